@@ -26,10 +26,63 @@ class Config:
             )
         self.debug = config.get("DEBUG", False)
         self.carrousel_size = config.get("CARROUSEL_SIZE", 10)
+        self.carousel_cache_mb = config.get("CAROUSEL_CACHE_MB", 32)
+        self.carousel_archive_dir = config.get("CAROUSEL_ARCHIVE_DIR", "")
         self.results_per_image = config.get("RESULTS_PER_IMAGE", 1)
+        self.results_page_size = config.get("RESULTS_PAGE_SIZE", 50)
+        self.lease_timeout = config.get("LEASE_TIMEOUT", 300)
+        self.memory_budget_mb = config.get("MEMORY_BUDGET_MB", 256)
+        self.spill_threshold_mb = config.get("SPILL_THRESHOLD_MB", 16)
+        self.max_upload_mb = config.get("MAX_UPLOAD_MB", 50)
+        self.blob_dir = config.get("BLOB_DIR", "")
+        self.accel_mapping = config.get("ACCEL_MAPPING", "")
+        self.queue_backend = config.get("QUEUE_BACKEND", "memory")
+        self.queue_db = config.get("QUEUE_DB", "queue.sqlite3")
+        self.upload_concurrency = config.get("UPLOAD_CONCURRENCY", 2)
+        self.upload_retries = config.get("UPLOAD_RETRIES", 5)
+        self.upload_backoff = config.get("UPLOAD_BACKOFF", 1.0)
+        self.journal_dir = config.get("JOURNAL_DIR", "")
+        self.journal_compact_every = config.get("JOURNAL_COMPACT_EVERY", 1000)
         self.animal_types = config.get("ANIMAL_TYPES", [])
         self.animal_types.append("other")
 
+        scheduler = config.get("scheduler", {})
+        self.scheduler_policy = scheduler.get("POLICY", "fifo")
+        self.broken_bone_boost = scheduler.get("BROKEN_BONE_BOOST", 0)
+        self.retry_boost = scheduler.get("RETRY_BOOST", 0)
+        self.animal_type_boosts = scheduler.get("ANIMAL_TYPE_BOOSTS", {})
+        self.scheduler_weights = scheduler.get("WEIGHTS", {})
+
+        normalize = config.get("normalize", {})
+        self.normalize_enabled = normalize.get("ENABLED", False)
+        self.normalize_max_edge = normalize.get("MAX_EDGE", 2048)
+        self.normalize_format = normalize.get("FORMAT", "jpeg")
+        self.normalize_quality = normalize.get("QUALITY", 90)
+        self.normalize_workers = normalize.get("WORKERS", 2)
+        self.normalize_keep_original = normalize.get("KEEP_ORIGINAL", True)
+
+        thumbnails = config.get("thumbnails", {})
+        self.thumbnail_sizes = thumbnails.get("SIZES", [256, 768])
+        self.thumbnail_cache_mb = thumbnails.get("CACHE_MB", 64)
+        self.thumbnail_format = thumbnails.get("FORMAT", "webp")
+        self.thumbnail_quality = thumbnails.get("QUALITY", 80)
+        self.thumbnail_eager = thumbnails.get("EAGER", False)
+
+        overlays = config.get("overlays", {})
+        self.overlay_cache_mb = overlays.get("CACHE_MB", 32)
+        self.overlay_scale_step = overlays.get("SCALE_STEP", 0.01)
+
+        preview = config.get("preview", {})
+        self.preview_max_edge = preview.get("MAX_EDGE", 1024)
+        self.preview_cache_mb = preview.get("CACHE_MB", 64)
+        self.preview_format = preview.get("FORMAT", "jpeg")
+        self.preview_quality = preview.get("QUALITY", 80)
+
+        events = config.get("events", {})
+        self.event_history = events.get("HISTORY", 256)
+        self.event_buffer = events.get("BUFFER", 64)
+        self.event_keepalive = events.get("KEEPALIVE", 15)
+
         security = config.get("security", {})
         self.password_hash = security.get("PASSWORD_HASH", "")
         self.access_token_expire_time = security.get("ACCESS_TOKEN_EXPIRE_TIME", 30)
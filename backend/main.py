@@ -1,14 +1,39 @@
+import asyncio
+from contextlib import asynccontextmanager
 from typing import Union
 
 from anyio import Path
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from .config import config
 from .routes import api, fracture_tool4
+from .routes.limits import BodySizeLimit
+from .routes.memory import MB
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await api.job_queue.recover()
+    # hand out jobs again whose workers never sent back a result
+    reaper = asyncio.create_task(api.job_queue.reap_leases())
+    yield
+    reaper.cancel()
+    # give the confirmed images a chance to reach the storage
+    await api.job_queue.uploads.aclose()
+    api.job_queue.close()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(api.router)
 app.include_router(fracture_tool4.router)
+# reject oversized uploads before they are parsed, leaving room for the form fields;
+# POST /jobs takes the results of up to MAX_BATCH jobs at once
+app.add_middleware(
+    BodySizeLimit,
+    max_body_size=config.max_upload_mb * MB + MB,
+    limits={"/jobs": api.MAX_BATCH * config.max_upload_mb * MB + MB},
+)
 # allow all cors because it probably doesn't matter in our case
 app.add_middleware(
     CORSMiddleware,
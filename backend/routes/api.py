@@ -1,8 +1,10 @@
+import asyncio
 import base64
+import hashlib
 import http
-import io
 import os
-import zipfile
+import secrets
+import time
 from curses.ascii import isdigit
 from datetime import datetime, timedelta, timezone
 from typing import Annotated, List, Tuple
@@ -14,7 +16,7 @@ import numpy as np
 import qrcode
 import reportlab.pdfgen.canvas
 import requests
-from anyio import SpooledTemporaryFile
+from anyio import SpooledTemporaryFile, to_thread
 from fastapi import (
     APIRouter,
     BackgroundTasks,
@@ -40,15 +42,127 @@ from fastapi.responses import (
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 from PIL import Image
-from pydantic import BaseModel
-
-from backend.routes.fracture_tool4 import apply_fracture
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+from backend.routes.fracture_tool4 import (
+    overlays,
+    place_fracture,
+    placement_error,
+    preview_fracture,
+    previews,
+    scaled_overlay,
+)
 
 from ..config import config
-from .jobqueue import ConfirmJobEnum, Job, JobQueue
+from .blobstore import BlobStore, BlobTooLarge, read_chunks
+from .bundles import BundleCache, bundle
+from .carousel import CarouselArchive
+from .events import EventBus
+from .jobqueue import (
+    BlobId,
+    ConfirmJobEnum,
+    Job,
+    JobQueue,
+    JobQueueBackend,
+    Lease,
+    PendingFilter,
+)
+from .journal import Journal
+from .memory import MB, MemoryAccountant
+from .normalize import Normalizer, UnsupportedImage
+from .responses import cache_headers, content_response, etag_matches, file_response
+from .scheduler import create_scheduler
+from .sqlitequeue import SQLiteJobQueue
+from .thumbnails import ThumbnailCache
+from .uploads import UploadPipeline
 
 router = APIRouter()
-job_queue = JobQueue(config.results_per_image, config.carrousel_size, config.storage[0])
+
+"""Creates the job queue backend selected by ``QUEUE_BACKEND``.
+
+    Raises:
+        ValueError: If the backend is unknown.
+
+    Returns:
+        JobQueueBackend: The job queue.
+"""
+
+
+def create_job_queue() -> JobQueueBackend:
+    scheduler = create_scheduler(
+        config.scheduler_policy,
+        broken_bone_boost=config.broken_bone_boost,
+        retry_boost=config.retry_boost,
+        animal_type_boosts=config.animal_type_boosts,
+        weights=config.scheduler_weights,
+    )
+    uploads = UploadPipeline(
+        config.storage[0],
+        concurrency=config.upload_concurrency,
+        retries=config.upload_retries,
+        backoff=config.upload_backoff,
+    )
+    archive = (
+        CarouselArchive(config.carousel_archive_dir)
+        if config.carousel_archive_dir
+        else None
+    )
+    if config.queue_backend == "sqlite":
+        return SQLiteJobQueue(
+            config.queue_db,
+            config.blob_dir or f"{config.queue_db}-blobs",
+            config.results_per_image,
+            config.carrousel_size,
+            config.storage[0],
+            lease_timeout=config.lease_timeout,
+            scheduler=scheduler,
+            uploads=uploads,
+            archive=archive,
+        )
+    if config.queue_backend != "memory":
+        raise ValueError(f"Unknown queue backend {config.queue_backend}")
+    return JobQueue(
+        config.results_per_image,
+        config.carrousel_size,
+        config.storage[0],
+        lease_timeout=config.lease_timeout,
+        journal=(
+            Journal(config.journal_dir, config.journal_compact_every)
+            if config.journal_dir
+            else None
+        ),
+        scheduler=scheduler,
+        blobs=BlobStore(
+            config.blob_dir or None,
+            MemoryAccountant(
+                budget=config.memory_budget_mb * MB,
+                spill_threshold=config.spill_threshold_mb * MB,
+            ),
+        ),
+        uploads=uploads,
+        archive=archive,
+    )
+
+
+job_queue = create_job_queue()
+normalizer = (
+    Normalizer(
+        max_edge=config.normalize_max_edge,
+        format=config.normalize_format,
+        quality=config.normalize_quality,
+        workers=config.normalize_workers,
+    )
+    if config.normalize_enabled
+    else None
+)
+thumbnails = ThumbnailCache(
+    sizes=tuple(config.thumbnail_sizes),
+    budget=config.thumbnail_cache_mb * MB,
+    format=config.thumbnail_format,
+    quality=config.thumbnail_quality,
+)
+bundles = BundleCache(budget=config.carousel_cache_mb * MB)
+events = EventBus(history=config.event_history, buffer=config.event_buffer)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
@@ -133,7 +247,39 @@ def validate_token(token: Annotated[str, Depends(oauth2_scheme)]) -> bool:
     return True
 
 
-qr_generation_progress: float = 0.0
+# a file rather than a global, so every worker process reports the same progress
+QR_PROGRESS_PATH = "temp/qr_progress"
+
+"""Records the progress of the QR code generation.
+
+    Args:
+        progress (float): The progress in percent.
+"""
+
+
+def set_qr_progress(progress: float) -> None:
+    os.makedirs(os.path.dirname(QR_PROGRESS_PATH), exist_ok=True)
+    tmp = f"{QR_PROGRESS_PATH}.{os.getpid()}"
+    with open(tmp, "w") as f:
+        f.write(str(progress))
+    os.replace(tmp, QR_PROGRESS_PATH)
+    events.publish_from_thread("qr", {"progress": progress})
+
+
+"""Reads the progress of the QR code generation.
+
+    Returns:
+        float: The progress in percent, 0 if no generation was started.
+"""
+
+
+def read_qr_progress() -> float:
+    try:
+        with open(QR_PROGRESS_PATH) as f:
+            return float(f.read())
+    except (FileNotFoundError, ValueError):
+        return 0.0
+
 
 """Generates QR codes in the background.
 
@@ -157,8 +303,7 @@ def gen_qr_codes(
     valid: Annotated[bool, Depends(validate_token)],
     background_tasks: BackgroundTasks,  # Inject BackgroundTasks as a parameter
 ):
-    global qr_generation_progress
-    qr_generation_progress = 0.0
+    set_qr_progress(0.0)
     # Add the task to the injected background_tasks
     background_tasks.add_task(get_qrs, n)
     return Response(
@@ -184,10 +329,11 @@ def gen_qr_codes(
 def get_qr_progress(
     valid: Annotated[bool, Depends(validate_token)],
 ):
-    print(f"QR generation progress: {qr_generation_progress}%")
+    progress = read_qr_progress()
+    print(f"QR generation progress: {progress}%")
     return JSONResponse(
         content={
-            "progress": qr_generation_progress,
+            "progress": progress,
         }
     )
 
@@ -219,14 +365,13 @@ def download_qr_pdf(
         n (int): The number of QR codes to generate.
 
     This function creates QR codes based on a user-specific URL and updates the global
-    `qr_generation_progress` variable to reflect the current progress of the generation.
+    progress recorded by `set_qr_progress` to reflect the current progress of the generation.
     The generated QR codes are passed to the `gen_qr_pdf` function for PDF creation.
 """
 
 
 def get_qrs(n):
-    global qr_generation_progress
-    qr_generation_progress = 0.0
+    set_qr_progress(0.0)
     qrs = []
     for i in range(n):
         url = config.storage[0].create_storage_for_user()
@@ -241,7 +386,7 @@ def get_qrs(n):
         img = qr.make_image(fill_color="black", back_color="white")
         qrs.append(img)
         qr.clear()
-        qr_generation_progress = i / n * 100
+        set_qr_progress(i / n * 100)
     gen_qr_pdf(qrs)
 
 
@@ -261,8 +406,7 @@ def gen_qr_pdf(qrs: list, size: int = 100):
     """
     qrs: list qrcode images
     """
-    global qr_generation_progress
-    qr_generation_progress = 0.0
+    set_qr_progress(0.0)
     X_BORDER, Y_BORDER, X_SPACING, Y_SPACING = 30, 30, 10, 10
     c = reportlab.pdfgen.canvas.Canvas("qr.pdf")
 
@@ -307,9 +451,171 @@ def gen_qr_pdf(qrs: list, size: int = 100):
                 c.showPage()
                 draw_page(c)
                 x, y = X_BORDER, Y_BORDER
-        qr_generation_progress = i / len(qrs) * 100
+        set_qr_progress(i / len(qrs) * 100)
     c.save()
-    qr_generation_progress = 100.0
+    set_qr_progress(100.0)
+
+
+"""Normalizes an uploaded image if normalization is enabled.
+
+    Args:
+        blob (BlobId): The image as uploaded, the reference on it is taken over.
+
+    Returns:
+        tuple[BlobId, BlobId | None]: The image to process and, if the upload is kept
+        for the storage, the image as uploaded.
+
+    Raises:
+        HTTPException: If the upload is not an image.
+"""
+
+
+async def normalize_upload(blob: BlobId) -> Tuple[BlobId, BlobId | None]:
+    if normalizer is None:
+        return blob, None
+    try:
+        with job_queue.blobs.open(blob) as file:
+            data = await normalizer.normalize(file)
+    except UnsupportedImage as e:
+        job_queue.blobs.release(blob)
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=str(e)
+        )
+    if data is None:
+        return blob, None
+    normalized = await job_queue.blobs.put(data)
+    if not config.normalize_keep_original:
+        job_queue.blobs.release(blob)
+        return normalized, None
+    return normalized, blob
+
+
+"""Renders the thumbnails of a job ahead of the first request, if configured.
+
+    Args:
+        job_id (int): The ID of the job whose original and results are rendered.
+"""
+
+
+def prefetch_thumbnails(job_id: int) -> None:
+    if not config.thumbnail_eager:
+        return
+    pending = job_queue.get_pending(job_id)
+    if pending is None:
+        return
+    job, results = pending
+    for blob in [job.blob, *results]:
+        thumbnails.prefetch(job_queue.blobs.open, blob)
+
+
+# the part of a blob id that image URLs carry as version, it changes with the content
+VERSION_LENGTH = 16
+
+# the names end up in the headers sent to the AI workers, where a line break would
+# start a header of its own
+HEADER_SAFE = r"^[^\x00-\x1f\x7f]*$"
+
+"""Builds the URL of an image that changes with its content.
+
+    Args:
+        request (Request): The FastAPI request object to construct URLs.
+        name (str): The name of the endpoint serving the image.
+        version (str): The version of the content, e.g. the start of its blob id.
+        **params: The path parameters of the endpoint.
+
+    Returns:
+        str: The URL with the version as ``v`` query parameter.
+"""
+
+
+def versioned_url(request: Request, name: str, version: str, **params) -> str:
+    return str(request.url_for(name, **params).include_query_params(v=version))
+
+
+"""Derives the version of a carousel item from the ids of its images.
+
+    Args:
+        xray (BlobId): The X-ray image.
+        original (BlobId): The original image.
+
+    Returns:
+        str: A version that changes with either image.
+"""
+
+
+def carousel_version(xray: BlobId, original: BlobId) -> str:
+    return hashlib.sha256(f"{xray}:{original}".encode()).hexdigest()[:VERSION_LENGTH]
+
+
+"""Serves an image, scaled down to a thumbnail if a size is given.
+
+    Args:
+        request (Request): The request, answered with 304 if it has the image already.
+        blob (BlobId): The image.
+        size (int | None): The longest edge of the thumbnail, or None for the image itself.
+        version (str | None): The version the client asked for.
+
+    Returns:
+        Response: The image or its thumbnail.
+
+    Raises:
+        HTTPException: If the size is not offered or the image cannot be scaled.
+"""
+
+
+async def image_response(
+    request: Request, blob: BlobId, size: int | None, version: str | None
+) -> Response:
+    etag = f'"{blob}"' if size is None else f'"{blob}-{size}"'
+    headers = cache_headers(etag, version, blob[:VERSION_LENGTH])
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if size is None:
+        return blob_response(request, blob, headers)
+    return content_response(
+        request, await thumbnail(blob, size), thumbnails.media_type, headers
+    )
+
+
+"""Serves an image straight from the blob store.
+
+    Images spilled to disk are sent as files, or handed to nginx, so their bytes never
+    pass through Python, see :func:`file_response`. All images support byte ranges.
+
+    Args:
+        request (Request): The request, possibly asking for a byte range.
+        blob (BlobId): The image.
+        headers (dict[str, str]): Further headers of the response.
+        redirect (bool): False to never hand the image to nginx, see :func:`file_response`.
+
+    Returns:
+        Response: The image.
+"""
+
+
+def blob_response(
+    request: Request, blob: BlobId, headers: dict[str, str], redirect: bool = True
+) -> Response:
+    path = job_queue.blobs.path(blob)
+    if path is None:
+        return content_response(
+            request, job_queue.blobs.view(blob), "image/png", headers
+        )
+    return file_response(
+        request, path, "image/png", headers, redirect, config.accel_mapping
+    )
+
+
+async def thumbnail(blob: BlobId, size: int) -> bytes:
+    try:
+        return await thumbnails.get(job_queue.blobs.open, blob, size)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except OSError:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Cannot scale the image",
+        )
 
 
 """Receives an image of an animal and owner details for processing.
@@ -326,6 +632,10 @@ def gen_qr_pdf(qrs: list, size: int = 100):
 
     Returns:
         dict: A JSON object containing the status of the upload, job ID, and current job count.
+
+    Raises:
+        HTTPException: If the image is larger than ``MAX_UPLOAD_MB`` or not an image,
+            or a name contains control characters.
 """
 
 
@@ -335,21 +645,31 @@ def gen_qr_pdf(qrs: list, size: int = 100):
 )
 async def create_upload_file(
     file: Annotated[UploadFile, File()],
-    first_name: Annotated[str, Form(...)],
-    last_name: Annotated[str, Form(...)],
-    animal_name: Annotated[str, Form(...)],
+    first_name: Annotated[str, Form(..., pattern=HEADER_SAFE)],
+    last_name: Annotated[str, Form(..., pattern=HEADER_SAFE)],
+    animal_name: Annotated[str, Form(..., pattern=HEADER_SAFE)],
     qr_content: Annotated[str, Form(...)],
     valid: Annotated[bool, Depends(validate_token)],
-    animal_type: Annotated[str, Form()] = "other",  # TODO: add validator
+    # TODO: add validator
+    animal_type: Annotated[str, Form(pattern=HEADER_SAFE)] = "other",
     broken_bone: Annotated[bool, Form()] = False,
 ):
     """Receive image of a teddy and user id so that we know where to save later.
     the image itself also gets an id so it can be referenced later when receiving results
     from AI."""
-    f = SpooledTemporaryFile()
-    await f.write(await file.read())
+    try:
+        # streamed into the blob store, hashed on the way, never read as a whole
+        blob = await job_queue.blobs.put_stream(
+            read_chunks(file), limit=config.max_upload_mb * MB
+        )
+    except BlobTooLarge as e:
+        raise HTTPException(
+            status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=str(e)
+        )
+    blob, archive = await normalize_upload(blob)
     job = Job(
-        file=f,
+        blob=blob,
+        archive=archive,
         owner_ref=qr_content,
         first_name=first_name,
         last_name=last_name,
@@ -359,13 +679,16 @@ async def create_upload_file(
         number_of_results=config.results_per_image,
     )
     job_queue.add_job(job)
-    return {"status": "success", "job_id": job.id, "current_jobs": len(job_queue.queue)}
+    events.publish("job", {"id": job.id})
+    prefetch_thumbnails(job.id)
+    return {"status": "success", "job_id": job.id, "current_jobs": job_queue.queued()}
 
 
 """Retrieves a job from the queue and returns the associated image.
 
     Args:
         valid (bool): Validates the token for authorization.
+        wait (float, optional): Seconds to wait for a job if the queue is empty. Defaults to 0.
 
     Returns:
         Response: An image response with job details or a 204 status if no jobs are available.
@@ -382,24 +705,96 @@ async def create_upload_file(
 )
 async def get_job(
     valid: Annotated[bool, Depends(validate_token)],
+    request: Request,
+    wait: Annotated[float, Query(ge=0, le=60)] = 0,
 ):
     """
     Get job from the queue. Returns an image with an id.
     """
-    job = job_queue.get_job()
-    if job is None:
+    lease = await job_queue.wait_for_job(wait)
+    if lease is None:
         return Response(status_code=status.HTTP_204_NO_CONTENT)
-    await job.file.seek(0)
-    response = Response(
-        content=await job.file.read(), media_type="image/png", status_code=200
+    # nginx drops the headers describing the job when it takes over the transfer
+    return blob_response(request, lease.job.blob, lease_headers(lease), redirect=False)
+
+
+"""Builds the headers that describe a leased job to the AI workers.
+
+    Args:
+        lease (Lease): The lease on the job to describe.
+
+    Returns:
+        dict[str, str]: The job ID, the lease and the metadata of the owner and animal.
+"""
+
+
+def lease_headers(lease: Lease) -> dict[str, str]:
+    job = lease.job
+    return {
+        "img_id": str(job.id),
+        "lease_token": lease.token,
+        "lease_timeout": str(job_queue.lease_timeout),
+        "first_name": job.first_name,
+        "last_name": job.last_name,
+        "animal_name": job.animal_name,
+        "animal_type": job.animal_type,
+    }
+
+
+# the most jobs leased or concluded in one request
+MAX_BATCH = 64
+
+"""Retrieves a batch of jobs from the queue as a single multipart response.
+
+    Every part holds one image and carries the same metadata headers as ``GET /job``.
+
+    Args:
+        valid (bool): Validates the token for authorization.
+        max (int): The maximum number of jobs to lease.
+        wait (float, optional): Seconds to wait for the first job if the queue is empty. Defaults to 0.
+
+    Returns:
+        StreamingResponse: A multipart/mixed response with one part per job or a 204 status if no jobs are available.
+"""
+
+
+@router.get(
+    "/jobs",
+    responses={
+        200: {"content": {"multipart/mixed": {}}},
+        204: {"description": "No Jobs in queue"},
+    },
+    response_class=StreamingResponse,
+)
+async def get_jobs(
+    valid: Annotated[bool, Depends(validate_token)],
+    max: Annotated[int, Query(gt=0, le=MAX_BATCH)],
+    wait: Annotated[float, Query(ge=0, le=60)] = 0,
+):
+    lease = await job_queue.wait_for_job(wait)
+    if lease is None:
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    leases = [lease] + job_queue.lease_jobs(max - 1)
+    boundary = secrets.token_hex(16)
+    # taken now, the views outlive a job cancelled while the batch is sent
+    views = [job_queue.blobs.view(lease.job.blob) for lease in leases]
+
+    async def parts():
+        for lease, view in zip(leases, views):
+            headers = {"Content-Type": "image/png", **lease_headers(lease)}
+            yield f"--{boundary}\r\n".encode()
+            for key, value in headers.items():
+                yield f"{key}: {value}\r\n".encode()
+            yield b"\r\n"
+            yield view
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+    return StreamingResponse(
+        parts(),
+        media_type=f"multipart/mixed; boundary={boundary}",
+        headers={"job_count": str(len(leases))},
     )
-    response.headers["Content-Type"] = "image/png"
-    response.headers["img_id"] = str(job.id)
-    response.headers["first_name"] = job.first_name
-    response.headers["last_name"] = job.last_name
-    response.headers["animal_name"] = job.animal_name
-    response.headers["animal_type"] = job.animal_type
-    return response
 
 
 """Submits the result of a job for processing.
@@ -408,6 +803,10 @@ async def get_job(
         image_id (int): The ID of the job to conclude.
         result (UploadFile): The result image file to be submitted.
         valid (bool): Validates the token for authorization.
+        lease_token (str | None, optional): The lease token handed out with the job.
+
+    Raises:
+        HTTPException: If the job ID is invalid or the lease expired.
 
     Returns:
         dict: A JSON object indicating the success of the submission.
@@ -419,11 +818,68 @@ async def conclude_job(
     image_id: Annotated[int, Form()],
     result: Annotated[UploadFile, File()],
     valid: Annotated[bool, Depends(validate_token)],
+    lease_token: Annotated[str | None, Form()] = None,
 ):
-    await job_queue.submit_job(image_id, await result.read())
+    try:
+        await job_queue.submit_job(image_id, await result.read(), lease_token)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    events.publish("result", {"id": image_id})
+    prefetch_thumbnails(image_id)
     return {"status": "success"}
 
 
+"""Submits the results of several jobs at once.
+
+    The n-th entry of ``image_ids`` is the job the n-th file in ``results`` belongs to.
+
+    Args:
+        image_ids (list[int]): The IDs of the jobs to conclude.
+        results (list[UploadFile]): The result image files to be submitted.
+        valid (bool): Validates the token for authorization.
+        lease_tokens (list[str] | None, optional): The lease tokens handed out with the jobs, in the same order.
+
+    Raises:
+        HTTPException: If the number of IDs, results and lease tokens differ, or there
+            are more than ``MAX_BATCH`` results.
+
+    Returns:
+        dict: A JSON object with the status of every submitted result.
+"""
+
+
+@router.post("/jobs", responses={200: {"content": {"application/json": {}}}})
+async def conclude_jobs(
+    image_ids: Annotated[list[int], Form()],
+    results: Annotated[list[UploadFile], File()],
+    valid: Annotated[bool, Depends(validate_token)],
+    lease_tokens: Annotated[list[str] | None, Form()] = None,
+):
+    tokens: list[str | None] = [None] * len(image_ids)
+    if lease_tokens is not None:
+        tokens = list(lease_tokens)
+    if not len(image_ids) == len(results) == len(tokens):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Number of image_ids, results and lease_tokens differ",
+        )
+    if len(results) > MAX_BATCH:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_BATCH} results per request",
+        )
+    statuses = []
+    for image_id, result, token in zip(image_ids, results, tokens):
+        try:
+            await job_queue.submit_job(image_id, await result.read(), token)
+            events.publish("result", {"id": image_id})
+            prefetch_thumbnails(image_id)
+            statuses.append({"image_id": image_id, "status": "success"})
+        except ValueError as e:
+            statuses.append({"image_id": image_id, "status": "error", "detail": str(e)})
+    return {"status": "success", "results": statuses}
+
+
 """Confirms a job based on user input.
 
     Args:
@@ -445,22 +901,85 @@ async def confirm_job(
     valid: Annotated[bool, Depends(validate_token)],
     image: Annotated[UploadFile | None, File()] = None,
 ):
-    await job_queue.confirm_job(image_id, confirm, choice, image)
+    # taken before confirming, the memory backend replaces it in the same list
+    pending = job_queue.get_pending(image_id)
+    replaced = None
+    if image is not None and pending is not None and 0 <= choice < len(pending[1]):
+        replaced = pending[1][choice]
+    try:
+        await job_queue.confirm_job(image_id, confirm, choice, image)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if replaced is not None:
+        # the override replaced the chosen result
+        thumbnails.invalidate(replaced)
+    events.publish("confirm", {"id": image_id, "confirm": confirm.value})
+    if confirm == ConfirmJobEnum.confirm:
+        await prepare_carousel()
     return JSONResponse(content={"status": "success"})
 
 
-@router.post("/apply_fracture_queue", response_class=JSONResponse)
-async def get_fracture_queue(
-    valid: Annotated[bool, Depends(validate_token)],
-    job_id: Annotated[int, Form()],
-    choice: Annotated[int, Form()],
-    overlay_file: Annotated[UploadFile, File()],
-    x: Annotated[int, Form()],
-    y: Annotated[int, Form()],
-    scale: Annotated[float, Form()],
-    noise: Annotated[int, Form()],
-) -> JSONResponse:
-    job = job_queue.awaiting_approval.get(job_id, None)
+"""Builds the bundle of the newest carousel item, so displays never wait for it.
+
+    Also drops the bundles of the items that left the carousel, and tells the
+    displays to fetch the new one.
+"""
+
+
+async def prepare_carousel() -> None:
+    carousel = job_queue.get_carousel()
+    bundles.retain(carousel_version(*pair) for pair in carousel)
+    if carousel:
+        await carousel_bundle(*carousel[0], None)
+        events.publish("carousel", {"version": carousel_version(*carousel[0])})
+
+
+"""Returns the zip file of a carousel item, building it on first use.
+
+    Args:
+        xray (BlobId): The X-ray image.
+        original (BlobId): The original image.
+        size (int | None): The longest edge of thumbnails to put in the zip file
+            instead of the images.
+
+    Returns:
+        bytes: The zip file.
+
+    Raises:
+        HTTPException: If the size is not offered or the images cannot be scaled.
+"""
+
+
+async def carousel_bundle(xray: BlobId, original: BlobId, size: int | None) -> bytes:
+    version = carousel_version(xray, original)
+    data = bundles.get(version, size)
+    if data is not None:
+        return data
+    if size is None:
+        images = job_queue.blobs.view(xray), job_queue.blobs.view(original)
+    else:
+        images = await thumbnail(xray, size), await thumbnail(original, size)
+    data = await to_thread.run_sync(bundle, *images)
+    bundles.put(version, size, data)
+    return data
+
+
+"""Looks up a result awaiting approval for the fracture endpoints.
+
+    Args:
+        job_id (int): The ID of the job.
+        choice (int): The index of the result.
+
+    Returns:
+        BlobId: The result.
+
+    Raises:
+        HTTPException: If the job or the result does not exist.
+"""
+
+
+def pending_result(job_id: int, choice: int) -> BlobId:
+    job = job_queue.get_pending(job_id)
     if job is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -472,52 +991,462 @@ async def get_fracture_queue(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid choice index",
         )
-    image = results[choice]
-    await image.seek(0)
-    result = apply_fracture(
-        img=cv2.imdecode(np.frombuffer(await image.read(), np.uint8), cv2.IMREAD_COLOR),
-        overlay=cv2.imdecode(
-            np.frombuffer(await overlay_file.read(), np.uint8), cv2.IMREAD_UNCHANGED
-        ),
+    return results[choice]
+
+
+"""Registers a fracture overlay, to be referenced by id in fracture requests.
+
+    Registering the same file again gives the same id.
+
+    Args:
+        overlay_file (UploadFile): A PNG with an alpha channel.
+        valid (bool): Validates the token for authorization.
+
+    Returns:
+        JSONResponse: The id of the overlay.
+
+    Raises:
+        HTTPException: If the file is not an image with an alpha channel.
+"""
+
+
+@router.post("/overlays", response_class=JSONResponse)
+async def register_overlay(
+    overlay_file: Annotated[UploadFile, File()],
+    valid: Annotated[bool, Depends(validate_token)],
+) -> JSONResponse:
+    data = await overlay_file.read()
+    try:
+        overlay_id = await to_thread.run_sync(overlays.register, data)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return JSONResponse(content={"id": overlay_id})
+
+
+"""Lists the registered fracture overlays.
+
+    Args:
+        valid (bool): Validates the token for authorization.
+
+    Returns:
+        JSONResponse: The ids of the overlays.
+"""
+
+
+@router.get("/overlays", response_class=JSONResponse)
+def get_overlays(valid: Annotated[bool, Depends(validate_token)]) -> JSONResponse:
+    return JSONResponse(content={"ids": overlays.ids()})
+
+
+"""Forgets a fracture overlay and its resized variants.
+
+    Args:
+        overlay_id (str): The id of the overlay.
+        valid (bool): Validates the token for authorization.
+
+    Raises:
+        HTTPException: If the overlay is not registered.
+"""
+
+
+@router.delete("/overlays/{overlay_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_overlay(
+    overlay_id: str, valid: Annotated[bool, Depends(validate_token)]
+) -> None:
+    if not overlays.remove(overlay_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Overlay not registered"
+        )
+
+
+"""Paints a fracture onto an encoded image at full resolution.
+
+    Args:
+        image (memoryview): The encoded image.
+        overlay_id (str | None): The id of a registered overlay.
+        overlay_data (bytes | None): The uploaded overlay.
+        x (int): The left edge of the overlay in the image.
+        y (int): The top edge of the overlay in the image.
+        scale (float): The scale of the overlay.
+        noise (int): The standard deviation of the noise painted with it.
+
+    Returns:
+        bytes: The painted image as PNG.
+
+    Raises:
+        HTTPException: If the overlay is missing, unknown or not an image.
+"""
+
+
+def paint_fracture(
+    image: memoryview,
+    overlay_id: str | None,
+    overlay_data: bytes | None,
+    x: int,
+    y: int,
+    scale: float,
+    noise: int,
+) -> bytes:
+    overlay = scaled_overlay(overlay_id, overlay_data, scale)
+    result = place_fracture(
+        img=cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR),
+        overlay=overlay,
         x=x,
         y=y,
-        scale=scale,
         noise_std=noise,
     )
     _, encoded_img = cv2.imencode(".png", result)
-    results[choice] = SpooledTemporaryFile()
-    await results[choice].write(encoded_img.tobytes())
+    return encoded_img.tobytes()
+
+
+"""Paints a fracture onto a result awaiting approval.
+
+    The overlay is either uploaded as ``overlay_file`` or, for overlays registered
+    with ``/overlays``, referenced as ``overlay_id``.
+
+    Args:
+        valid (bool): Validates the token for authorization.
+        job_id (int): The ID of the job.
+        choice (int): The index of the result.
+        x (int): The left edge of the overlay in the result.
+        y (int): The top edge of the overlay in the result.
+        scale (float): The scale of the overlay.
+        noise (int): The standard deviation of the noise painted with it.
+        overlay_file (UploadFile | None, optional): The overlay.
+        overlay_id (str | None, optional): The id of a registered overlay.
+
+    Returns:
+        JSONResponse: The status.
+
+    Raises:
+        HTTPException: If the job or the result does not exist, or the overlay is
+            missing, unknown or not an image.
+"""
+
+
+@router.post("/apply_fracture_queue", response_class=JSONResponse)
+async def get_fracture_queue(
+    valid: Annotated[bool, Depends(validate_token)],
+    job_id: Annotated[int, Form()],
+    choice: Annotated[int, Form()],
+    x: Annotated[int, Form()],
+    y: Annotated[int, Form()],
+    scale: Annotated[float, Form()],
+    noise: Annotated[int, Form()],
+    overlay_file: Annotated[UploadFile | None, File()] = None,
+    overlay_id: Annotated[str | None, Form()] = None,
+) -> JSONResponse:
+    overlay_data = await overlay_file.read() if overlay_file is not None else None
+    blob = pending_result(job_id, choice)
+    # the result may be replaced or confirmed while it is painted
+    job_queue.blobs.incref(blob)
+    try:
+        encoded = await to_thread.run_sync(
+            paint_fracture,
+            job_queue.blobs.view(blob),
+            overlay_id,
+            overlay_data,
+            x,
+            y,
+            scale,
+            noise,
+        )
+    finally:
+        job_queue.blobs.release(blob)
+    try:
+        await job_queue.replace_result(job_id, choice, encoded)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    thumbnails.invalidate(blob)
+    events.publish("result", {"id": job_id})
+    prefetch_thumbnails(job_id)
     return JSONResponse(content={"status": "success"})
 
 
-"""Retrieves the results of jobs awaiting approval.
+"""Previews a fracture on a result awaiting approval, without changing it.
+
+    The fracture is painted on a scaled-down copy of the result, cached for the
+    following previews, and sent as a JPEG or WebP; ``/apply_fracture_queue`` with
+    the same form paints it at full resolution.
+
+    Args:
+        valid (bool): Validates the token for authorization.
+        job_id (int): The ID of the job.
+        choice (int): The index of the result.
+        x (int): The left edge of the overlay in the result.
+        y (int): The top edge of the overlay in the result.
+        scale (float): The scale of the overlay.
+        noise (int): The standard deviation of the noise painted with it.
+        overlay_file (UploadFile | None, optional): The overlay.
+        overlay_id (str | None, optional): The id of a registered overlay.
+
+    Returns:
+        Response: The preview.
+
+    Raises:
+        HTTPException: If the job or the result does not exist, or the overlay is
+            missing, unknown or not an image.
+"""
+
+
+@router.post(
+    "/preview_fracture_queue",
+    responses={200: {"content": {"image/jpeg": {}, "image/webp": {}}}},
+    response_class=Response,
+)
+async def preview_fracture_queue(
+    valid: Annotated[bool, Depends(validate_token)],
+    job_id: Annotated[int, Form()],
+    choice: Annotated[int, Form()],
+    x: Annotated[int, Form()],
+    y: Annotated[int, Form()],
+    scale: Annotated[float, Form()],
+    noise: Annotated[int, Form()],
+    overlay_file: Annotated[UploadFile | None, File()] = None,
+    overlay_id: Annotated[str | None, Form()] = None,
+) -> Response:
+    overlay_data = await overlay_file.read() if overlay_file is not None else None
+    blob = pending_result(job_id, choice)
+    # the result may be replaced or confirmed while the copy is made
+    job_queue.blobs.incref(blob)
+    try:
+        content = await to_thread.run_sync(
+            preview_fracture,
+            blob,
+            job_queue.blobs.view(blob),
+            overlay_id,
+            overlay_data,
+            x,
+            y,
+            scale,
+            noise,
+        )
+    finally:
+        job_queue.blobs.release(blob)
+    return Response(content=content, media_type=previews.media_type)
+
+
+class FractureOperation(BaseModel):
+    # a registered overlay, or the index of an uploaded one in overlay_files
+    overlay_id: str | None = None
+    overlay_file: int | None = None
+    x: int
+    y: int
+    scale: float = 1.0
+    noise: int = 0
+
+
+FRACTURE_OPERATIONS = TypeAdapter(list[FractureOperation])
+
+"""Paints several fractures onto an encoded image, decoding and encoding it once.
+
+    Blocks for as long as the image takes to decode, paint and encode; runs in a
+    worker thread.
+
+    Args:
+        image (bytes | memoryview): The encoded image.
+        operations (list[FractureOperation]): The fractures, painted in order.
+        overlay_files (list[bytes]): The uploaded overlays the operations refer to.
+
+    Returns:
+        tuple[bytes | None, list[dict]]: The image as PNG, or None if no fracture
+        was painted, and the status of every operation.
+"""
+
+
+def fracture_batch(
+    image: bytes | memoryview,
+    operations: list[FractureOperation],
+    overlay_files: list[bytes],
+) -> tuple[bytes | None, list[dict]]:
+    img = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    statuses = []
+    for operation in operations:
+        data = None
+        if operation.overlay_file is not None:
+            if not 0 <= operation.overlay_file < len(overlay_files):
+                statuses.append({"status": "error", "detail": "No such overlay file"})
+                continue
+            data = overlay_files[operation.overlay_file]
+        try:
+            overlay = scaled_overlay(operation.overlay_id, data, operation.scale)
+        except HTTPException as e:
+            statuses.append({"status": "error", "detail": e.detail})
+            continue
+        error = placement_error(img, overlay, operation.x, operation.y)
+        if error is not None:
+            statuses.append({"status": "error", "detail": error})
+            continue
+        place_fracture(img, overlay, operation.x, operation.y, operation.noise)
+        statuses.append({"status": "success"})
+    if not any(s["status"] == "success" for s in statuses):
+        return None, statuses
+    _, encoded_img = cv2.imencode(".png", img)
+    return encoded_img.tobytes(), statuses
+
+
+"""Paints several fractures onto a result awaiting approval at once.
+
+    The result is decoded once, the fractures are painted in order and it is encoded
+    once at the end. Operations that fail, e.g. because the overlay is unknown or
+    does not fit, are skipped and reported; the others are still painted.
+
+    Args:
+        valid (bool): Validates the token for authorization.
+        job_id (int): The ID of the job.
+        choice (int): The index of the result.
+        operations (str): A JSON list of operations with ``x``, ``y``, ``scale``,
+            ``noise`` and either ``overlay_id`` or ``overlay_file``, the index of the
+            overlay in ``overlay_files``.
+        overlay_files (list[UploadFile] | None, optional): The uploaded overlays.
+
+    Returns:
+        JSONResponse: The status of every operation, in order.
+
+    Raises:
+        HTTPException: If the operations are malformed or the job or the result does
+            not exist.
+"""
+
+
+@router.post("/apply_fractures_queue", response_class=JSONResponse)
+async def apply_fractures_queue(
+    valid: Annotated[bool, Depends(validate_token)],
+    job_id: Annotated[int, Form()],
+    choice: Annotated[int, Form()],
+    operations: Annotated[str, Form()],
+    overlay_files: Annotated[list[UploadFile] | None, File()] = None,
+) -> JSONResponse:
+    try:
+        parsed = FRACTURE_OPERATIONS.validate_json(operations)
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Malformed operations: {e.errors()[0]['msg']}",
+        )
+    files = [await file.read() for file in overlay_files or []]
+    blob = pending_result(job_id, choice)
+    # the result may be replaced or confirmed while it is painted
+    job_queue.blobs.incref(blob)
+    try:
+        encoded, statuses = await to_thread.run_sync(
+            fracture_batch, job_queue.blobs.view(blob), parsed, files
+        )
+    finally:
+        job_queue.blobs.release(blob)
+    if encoded is not None:
+        try:
+            await job_queue.replace_result(job_id, choice, encoded)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+        thumbnails.invalidate(blob)
+        events.publish("result", {"id": job_id})
+        prefetch_thumbnails(job_id)
+    return JSONResponse(content={"status": "success", "results": statuses})
+
+
+"""Retrieves the results of jobs awaiting approval, a page at a time.
+
+    Jobs are listed oldest first, at most ``limit`` of them; ``next`` is the cursor
+    to pass as ``after`` for the following page, or null after the last one. The
+    filters select from secondary indexes of the queue.
+
+    With ``since`` only the jobs added, changed or removed after that version are
+    listed, so polling costs as much as there are changes. Changed jobs that do not
+    match the filters anymore are listed as removed, and the changes are not paged.
+    If the version is too old to tell, or missing, the first page is listed and
+    ``full`` is true.
 
     Args:
         valid (bool): Validates the token for authorization.
         request (Request): The FastAPI request object to construct URLs.
+        since (int | None, optional): The ``version`` of an earlier response.
+        after (str | None, optional): The ``next`` cursor of the previous page.
+        limit (int | None, optional): The most jobs to list, at most ``RESULTS_PAGE_SIZE``.
+        animal_type (str | None, optional): Only jobs of this animal type.
+        complete (bool | None, optional): Only jobs with all results, or only jobs
+            still waiting for some.
+        min_age (float | None, optional): Only jobs waiting at least this many seconds.
+        max_age (float | None, optional): Only jobs waiting at most this many seconds.
+
+    Raises:
+        HTTPException: If the cursor is malformed.
 
     Returns:
-        JSONResponse: A JSON object containing metadata, result URLs, and original image URLs for each job.
+        JSONResponse: A JSON object containing metadata, result URLs, and original image URLs for each job,
+        the ids of the removed jobs, the cursor of the next page and the version to ask with next.
 """
 
 
 @router.get("/results")
 async def get_results(
-    valid: Annotated[bool, Depends(validate_token)], request: Request
+    valid: Annotated[bool, Depends(validate_token)],
+    request: Request,
+    since: Annotated[int | None, Query()] = None,
+    after: Annotated[str | None, Query()] = None,
+    limit: Annotated[int | None, Query(ge=1)] = None,
+    animal_type: Annotated[str | None, Query()] = None,
+    complete: Annotated[bool | None, Query()] = None,
+    min_age: Annotated[float | None, Query(ge=0)] = None,
+    max_age: Annotated[float | None, Query(ge=0)] = None,
 ) -> JSONResponse:
-    # Compare job_queue.awaiting_approval with current_results
+    now = time.time()
+    pending_filter = PendingFilter(
+        animal_type=animal_type,
+        complete=complete,
+        added_after=None if max_age is None else now - max_age,
+        added_before=None if min_age is None else now - min_age,
+    )
+    cursor = None
+    if after is not None:
+        try:
+            added, id = after.split(":")
+            cursor = float(added), int(id)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+            )
+    limit = min(limit or config.results_page_size, config.results_page_size)
+    # a version below any real one lists everything
+    version, changed = job_queue.changes(-1 if since is None else since)
+    removed: list[int] = []
+    next_cursor = None
+    if changed is None:
+        pending, next_cursor = job_queue.pending_page(pending_filter, cursor, limit)
+    else:
+        pending = []
+        for id in changed:
+            entry = job_queue.get_pending(id)
+            if entry is None or not pending_filter.matches(
+                *entry, config.results_per_image
+            ):
+                removed.append(id)
+            else:
+                pending.append(entry)
     # return dict with key = job_id and value = list of urls for the results
     results: dict[int, list[str]] = {}
     originals: dict[int, str] = {}
     metadata: dict[int, dict] = {}
-    for k, v in job_queue.awaiting_approval.items():
+    for v in pending:
+        k = v[0].id
+        # the URLs change with the images, so browsers can cache them for good
         results[k] = [
-            str(request.url_for("get_result_image", job_id=k, option=str(option)))
-            for option in range(len(v[1]))
+            versioned_url(
+                request,
+                "get_result_image",
+                blob[:VERSION_LENGTH],
+                job_id=k,
+                option=str(option),
+            )
+            for option, blob in enumerate(v[1])
         ]
         results[k] = results[k] + ["nonsense"] * (config.results_per_image - len(v[1]))
-        originals[k] = str(
-            request.url_for("get_result_image", job_id=k, option="original")
+        originals[k] = versioned_url(
+            request,
+            "get_result_image",
+            v[0].blob[:VERSION_LENGTH],
+            job_id=k,
+            option="original",
         )
         job = v[0]
         metadata[k] = {
@@ -530,6 +1459,12 @@ async def get_results(
         "results": results,
         "originals": originals,
         "results_per_image": config.results_per_image,
+        "version": version,
+        "full": changed is None,
+        "removed": removed,
+        "next": (
+            None if next_cursor is None else f"{next_cursor[0]!r}:{next_cursor[1]}"
+        ),
     }
     return JSONResponse(content=response)
 
@@ -539,33 +1474,123 @@ async def get_results(
     Args:
         job_id (int): The ID of the job whose result is being requested.
         option (str): The option index of the result image.
+        request (Request): The request, answered with 304 if it has the image already.
+        size (int | None, optional): The longest edge of a thumbnail to return instead,
+            one of the configured thumbnail sizes.
+        v (str | None, optional): The version of the image from ``/results``, with the
+            current version the image is cached for good.
 
     Returns:
-        StreamingResponse: A streaming response containing the requested image.
+        Response: A response containing the requested image.
 """
 
 
-@router.get("/results/{job_id}/{option}", response_class=StreamingResponse)
+@router.api_route(
+    "/results/{job_id}/{option}", methods=["GET", "HEAD"], response_class=Response
+)
 async def get_result_image(
-    job_id: Annotated[int, Path()], option: Annotated[str, Path()]
+    job_id: Annotated[int, Path()],
+    option: Annotated[str, Path()],
+    request: Request,
+    size: Annotated[int | None, Query()] = None,
+    v: Annotated[str | None, Query()] = None,
 ):
+    pending = job_queue.get_pending(job_id)
+    if pending is None:
+        return Response(status_code=status.HTTP_404_NOT_FOUND)
     if option.isdigit():
-        options = job_queue.awaiting_approval[job_id][1]
-        file = options[int(option)]
-        await file.seek(0)
-        response = StreamingResponse(content=file, media_type="image/png")
+        options = pending[1]
+        blob = options[int(option)]
     else:
-        job = job_queue.awaiting_approval[job_id][0]
-        file = job.file
-        await file.seek(0)
+        job = pending[0]
+        blob = job.blob
+    # edited images get a new version, so the old one can be cached for good
+    return await image_response(request, blob, size, v)
+
+
+"""Reports how many bytes of images are held in memory and on disk.
+
+    Args:
+        valid (bool): Validates the token for authorization.
+
+    Returns:
+        JSONResponse: A JSON object with the number and size of the stored images and
+        cached thumbnails and, for the in-memory queue, the memory budget and the
+        resident and spilled bytes.
+"""
+
+
+@router.get("/memory", response_class=JSONResponse)
+def get_memory_usage(valid: Annotated[bool, Depends(validate_token)]):
+    return JSONResponse(
+        content=job_queue.blobs.stats()
+        | thumbnails.stats()
+        | bundles.stats()
+        | overlays.stats()
+        | previews.stats()
+    )
+
+
+"""Reports the uploads of the recently confirmed jobs to the storage.
+
+    Args:
+        valid (bool): Validates the token for authorization.
+
+    Returns:
+        JSONResponse: A list of upload states, oldest first, each with the job id, the
+        status (queued, uploading, retrying, done or failed), the number of uploaded
+        files out of all files, the attempts on the current file and the last error.
+"""
 
-        response = StreamingResponse(content=file, media_type="image/png")
 
-    # these headers are for fixing cache issue
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
-    return response
+@router.get("/uploads", response_class=JSONResponse)
+def get_uploads(valid: Annotated[bool, Depends(validate_token)]):
+    return JSONResponse(content=job_queue.upload_statuses())
+
+
+"""Reports the uploads of a confirmed job to the storage.
+
+    Args:
+        job_id (int): The ID of the confirmed job.
+        valid (bool): Validates the token for authorization.
+
+    Returns:
+        JSONResponse: The upload state of the job.
+
+    Raises:
+        HTTPException: If no uploads are known for the job.
+"""
+
+
+@router.get("/uploads/{job_id}", response_class=JSONResponse)
+def get_upload(job_id: int, valid: Annotated[bool, Depends(validate_token)]):
+    state = job_queue.upload_status(job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="No uploads for this job")
+    return JSONResponse(content=state)
+
+
+"""Uploads the images of a confirmed job again after they failed.
+
+    Args:
+        job_id (int): The ID of the confirmed job.
+        valid (bool): Validates the token for authorization.
+
+    Returns:
+        JSONResponse: A JSON object indicating that the uploads are queued again.
+
+    Raises:
+        HTTPException: If the uploads of the job did not fail.
+"""
+
+
+@router.post("/uploads/{job_id}/retry", response_class=JSONResponse)
+def retry_upload(job_id: int, valid: Annotated[bool, Depends(validate_token)]):
+    if not job_queue.retry_upload(job_id):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="The uploads did not fail"
+        )
+    return JSONResponse(content={"status": "success"})
 
 
 """Retrieves the list of available animal types.
@@ -580,6 +1605,68 @@ def get_animal_types():
     return JSONResponse({"types": config.animal_types})
 
 
+# the events of /events that need no token
+PUBLIC_EVENTS = {"carousel", "reset"}
+
+"""Streams what happens in the backend as Server-Sent Events.
+
+    The events are "job" when a teddy is queued, "result" when a result arrives or
+    is edited, "confirm" when a job is confirmed, retried or cancelled, "carousel"
+    when the carousel changed and "qr" with the progress of the QR code generation.
+    They carry ids and versions only, clients fetch the rest from the other endpoints.
+    A "reset" event tells a client that it missed events and has to fetch everything.
+
+    Browsers cannot send an ``Authorization`` header with an event stream, so the
+    token comes as query parameter. Without it only the ``PUBLIC_EVENTS`` are sent,
+    which announce nothing the public ``/carousel`` does not show anyway.
+
+    Args:
+        token (str | None, optional): The JWT token, for all events.
+        last_event_id (int | None, optional): The id of the last event received,
+            sent by the browser when it reconnects.
+
+    Raises:
+        HTTPException: If the token is invalid.
+
+    Returns:
+        StreamingResponse: The event stream, with a comment every ``KEEPALIVE`` seconds.
+"""
+
+
+@router.get(
+    "/events",
+    responses={200: {"content": {"text/event-stream": {}}}},
+    response_class=StreamingResponse,
+)
+async def get_events(
+    token: str | None = None,
+    last_event_id: Annotated[int | None, Header()] = None,
+):
+    public = token is None or not validate_token(token)
+
+    async def stream():
+        with events.subscribe(last_event_id) as subscription:
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        subscription.get(), config.event_keepalive
+                    )
+                except TimeoutError:
+                    # keeps proxies from closing the idle connection
+                    yield b": keepalive\n\n"
+                    continue
+                if public and event.type not in PUBLIC_EVENTS:
+                    continue
+                yield event.encode()
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        # nginx would hold the events back until its buffer is full
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 """Retrieves a list of URLs for carousel images.
 
     Args:
@@ -594,40 +1681,150 @@ def get_animal_types():
 async def get_carousel_list(request: Request):
     # Returns a list of URLs to fetch carousel images.
     carousel_items = job_queue.get_carousel()
+    # other workers may have moved the carousel on
+    bundles.retain(carousel_version(*pair) for pair in carousel_items)
     return JSONResponse(
         content=[
-            str(request.url_for("get_carousel_image", index=i))
-            for i in range(len(carousel_items))
+            versioned_url(
+                request, "get_carousel_image", carousel_version(*pair), index=i
+            )
+            for i, pair in enumerate(carousel_items)
         ]
     )
 
 
-"""Retrieves a zip file containing X-ray and original images for a specific carousel index.
+"""Pages through every item that was in the carousel, newest first.
 
     Args:
-        index (int): The index of the carousel item to retrieve.
+        request (Request): The FastAPI request object to construct URLs.
+        offset (int, optional): How many of the newest items to skip.
+        limit (int, optional): The most items to list.
+
+    Raises:
+        HTTPException: If no history is kept, see ``CAROUSEL_ARCHIVE_DIR``.
 
     Returns:
-        StreamingResponse: A streaming response containing a zip file with the images, or a 404 status if the index is invalid.
+        JSONResponse: The number of items in the history and the URLs of the zip files
+        of the items in the page, with the time they entered the carousel.
 """
 
 
-@router.get("/carousel/{index}")
-async def get_carousel_image(index: int):
-    carousel = job_queue.get_carousel()
-    if index < 0 or index >= len(carousel):
+@router.get("/carousel/history", response_class=JSONResponse)
+async def get_carousel_history(
+    request: Request,
+    offset: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+):
+    archive = job_queue.archive
+    if archive is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="The carousel history is not kept",
+        )
+    total, entries = await to_thread.run_sync(
+        lambda: (len(archive), archive.entries(offset, limit))
+    )
+    return JSONResponse(
+        content={
+            "total": total,
+            "items": [
+                {
+                    "url": versioned_url(
+                        request,
+                        "get_carousel_history_item",
+                        carousel_version(xray, original),
+                        number=number,
+                    ),
+                    "added": added,
+                }
+                for number, xray, original, added in entries
+            ],
+        }
+    )
+
+
+"""Retrieves the zip file of an item of the carousel history.
+
+    Args:
+        number (int): The number of the item, 0 for the oldest.
+        request (Request): The request, answered with 304 if it has the images already.
+        v (str | None, optional): The version of the item from ``/carousel/history``.
+
+    Returns:
+        Response: A zip file with the images, like ``/carousel/{index}``, or a 404 status
+        if there is no such item.
+"""
+
+
+@router.api_route("/carousel/history/{number}", methods=["GET", "HEAD"])
+async def get_carousel_history_item(
+    number: int,
+    request: Request,
+    v: Annotated[str | None, Query()] = None,
+):
+    archive = job_queue.archive
+    entry = None if archive is None else await to_thread.run_sync(archive.entry, number)
+    if entry is None:
         return Response(status_code=404)
+    _, xray, original, _ = entry
+    version = carousel_version(xray, original)
+    etag = f'"{version}"'
+    cache = cache_headers(etag, v, version)
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache)
+    # items still in the carousel are built already
+    data = bundles.get(version, None)
+    if data is None:
+        data = await to_thread.run_sync(
+            lambda: bundle(archive.read(xray), archive.read(original))
+        )
+    headers = {
+        "Content-Disposition": f"attachment; filename=carousel_history_{number}.zip",
+        **cache,
+    }
+    return content_response(request, data, "application/zip", headers)
+
+
+"""Retrieves a zip file containing X-ray and original images for a specific carousel index.
+
+    Args:
+        index (int): The index of the carousel item to retrieve.
+        request (Request): The request, answered with 304 if it has the images already.
+        size (int | None, optional): The longest edge of thumbnails to put in the zip file
+            instead of the images, one of the configured thumbnail sizes.
+        v (str | None, optional): The version of the item from ``/carousel``, with the
+            current version the zip file is cached for good.
 
-    xray_file, original_file = carousel[index]
-    await xray_file.seek(0)
-    await original_file.seek(0)
+    Returns:
+        Response: A zip file with the images, built once per carousel item, or a 404 status if the index is invalid.
+"""
 
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w") as zip_file:
-        zip_file.writestr("xray.png", await xray_file.read())
-        zip_file.writestr("original.png", await original_file.read())
-    zip_buffer.seek(0)
 
-    headers = {"Content-Disposition": f"attachment; filename=carousel_{index}.zip"}
+@router.api_route("/carousel/{index}", methods=["GET", "HEAD"])
+async def get_carousel_image(
+    index: int,
+    request: Request,
+    size: Annotated[int | None, Query()] = None,
+    v: Annotated[str | None, Query()] = None,
+):
+    item = job_queue.carousel_item(index)
+    if item is None:
+        return Response(status_code=404)
 
-    return StreamingResponse(zip_buffer, media_type="application/zip", headers=headers)
+    xray, original = item
+    # the item at an index changes as the carousel moves on, its version does not
+    version = carousel_version(xray, original)
+    etag = f'"{version}"' if size is None else f'"{version}-{size}"'
+    cache = cache_headers(etag, v, version)
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache)
+    headers = {
+        "Content-Disposition": f"attachment; filename=carousel_{index}.zip",
+        **cache,
+    }
+    return content_response(
+        request,
+        await carousel_bundle(xray, original, size),
+        "application/zip",
+        headers,
+    )
@@ -0,0 +1,436 @@
+import hashlib
+import io
+import mmap
+import os
+import pathlib
+import re
+import secrets
+import shutil
+import tempfile
+from typing import AsyncIterable, BinaryIO, Protocol
+
+from anyio import to_thread
+
+from .memory import MB, MemoryAccountant
+
+# hashing smaller blobs is cheaper than the hop to a worker thread
+HASH_IN_THREAD = 1 * MB
+# the size of the pieces uploads are streamed in
+CHUNK_SIZE = 256 * 1024
+
+_BLOB_NAME = re.compile(r"[0-9a-f]{64}")
+
+"""Raised when streamed content exceeds the size limit, before it is read any further."""
+
+
+class BlobTooLarge(ValueError):
+    pass
+
+
+class AsyncReadable(Protocol):
+    async def read(self, size: int = -1) -> bytes: ...
+
+
+"""Reads a file in chunks, e.g. an UploadFile, without loading it as a whole.
+
+    Args:
+        file (AsyncReadable): The file to read.
+        size (int): The size of the chunks.
+
+    Yields:
+        bytes: The content of the file, piece by piece.
+"""
+
+
+async def read_chunks(file: AsyncReadable, size: int = CHUNK_SIZE):
+    while chunk := await file.read(size):
+        yield chunk
+
+
+"""Streams content into a buffer or, once it grows beyond a threshold, into a file.
+
+    The content is hashed and counted on the way in, so it is copied only once.
+
+    Args:
+        chunks (AsyncIterable[bytes]): The content, piece by piece.
+        directory (pathlib.Path): Where to put the file for large content.
+        limit (int | None): The largest size accepted, unlimited if None.
+        spill_threshold (float): Content larger than this goes to a file.
+
+    Returns:
+        tuple[str, int, bytearray | None, pathlib.Path | None]: The SHA-256 hex digest,
+        the size and either the buffer or the temporary file holding the content.
+
+    Raises:
+        BlobTooLarge: As soon as the content exceeds the limit, the file is removed.
+"""
+
+
+async def ingest(
+    chunks: AsyncIterable[bytes],
+    directory: pathlib.Path,
+    limit: int | None,
+    spill_threshold: float,
+) -> tuple[str, int, bytearray | None, pathlib.Path | None]:
+    digest = hashlib.sha256()
+    size = 0
+    buffer: bytearray | None = bytearray()
+    tmp = directory / f"{os.getpid()}.{secrets.token_hex(4)}.tmp"
+    file: BinaryIO | None = None
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if limit is not None and size > limit:
+                raise BlobTooLarge(f"Content exceeds {limit} bytes")
+            if len(chunk) >= HASH_IN_THREAD:
+                await to_thread.run_sync(digest.update, chunk)
+            else:
+                digest.update(chunk)
+            if file is not None:
+                await to_thread.run_sync(file.write, chunk)
+            elif size > spill_threshold:
+                buffer += chunk
+                file = await to_thread.run_sync(open, tmp, "wb")
+                await to_thread.run_sync(file.write, buffer)
+                buffer = None
+            else:
+                buffer += chunk
+    except BaseException:
+        if file is not None:
+            file.close()
+            tmp.unlink(missing_ok=True)
+        raise
+    if file is None:
+        return digest.hexdigest(), size, buffer, None
+    await to_thread.run_sync(file.close)
+    return digest.hexdigest(), size, None, tmp
+
+
+"""An image held by the BlobStore, either in memory or mapped from a file.
+
+    Attributes:
+        id (str): The SHA-256 hex digest of the content.
+        size (int): The size of the content in bytes.
+        refs (int): The number of references held on the blob.
+"""
+
+
+class Blob:
+    def __init__(self, store: "BlobStore", id: str, size: int):
+        self.id = id
+        self.size = size
+        self.refs = 1
+        self._store = store
+        self._data: bytes | bytearray | None = None
+        self._mmap: mmap.mmap | None = None
+
+    def view(self) -> memoryview:
+        if self._mmap is not None:
+            return memoryview(self._mmap)
+        assert self._data is not None
+        return memoryview(self._data).toreadonly()
+
+    """Moves the content to a file and maps it instead of keeping it in memory."""
+
+    async def rollover(self) -> None:
+        data = self._data
+        if data is None or self.refs <= 0:
+            return
+        mapped = await to_thread.run_sync(self._store._spill, self.id, data)
+        if self._data is not data or self.refs <= 0:
+            # released or spilled by somebody else while writing
+            mapped.close()
+            if self.refs <= 0 and self.id not in self._store:
+                self._store._unlink(self.id)
+            return
+        self._mmap = mapped
+        self._data = None
+        self._store.memory.resize_spilled(self, self.size)
+
+    def _discard(self) -> None:
+        self._data = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # a response still serves from the mapping, it goes away with the view
+                pass
+            self._mmap = None
+            self._store._unlink(self.id)
+
+
+"""Content-addressed store for the images handled by the JobQueue.
+
+    Every image is stored once per SHA-256 digest, no matter how often it is put, and
+    referred to by that digest. Each :meth:`put` and :meth:`incref` takes a reference
+    that has to be given back with :meth:`release`; the blob is dropped with its last
+    reference.
+
+    Blobs are kept in memory within the budget of ``memory``. Blobs larger than its
+    spill threshold, and the least recently used ones once the budget is exceeded, are
+    written to ``directory`` and memory-mapped, so :meth:`view` serves them straight
+    from the page cache.
+
+    Attributes:
+        directory (pathlib.Path): The directory spilled blobs are written to.
+        memory (MemoryAccountant): Keeps the blobs held in memory within the budget.
+"""
+
+
+class BlobStore:
+    def __init__(
+        self,
+        directory: str | os.PathLike | None = None,
+        memory: MemoryAccountant | None = None,
+    ):
+        self._temporary = directory is None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="blobs-")
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # blobs do not outlive the process, the journal keeps its own copies
+        for path in self.directory.glob("*/*"):
+            if _BLOB_NAME.fullmatch(path.name):
+                path.unlink()
+        for path in self.directory.glob("*.tmp"):
+            path.unlink()
+        self.memory = memory if memory is not None else MemoryAccountant()
+        self._blobs: dict[str, Blob] = {}
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._blobs
+
+    def __len__(self) -> int:
+        return len(self._blobs)
+
+    def _path(self, id: str) -> pathlib.Path:
+        return self.directory / id[:2] / id
+
+    def _spill(self, id: str, data: bytes | bytearray) -> mmap.mmap:
+        tmp = self._path(id).with_name(f"{id}.{os.getpid()}.tmp")
+        tmp.parent.mkdir(exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        return self._move(id, tmp)
+
+    def _move(self, id: str, tmp: pathlib.Path) -> mmap.mmap:
+        path = self._path(id)
+        path.parent.mkdir(exist_ok=True)
+        os.replace(tmp, path)
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _unlink(self, id: str) -> None:
+        self._path(id).unlink(missing_ok=True)
+
+    def _get(self, id: str) -> Blob:
+        blob = self._blobs.get(id)
+        if blob is None:
+            raise KeyError(f"Unknown blob {id}")
+        return blob
+
+    """Stores an image and takes a reference on it.
+
+        Args:
+            data (bytes): The content of the image.
+
+        Returns:
+            str: The id of the blob, the SHA-256 hex digest of the content.
+    """
+
+    async def put(self, data: bytes) -> str:
+        if len(data) >= HASH_IN_THREAD:
+            id = await to_thread.run_sync(lambda: hashlib.sha256(data).hexdigest())
+        else:
+            id = hashlib.sha256(data).hexdigest()
+        return await self._add(id, data)
+
+    """Stores an image read piece by piece and takes a reference on it.
+
+        Content up to the spill threshold is collected in memory, larger content is
+        written straight to a file, so it is never held in memory as a whole.
+
+        Args:
+            chunks (AsyncIterable[bytes]): The content of the image, e.g. from :func:`read_chunks`.
+            limit (int | None): The largest size accepted, unlimited if None.
+
+        Returns:
+            str: The id of the blob, the SHA-256 hex digest of the content.
+
+        Raises:
+            BlobTooLarge: If the content exceeds the limit, nothing is stored.
+    """
+
+    async def put_stream(
+        self, chunks: AsyncIterable[bytes], limit: int | None = None
+    ) -> str:
+        id, size, data, tmp = await ingest(
+            chunks, self.directory, limit, self.memory.spill_threshold
+        )
+        if tmp is None:
+            return await self._add(id, data)
+        if id in self._blobs:
+            tmp.unlink()
+            return self.incref(id)
+        mapped = await to_thread.run_sync(self._move, id, tmp)
+        if id in self._blobs:
+            mapped.close()
+            return self.incref(id)
+        blob = Blob(self, id, size)
+        self._blobs[id] = blob
+        blob._mmap = mapped
+        self.memory.resize_spilled(blob, blob.size)
+        return id
+
+    async def _add(self, id: str, data: bytes | bytearray) -> str:
+        if id in self._blobs:
+            return self.incref(id)
+        mapped = None
+        # empty files cannot be mapped, they do not cost anything anyway
+        if data and len(data) > self.memory.spill_threshold:
+            mapped = await to_thread.run_sync(self._spill, id, data)
+            if id in self._blobs:
+                # stored by somebody else in the meantime, the file has the same content
+                mapped.close()
+                return self.incref(id)
+        blob = Blob(self, id, len(data))
+        self._blobs[id] = blob
+        if mapped is not None:
+            blob._mmap = mapped
+            self.memory.resize_spilled(blob, blob.size)
+        else:
+            blob._data = data
+            self.memory.resize(blob, blob.size)
+            await self.memory.enforce()
+        return id
+
+    """Takes another reference on a blob.
+
+        Args:
+            id (str): The id of the blob.
+
+        Returns:
+            str: The id of the blob, for chaining.
+
+        Raises:
+            KeyError: If the blob does not exist.
+    """
+
+    def incref(self, id: str) -> str:
+        self._get(id).refs += 1
+        return id
+
+    """Gives back a reference on a blob and drops the blob with its last reference.
+
+        Args:
+            id (str): The id of the blob.
+
+        Raises:
+            KeyError: If the blob does not exist.
+    """
+
+    def release(self, id: str) -> None:
+        blob = self._get(id)
+        blob.refs -= 1
+        if blob.refs > 0:
+            return
+        del self._blobs[id]
+        self.memory.forget(blob)
+        blob._discard()
+
+    """Gives read access to a blob without copying it.
+
+        The view stays valid after the blob is released.
+
+        Args:
+            id (str): The id of the blob.
+
+        Returns:
+            memoryview: The content of the blob.
+
+        Raises:
+            KeyError: If the blob does not exist.
+    """
+
+    def view(self, id: str) -> memoryview:
+        blob = self._get(id)
+        self.memory.touch(blob)
+        return blob.view()
+
+    """Returns a copy of the content of a blob.
+
+        Args:
+            id (str): The id of the blob.
+
+        Returns:
+            bytes: The content of the blob.
+
+        Raises:
+            KeyError: If the blob does not exist.
+    """
+
+    def read(self, id: str) -> bytes:
+        return bytes(self.view(id))
+
+    """Opens a blob as a file, e.g. to hand it to a storage backend.
+
+        Args:
+            id (str): The id of the blob.
+
+        Returns:
+            BinaryIO: A file positioned at the start, to be closed by the caller.
+
+        Raises:
+            KeyError: If the blob does not exist.
+    """
+
+    def open(self, id: str) -> BinaryIO:
+        blob = self._get(id)
+        self.memory.touch(blob)
+        if blob._data is not None:
+            # BytesIO shares bytes until it is written to, streamed content is copied
+            return io.BytesIO(blob._data)
+        return open(self._path(id), "rb")
+
+    """Returns the file of a blob, so it can be sent without reading it into Python.
+
+        Args:
+            id (str): The id of the blob.
+
+        Returns:
+            pathlib.Path | None: The file, or None while the blob is held in memory.
+
+        Raises:
+            KeyError: If the blob does not exist.
+    """
+
+    def path(self, id: str) -> pathlib.Path | None:
+        blob = self._get(id)
+        self.memory.touch(blob)
+        if blob._mmap is None:
+            return None
+        return self._path(id)
+
+    """Reports the number and size of the stored blobs and their memory usage.
+
+        Returns:
+            dict[str, int]: The number of blobs, their total size and the number of
+            references, along with the stats of the MemoryAccountant.
+    """
+
+    def stats(self) -> dict[str, int]:
+        return self.memory.stats() | {
+            "blobs": len(self._blobs),
+            "bytes": sum(blob.size for blob in self._blobs.values()),
+            "refs": sum(blob.refs for blob in self._blobs.values()),
+        }
+
+    """Drops all blobs and removes the directory if it was created by the store."""
+
+    def close(self) -> None:
+        for blob in self._blobs.values():
+            self.memory.forget(blob)
+            blob._discard()
+        self._blobs.clear()
+        if self._temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
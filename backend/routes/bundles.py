@@ -0,0 +1,100 @@
+import io
+import zipfile
+from collections import OrderedDict
+from typing import Iterable
+
+from .memory import MB
+
+"""Packs the images of a carousel item into a zip file.
+
+    The images are stored as they are: PNGs and the thumbnail codecs are compressed
+    already, so deflating them again only costs time.
+
+    Args:
+        xray (bytes | memoryview): The X-ray image.
+        original (bytes | memoryview): The original image.
+
+    Returns:
+        bytes: The zip file with ``xray.png`` and ``original.png``.
+"""
+
+
+def bundle(xray: bytes | memoryview, original: bytes | memoryview) -> bytes:
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_STORED) as zip_file:
+        # the names stay the same for thumbnails, clients look the images up by them
+        zip_file.writestr("xray.png", xray)
+        zip_file.writestr("original.png", original)
+    return out.getvalue()
+
+
+"""Zip files of the carousel items, built once and served to every display.
+
+    Bundles are keyed by the version of the carousel item and the size of the
+    thumbnails in it, None for the images themselves. The version changes with the
+    images, so a bundle never goes stale; bundles of items that left the carousel
+    are dropped by :meth:`retain`, and the least recently used ones once the bundles
+    take up more than ``budget`` bytes.
+
+    Args:
+        budget (int): The most bytes of bundles kept.
+"""
+
+
+class BundleCache:
+    def __init__(self, budget: int = 32 * MB):
+        self.budget = budget
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[tuple[str, int | None], bytes] = OrderedDict()
+
+    """Returns a bundle if it was built already.
+
+        Args:
+            version (str): The version of the carousel item.
+            size (int | None): The size of the thumbnails in the bundle.
+
+        Returns:
+            bytes | None: The bundle, or None if it has to be built.
+    """
+
+    def get(self, version: str, size: int | None) -> bytes | None:
+        key = (version, size)
+        data = self._cache.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._cache.move_to_end(key)
+        return data
+
+    def put(self, version: str, size: int | None, data: bytes) -> None:
+        old = self._cache.pop((version, size), None)
+        if old is not None:
+            self.bytes -= len(old)
+        self._cache[(version, size)] = data
+        self.bytes += len(data)
+        while self.bytes > self.budget and self._cache:
+            _, old = self._cache.popitem(last=False)
+            self.bytes -= len(old)
+
+    """Drops the bundles of all items but the given ones, e.g. when the carousel moved on.
+
+        Args:
+            versions (Iterable[str]): The versions of the items in the carousel.
+    """
+
+    def retain(self, versions: Iterable[str]) -> None:
+        keep = set(versions)
+        for key in [key for key in self._cache if key[0] not in keep]:
+            self.bytes -= len(self._cache.pop(key))
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "bundles": len(self._cache),
+            "bundle_bytes": self.bytes,
+            "bundle_budget": self.budget,
+            "bundle_hits": self.hits,
+            "bundle_misses": self.misses,
+        }
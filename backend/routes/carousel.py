@@ -0,0 +1,192 @@
+import os
+import pathlib
+import struct
+import time
+from typing import Iterator
+
+# an archived carousel item: the SHA-256 digests of the X-ray and the original and
+# when it entered the carousel; fixed width, so item n is read with a single seek
+RECORD = struct.Struct("<32s32sd")
+
+# the ids of the X-ray and the original image of an item
+Item = tuple[str, str]
+
+"""The items of the carousel, newest first, in a fixed number of slots.
+
+    Adding an item overwrites the slot of the oldest one once all slots are taken,
+    so adding, indexing and the length cost the same however large the carousel is.
+
+    Args:
+        capacity (int): The most items held.
+"""
+
+
+class CarouselRing:
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("The carousel needs at least one slot")
+        self.capacity = capacity
+        self._slots: list[Item | None] = [None] * capacity
+        # the slot of the newest item
+        self._head = -1
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, index: int) -> Item:
+        if not 0 <= index < self._len:
+            raise IndexError("carousel index out of range")
+        return self._slots[(self._head - index) % self.capacity]
+
+    def __iter__(self) -> Iterator[Item]:
+        for index in range(self._len):
+            yield self[index]
+
+    """Adds an item in front of the others.
+
+        Args:
+            item (Item): The new item.
+
+        Returns:
+            Item | None: The oldest item, if it had to make room.
+    """
+
+    def push(self, item: Item) -> Item | None:
+        self._head = (self._head + 1) % self.capacity
+        evicted = self._slots[self._head] if self._len == self.capacity else None
+        self._slots[self._head] = item
+        self._len = min(self._len + 1, self.capacity)
+        return evicted
+
+
+"""Every item that was ever shown in the carousel, kept on disk.
+
+    Items are appended as they enter the carousel and stay after they left it, so the
+    newest ones restore the carousel after a restart and the older ones can be paged
+    through. The images are stored once per content hash in ``images/`` and the items
+    as fixed-width records in ``index``, numbered from 0 for the oldest; reading an
+    item or a page costs a single seek however long the history is.
+
+    Appends write a single record with ``O_APPEND``, so several processes can share
+    an archive.
+
+    Attributes:
+        directory (pathlib.Path): The directory holding the index and the images.
+"""
+
+
+class CarouselArchive:
+    INDEX = "index"
+    IMAGES = "images"
+
+    def __init__(self, directory: str | os.PathLike):
+        self.directory = pathlib.Path(directory)
+        (self.directory / self.IMAGES).mkdir(parents=True, exist_ok=True)
+        self._index = self.directory / self.INDEX
+        self._index.touch()
+        # a record torn by a crash in the middle of a write
+        size = self._index.stat().st_size
+        if size % RECORD.size:
+            os.truncate(self._index, size - size % RECORD.size)
+
+    def __len__(self) -> int:
+        return self._index.stat().st_size // RECORD.size
+
+    def path(self, digest: str) -> pathlib.Path:
+        return self.directory / self.IMAGES / digest[:2] / digest
+
+    def _write_image(self, digest: str, data: bytes | memoryview) -> None:
+        path = self.path(digest)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    """Archives an item that entered the carousel. Blocks on the disk.
+
+        Args:
+            xray (str): The SHA-256 hex digest of the X-ray image.
+            original (str): The SHA-256 hex digest of the original image.
+            xray_data (bytes | memoryview): The X-ray image.
+            original_data (bytes | memoryview): The original image.
+            added (float | None): When the item entered the carousel, now if None.
+    """
+
+    def append(
+        self,
+        xray: str,
+        original: str,
+        xray_data: bytes | memoryview,
+        original_data: bytes | memoryview,
+        added: float | None = None,
+    ) -> None:
+        # the images are on disk before the record that points to them
+        self._write_image(xray, xray_data)
+        self._write_image(original, original_data)
+        record = RECORD.pack(
+            bytes.fromhex(xray),
+            bytes.fromhex(original),
+            time.time() if added is None else added,
+        )
+        fd = os.open(self._index, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, record)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    """Reads a page of the history, newest first. Blocks on the disk.
+
+        Args:
+            offset (int): How many of the newest items to skip.
+            limit (int): The most items to read.
+
+        Returns:
+            list[tuple[int, str, str, float]]: The number, X-ray digest, original
+            digest and time of each item.
+    """
+
+    def entries(self, offset: int, limit: int) -> list[tuple[int, str, str, float]]:
+        with open(self._index, "rb") as f:
+            count = os.fstat(f.fileno()).st_size // RECORD.size
+            stop = count - offset
+            start = max(stop - limit, 0)
+            if stop <= start:
+                return []
+            f.seek(start * RECORD.size)
+            data = f.read((stop - start) * RECORD.size)
+        entries = [
+            (start + i, xray.hex(), original.hex(), added)
+            for i, (xray, original, added) in enumerate(RECORD.iter_unpack(data))
+        ]
+        return entries[::-1]
+
+    """Reads a single item. Blocks on the disk.
+
+        Args:
+            number (int): The number of the item, 0 for the oldest.
+
+        Returns:
+            tuple[int, str, str, float] | None: The item as in :meth:`entries`, or None
+            if there is no such item.
+    """
+
+    def entry(self, number: int) -> tuple[int, str, str, float] | None:
+        if number < 0:
+            return None
+        with open(self._index, "rb") as f:
+            f.seek(number * RECORD.size)
+            data = f.read(RECORD.size)
+        if len(data) < RECORD.size:
+            return None
+        xray, original, added = RECORD.unpack(data)
+        return number, xray.hex(), original.hex(), added
+
+    def read(self, digest: str) -> bytes:
+        return self.path(digest).read_bytes()
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import time
+from collections import deque
+
+from anyio import from_thread
+
+"""Something that happened, as sent to the clients of the event stream.
+
+    Attributes:
+        id (int): Grows with every event, clients resume after it with ``Last-Event-ID``.
+        type (str): What happened, e.g. "job" or "carousel".
+        data (dict): The details, kept small; clients fetch the rest if they need it.
+"""
+
+
+class Event:
+    def __init__(self, id: int, type: str, data: dict):
+        self.id = id
+        self.type = type
+        self.data = data
+
+    """Formats the event as a Server-Sent Events message."""
+
+    def encode(self) -> bytes:
+        data = json.dumps(self.data, separators=(",", ":"))
+        return f"id: {self.id}\nevent: {self.type}\ndata: {data}\n\n".encode()
+
+
+"""The events a single client has not received yet.
+
+    A client that does not keep up loses its backlog once ``size`` events are
+    waiting and gets a single "reset" event instead, telling it to fetch the
+    current state again.
+
+    Args:
+        bus (EventBus): The bus the subscription belongs to.
+        size (int): The most events waiting for the client.
+"""
+
+
+class Subscription:
+    def __init__(self, bus: "EventBus", size: int):
+        self.size = size
+        self._bus = bus
+        self._events: deque[Event] = deque()
+        self._wakeup = asyncio.Event()
+
+    def __enter__(self) -> "Subscription":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._bus._subscribers.discard(self)
+
+    def _deliver(self, event: Event) -> None:
+        if len(self._events) >= self.size:
+            self._events.clear()
+            event = self._bus._reset()
+        self._events.append(event)
+        self._wakeup.set()
+
+    """Waits for the next event.
+
+        Returns:
+            Event: The oldest event the client has not received.
+    """
+
+    async def get(self) -> Event:
+        while not self._events:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        return self._events.popleft()
+
+
+"""Hands what happens in the backend to every connected client, see ``/events``.
+
+    Events are numbered and the most recent ``history`` of them are kept, so a client
+    that reconnects gets the events it missed. Clients that were gone for longer, or
+    connect to a restarted backend, get a "reset" event instead. Numbers start at the
+    clock, so a restarted backend never reuses one.
+
+    The bus lives in the process, with several worker processes a client only sees
+    the events of the process it is connected to.
+
+    Args:
+        history (int): How many events are kept for reconnecting clients.
+        buffer (int): How many events may wait for a single client.
+"""
+
+
+class EventBus:
+    def __init__(self, history: int = 256, buffer: int = 64):
+        self.buffer = buffer
+        self.last_id = time.time_ns() // 1000
+        self._history: deque[Event] = deque(maxlen=history)
+        self._subscribers: set[Subscription] = set()
+
+    def _reset(self) -> Event:
+        # not kept in the history, it is addressed to a single client
+        return Event(self.last_id, "reset", {})
+
+    """Sends an event to all clients.
+
+        Args:
+            type (str): What happened.
+            data (dict): The details, encoded as JSON.
+
+        Returns:
+            Event: The event.
+    """
+
+    def publish(self, type: str, data: dict) -> Event:
+        self.last_id += 1
+        event = Event(self.last_id, type, data)
+        self._history.append(event)
+        for subscription in self._subscribers:
+            subscription._deliver(event)
+        return event
+
+    """Sends an event from a worker thread, e.g. of a background task.
+
+        Args:
+            type (str): What happened.
+            data (dict): The details, encoded as JSON.
+    """
+
+    def publish_from_thread(self, type: str, data: dict) -> None:
+        try:
+            from_thread.run_sync(self.publish, type, data)
+        except RuntimeError:
+            # not a worker thread of the event loop, e.g. the loop itself
+            self.publish(type, data)
+
+    """Connects a client.
+
+        Args:
+            last_id (int | None): The id of the last event the client received before
+                it reconnected, or None for a new client.
+
+        Returns:
+            Subscription: The events for the client, to be used as context manager.
+    """
+
+    def subscribe(self, last_id: int | None = None) -> Subscription:
+        subscription = Subscription(self, self.buffer)
+        if last_id is not None and last_id != self.last_id:
+            oldest = self._history[0].id if self._history else self.last_id + 1
+            if oldest - 1 <= last_id < self.last_id:
+                for event in self._history:
+                    if event.id > last_id:
+                        subscription._deliver(event)
+            else:
+                # the events the client missed are gone
+                subscription._deliver(self._reset())
+        self._subscribers.add(subscription)
+        return subscription
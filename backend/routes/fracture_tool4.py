@@ -1,3 +1,5 @@
+import functools
+import hashlib
 import tempfile
 from io import BytesIO
 from typing import Annotated
@@ -8,7 +10,21 @@ from fastapi import APIRouter, File, Form, HTTPException, Response, UploadFile,
 from fastapi.responses import FileResponse
 from PIL import Image
 
+from ..config import config
+from .memory import MB
+from .overlays import OverlayLibrary
+from .previews import PreviewCache
+
 router = APIRouter()
+overlays = OverlayLibrary(
+    budget=config.overlay_cache_mb * MB, scale_step=config.overlay_scale_step
+)
+previews = PreviewCache(
+    max_edge=config.preview_max_edge,
+    budget=config.preview_cache_mb * MB,
+    format=config.preview_format,
+    quality=config.preview_quality,
+)
 
 
 # ------------------- Helper functions
@@ -20,56 +36,115 @@ def add_gaussian_noise(image: np.ndarray, mean: float = 0, std: float = 10):
     return noisy.astype(np.uint8)
 
 
+# Grey Threshold for samples (only sampling, if lower than Threshold)
+GRAY_THRESH = 120
+# the directions the first sample is searched in, on every ring around the center
+RING_ANGLES = 64
+# rings searched at once; a dark pixel is usually found on one of the first rings
+RING_BLOCK = 16
+
+# per direction, as the scalar np.cos/np.sin give them, so the offsets match the
+# pixel by pixel search exactly
+_COS = np.array([np.cos(a) for a in np.linspace(0, 2 * np.pi, RING_ANGLES)])
+_SIN = np.array([np.sin(a) for a in np.linspace(0, 2 * np.pi, RING_ANGLES)])
+
+"""The pixel offsets of the rings around a center, nearest ring first.
+
+    Args:
+        max_radius (int): The rings have radii 1 to ``max_radius - 1``.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The x and y offsets, ``RING_ANGLES`` per ring
+        and row, read only.
+"""
+
+
+@functools.lru_cache(maxsize=64)
+def ring_offsets(max_radius: int) -> tuple[np.ndarray, np.ndarray]:
+    radii = np.arange(1, max(max_radius, 1), dtype=np.float64)[:, None]
+    # np.rint rounds halves to even like round() does
+    dx = np.rint(radii * _COS).astype(np.intp)
+    dy = np.rint(radii * _SIN).astype(np.intp)
+    dx.flags.writeable = dy.flags.writeable = False
+    return dx, dy
+
+
+def _gray(img: np.ndarray, sy: np.ndarray, sx: np.ndarray) -> np.ndarray:
+    # the mean over the channels, as np.mean(img[sy, sx]) gives it per pixel
+    pixels = img[sy, sx]
+    return pixels.mean(axis=-1) if pixels.ndim > sy.ndim else pixels
+
+
+"""Finds the colors of the bone next to an overlay, to paint the fracture with.
+
+    The first sample is the nearest dark pixel on rings around the center of the
+    overlay, the second the nearest dark pixel under the overlay in the opposite
+    direction. The rings are marched a block at a time with the offsets from
+    :func:`ring_offsets` and only the sampled pixels are converted to gray.
+
+    Args:
+        img (np.ndarray): The image.
+        mask (np.ndarray): The alpha channel of the overlay.
+        x (int): The left edge of the overlay in the image.
+        y (int): The top edge of the overlay in the image.
+
+    Returns:
+        tuple: The colors of both samples and the direction from the first to the second.
+"""
+
+
 def sample_color_gradient(img: np.ndarray, mask: np.ndarray, x: int, y: int):
-    # Grey Threshold for samples (only sampling, if lower than Threshold)
-    gray_thresh = 120
     x = x % img.shape[1]
     y = y % img.shape[0]
     h, w = mask.shape
     center_x = x + w // 2
     center_y = y + h // 2
     max_radius = max(h, w) // 2
-    alpha_mask = mask / 255.0
 
     sample1 = sample2 = None
     dir_vector = np.array([0, 0])
 
     # Searching first Sample:
-    for r in range(1, max_radius):
-        for angle in np.linspace(0, 2 * np.pi, 64):
-            dx = int(round(r * np.cos(angle)))
-            dy = int(round(r * np.sin(angle)))
-            sx = center_x + dx
-            sy = center_y + dy
-
-            if 0 <= sx < img.shape[1] and 0 <= sy < img.shape[0]:
-                if np.mean(img[sy, sx]) < gray_thresh:
-                    sample1 = (sx, sy)
-                    dir_vector = np.array([dx, dy])
-                    break
-        if sample1 is not None:
+    ring_dx, ring_dy = ring_offsets(max_radius)
+    for first in range(0, len(ring_dx), RING_BLOCK):
+        sx = center_x + ring_dx[first : first + RING_BLOCK]
+        sy = center_y + ring_dy[first : first + RING_BLOCK]
+        inside = (0 <= sx) & (sx < img.shape[1]) & (0 <= sy) & (sy < img.shape[0])
+        dark = np.zeros(sx.shape, dtype=bool)
+        dark[inside] = _gray(img, sy[inside], sx[inside]) < GRAY_THRESH
+        # rows are rings and columns directions, in the order they were searched
+        hit = np.argmax(dark)
+        if dark.flat[hit]:
+            sample1 = (int(sx.flat[hit]), int(sy.flat[hit]))
+            dir_vector = np.array([sample1[0] - center_x, sample1[1] - center_y])
             break
 
     if sample1 is None:
         return img[50, 50].astype(np.float32), img[1, 1].astype(np.float32), (1, 0)
 
     # Search Second Sample
-    for r in range(1, max_radius):
-        dx, dy = -dir_vector * r
-        sx = center_x + int(round(dx))
-        sy = center_y + int(round(dy))
-
-        mask_y = sy - y
-        mask_x = sx - x
-        if (
-            0 <= sx < img.shape[1]
-            and 0 <= sy < img.shape[0]
-            and 0 <= mask_x < alpha_mask.shape[1]
-            and 0 <= mask_y < alpha_mask.shape[0]
-        ):
-            if alpha_mask[mask_y, mask_x] > 0 and np.mean(img[sy, sx]) < gray_thresh:
-                sample2 = (sx, sy)
-                break
+    radii = np.arange(1, max_radius)
+    sx = center_x - dir_vector[0] * radii
+    sy = center_y - dir_vector[1] * radii
+    mask_x = sx - x
+    mask_y = sy - y
+    inside = (
+        (0 <= sx)
+        & (sx < img.shape[1])
+        & (0 <= sy)
+        & (sy < img.shape[0])
+        & (0 <= mask_x)
+        & (mask_x < w)
+        & (0 <= mask_y)
+        & (mask_y < h)
+    )
+    candidates = np.flatnonzero(inside)
+    candidates = candidates[mask[mask_y[candidates], mask_x[candidates]] > 0]
+    if len(candidates):
+        dark = _gray(img, sy[candidates], sx[candidates]) < GRAY_THRESH
+        if dark.any():
+            hit = candidates[np.argmax(dark)]
+            sample2 = (int(sx[hit]), int(sy[hit]))
 
     if sample2 is None:
         return (
@@ -85,6 +160,58 @@ def sample_color_gradient(img: np.ndarray, mask: np.ndarray, x: int, y: int):
     return color1, color2, gradient_direction
 
 
+# Grey values of the bone the overlay is painted on
+LOWER_TRESH_MASK = 90
+UPPER_TRESH_MASK = 255
+# rows of the ROI composited at once, so the temporaries stay a few hundred KB
+BAND_ROWS = 64
+# the noise painted over the fractures; Generators lock, threads can share it
+NOISE_RNG = np.random.default_rng()
+
+"""The coordinates of the pixels of an overlay, relative to its center.
+
+    Args:
+        h (int): The height of the overlay.
+        w (int): The width of the overlay.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The x coordinates of a row and the y
+        coordinates of a column, read only; they broadcast to the grid.
+"""
+
+
+@functools.lru_cache(maxsize=64)
+def overlay_coordinates(h: int, w: int) -> tuple[np.ndarray, np.ndarray]:
+    xs = np.arange(w, dtype=np.float64) - w // 2
+    ys = np.arange(h, dtype=np.float64) - h // 2
+    xs.flags.writeable = ys.flags.writeable = False
+    return xs, ys
+
+
+"""Paints the overlay onto the bone under it, with a color gradient and noise.
+
+    The ROI is composited in bands of ``BAND_ROWS`` rows, into buffers allocated once
+    per call: the gradient in float64 as before, so its colors truncate the same way,
+    and the blend in fixed point uint16 with the alpha of the overlay on the 3x3
+    dilated bone mask as weight out of 255. The channels are broadcast and only the
+    uint8 masks are allocated at the size of the ROI. The noise is drawn in float32
+    from :data:`NOISE_RNG`, which is several times faster than ``np.random.normal``.
+
+    Args:
+        img (np.ndarray): The image, painted in place.
+        x (int): The left edge of the overlay in the image.
+        y (int): The top edge of the overlay in the image.
+        overlay (np.ndarray): The overlay, with an alpha channel.
+        gradient_dir (np.ndarray): The direction of the gradient.
+        color1 (np.ndarray): The color at the start of the gradient.
+        color2 (np.ndarray): The color at the end of the gradient.
+        noise_std (int): The standard deviation of the gaussian noise, 0 for none.
+
+    Returns:
+        np.ndarray: The image.
+"""
+
+
 def apply_gradient_to_mask(
     img: np.ndarray,
     x: int,
@@ -95,14 +222,8 @@ def apply_gradient_to_mask(
     color2: np.ndarray,
     noise_std: int,
 ):
-    UPPER_TRESH_MASK = np.array(255)
-    LOWER_TRESH_MASK = np.array(90)
-    x = x % img.shape[1]  # Corrections in case of wrong coordinates: Image width
-    y = y % img.shape[0]  # Image height
-    print(x)
-    print(y)
-    x = int(x)
-    y = int(y)
+    x = int(x % img.shape[1])  # Corrections in case of wrong coordinates: Image width
+    y = int(y % img.shape[0])  # Image height
     h, w = overlay.shape[:2]
 
     # Fallback for zero_gradient
@@ -120,65 +241,254 @@ def apply_gradient_to_mask(
     if overlay.shape[0] == 0 or overlay.shape[1] == 0:
         return img  # overlay not valid
 
-    alpha = overlay[:, :, 3] / 255.0
-    mask = np.repeat(alpha[..., np.newaxis], 3, axis=2)
-
+    alpha = overlay[:, :, 3]
     gray_roi = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
-    bone_mask = cv2.inRange(gray_roi, LOWER_TRESH_MASK, UPPER_TRESH_MASK) / 255.0
-
+    bone_mask = cv2.inRange(gray_roi, LOWER_TRESH_MASK, UPPER_TRESH_MASK)
     # make Mask bigger
     kernel = np.ones((3, 3), np.uint8)
-    bone_mask_expanded = (
-        cv2.dilate((bone_mask * 255).astype(np.uint8), kernel, iterations=1) / 255.0
-    )
-    bone_mask_3ch = np.repeat(bone_mask_expanded[..., np.newaxis], 3, axis=2)
+    bone_mask = cv2.dilate(bone_mask, kernel, iterations=1)
+    # the mask is 0 or 255, so this is the alpha on the bone and 0 elsewhere
+    weight = np.bitwise_and(alpha, bone_mask, out=bone_mask)
 
-    combined_mask = mask * bone_mask_3ch
-
-    # calculate Gradient direction
+    # calculate Gradient direction, the projections are xs * dx + ys * dy
     grad_norm = gradient_dir / (np.linalg.norm(gradient_dir) + 1e-6)
-    Y, X = np.meshgrid(
-        np.arange(overlay.shape[0]), np.arange(overlay.shape[1]), indexing="ij"
-    )
-    rel_coords = np.stack(
-        (X - overlay.shape[1] // 2, Y - overlay.shape[0] // 2), axis=-1
-    )
-    projections = rel_coords @ grad_norm
+    xs, ys = overlay_coordinates(*overlay.shape[:2])
+    xs = xs * grad_norm[0]
+    ys = ys * grad_norm[1]
+
+    rows, cols = weight.shape
+    band = min(BAND_ROWS, rows)
+    proj = np.empty((band, cols), np.float64)
 
     # Fallback for empty alpha_mask
-    mask_nonzero = alpha > 0
-    if np.any(mask_nonzero):
-        min_proj = np.min(projections[mask_nonzero])
-        max_proj = np.max(projections[mask_nonzero])
-    else:
+    min_proj, max_proj = np.inf, -np.inf
+    for top in range(0, rows, band):
+        n = min(band, rows - top)
+        np.add(ys[top : top + n, None], xs, out=proj[:n])
+        visible = alpha[top : top + n] > 0
+        min_proj = np.min(proj[:n], where=visible, initial=min_proj)
+        max_proj = np.max(proj[:n], where=visible, initial=max_proj)
+    if min_proj > max_proj:
         min_proj, max_proj = 0.0, 1.0
+    span = max_proj - min_proj + 1e-6
+
+    color1 = np.asarray(color1, np.float64)
+    color2 = np.asarray(color2, np.float64)
+    gradient = np.empty((band, cols, 3), np.float64)
+    lerp = np.empty((band, cols, 3), np.float64)
+    noisy = np.empty((band, cols, 3), np.int16)
+    # flat, the generator fills contiguous arrays only
+    noise = np.empty(band * cols * 3, np.float32)
+    blend = np.empty((band, cols, 3), np.uint16)
+    under = np.empty((band, cols, 3), np.uint16)
+    for top in range(0, rows, band):
+        n = min(band, rows - top)
+        # only the columns the overlay paints on, a crack is often a thin line
+        painted = np.flatnonzero(weight[top : top + n].any(axis=0))
+        if not len(painted):
+            continue
+        left, right = painted[0], painted[-1] + 1
+        shape = (n, right - left)
+        t = proj[:n, : shape[1]]
+        np.add(ys[top : top + n, None], xs[left:right], out=t)
+        t -= min_proj
+        t /= span
+        np.clip(t, 0, 1, out=t)
+
+        # Add gradient
+        lerp_band = lerp[:n, : shape[1]]
+        gradient_band = gradient[:n, : shape[1]]
+        np.subtract(1, t[..., None], out=lerp_band)
+        np.multiply(lerp_band, color1, out=gradient_band)
+        np.multiply(t[..., None], color2, out=lerp_band)
+        gradient_band += lerp_band
+        # truncated like astype(np.uint8)
+        noisy_band = noisy[:n, : shape[1]]
+        np.copyto(noisy_band, gradient_band, casting="unsafe")
+        if noise_std:
+            noise_band = noise[: n * shape[1] * 3].reshape(*shape, 3)
+            NOISE_RNG.standard_normal(dtype=np.float32, out=noise_band)
+            noise_band *= noise_std
+            # truncated like astype(np.int16)
+            np.trunc(noise_band, out=noise_band)
+            np.add(noisy_band, noise_band, out=noisy_band, casting="unsafe")
+            np.clip(noisy_band, 0, 255, out=noisy_band)
+
+        # (roi * (255 - weight) + noisy * weight) // 255, at most 255 * 255
+        roi_band = roi[top : top + n, left:right]
+        weight_band = weight[top : top + n, left:right, None]
+        blend_band = blend[:n, : shape[1]]
+        under_band = under[:n, : shape[1]]
+        np.multiply(
+            noisy_band, weight_band, out=blend_band, dtype=np.uint16, casting="unsafe"
+        )
+        np.subtract(255, weight_band, out=under_band, casting="unsafe")
+        np.multiply(under_band, roi_band, out=under_band)
+        blend_band += under_band
+        blend_band //= 255
+        np.copyto(roi_band, blend_band, casting="unsafe")
+    return img
 
-    norm_proj = (projections - min_proj) / (max_proj - min_proj + 1e-6)
-    norm_proj = np.clip(norm_proj, 0, 1)
 
-    # Add gradient
-    gradient = (1 - norm_proj[..., None]) * color1 + norm_proj[..., None] * color2
-    gradient_noisy = add_gaussian_noise(gradient.astype(np.uint8), std=noise_std)
+"""Tells why an overlay cannot be placed, :func:`place_fracture` skips those.
 
-    blended = (1 - combined_mask) * roi + combined_mask * gradient_noisy
+    Args:
+        img (np.ndarray): The image.
+        overlay (np.ndarray): The overlay at its scale.
+        x (int): The left edge of the overlay in the image.
+        y (int): The top edge of the overlay in the image.
 
-    img[start_y:end_y, start_x:end_x] = blended.astype(np.uint8)
-    return img
+    Returns:
+        str | None: The reason, or None if the overlay can be placed.
+"""
 
 
-def apply_fracture(
-    img: np.ndarray, overlay: np.ndarray, x: int, y: int, scale: float, noise_std: int
+def placement_error(img: np.ndarray, overlay: np.ndarray, x: int, y: int) -> str | None:
+    if overlay.ndim != 3 or overlay.shape[2] != 4:
+        return "The overlay needs an alpha channel"
+    h, w = overlay.shape[:2]
+    if y + h > img.shape[0] or x + w > img.shape[1]:
+        return "The overlay does not fit into the image"
+    return None
+
+
+"""Places an overlay that is scaled already, see :func:`apply_fracture`."""
+
+
+def place_fracture(
+    img: np.ndarray, overlay: np.ndarray, x: int, y: int, noise_std: int
 ):
-    overlay_resized = cv2.resize(overlay, (0, 0), fx=scale, fy=scale)
-    h, w = overlay_resized.shape[:2]
+    h, w = overlay.shape[:2]
     if y + h > img.shape[0] or x + w > img.shape[1]:
         return img
 
-    alpha = overlay_resized[:, :, 3]
+    alpha = overlay[:, :, 3]
     color1, color2, grad_dir = sample_color_gradient(img, alpha, x, y)
     return apply_gradient_to_mask(
-        img, x, y, overlay_resized, grad_dir, color1, color2, noise_std
+        img, x, y, overlay, grad_dir, color1, color2, noise_std
+    )
+
+
+def apply_fracture(
+    img: np.ndarray, overlay: np.ndarray, x: int, y: int, scale: float, noise_std: int
+):
+    overlay_resized = cv2.resize(overlay, (0, 0), fx=scale, fy=scale)
+    return place_fracture(img, overlay_resized, x, y, noise_std)
+
+
+"""Returns the overlay of a fracture request at its scale.
+
+    Registered overlays come from :data:`overlays`, decoded and resized once;
+    uploaded ones are decoded and resized for the request.
+
+    Args:
+        overlay_id (str | None): The id of a registered overlay.
+        overlay_data (bytes | None): An uploaded overlay.
+        scale (float): The scale to place the overlay at.
+
+    Returns:
+        np.ndarray: The overlay.
+
+    Raises:
+        HTTPException: If neither or both are given, the id is unknown or the upload
+            is not an image.
+"""
+
+
+def scaled_overlay(
+    overlay_id: str | None, overlay_data: bytes | None, scale: float
+) -> np.ndarray:
+    if (overlay_id is None) == (overlay_data is None):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Send either overlay_id or overlay_file",
+        )
+    if overlay_id is not None:
+        try:
+            return overlays.get(overlay_id, scale)
+        except KeyError:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Overlay not registered"
+            )
+    overlay = cv2.imdecode(np.frombuffer(overlay_data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if overlay is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid image or overlay file",
+        )
+    return cv2.resize(overlay, (0, 0), fx=scale, fy=scale)
+
+
+"""Paints a fracture on the scaled-down copy of an image, see :class:`PreviewCache`.
+
+    The placement is given in pixels of the image and scaled with the copy, so the
+    same placement can be applied at full resolution afterwards. Overlays that do
+    not fit are left out like at full resolution.
+
+    Args:
+        id (str): The SHA-256 hex digest of the image.
+        image (bytes | memoryview): The encoded image.
+        overlay_id (str | None): The id of a registered overlay.
+        overlay_data (bytes | None): An uploaded overlay.
+        x (int): The left edge of the overlay in the image.
+        y (int): The top edge of the overlay in the image.
+        scale (float): The scale of the overlay on the image.
+        noise_std (int): The standard deviation of the noise.
+
+    Returns:
+        bytes: The preview, encoded with ``previews.format``.
+
+    Raises:
+        HTTPException: If the image cannot be read or the overlay is missing, unknown
+            or not an image.
+"""
+
+
+def preview_fracture(
+    id: str,
+    image: bytes | memoryview,
+    overlay_id: str | None,
+    overlay_data: bytes | None,
+    x: int,
+    y: int,
+    scale: float,
+    noise_std: int,
+) -> bytes:
+    try:
+        preview = previews.get(id, image)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    overlay = scaled_overlay(overlay_id, overlay_data, scale * preview.fx)
+    img = preview.pixels.copy()
+    x, y = round(x * preview.fx), round(y * preview.fy)
+    if placement_error(img, overlay, x, y) is None:
+        place_fracture(img, overlay, x, y, noise_std)
+    return previews.encode(img)
+
+
+@router.post("/preview_fracture")
+def fracture_preview(
+    x: Annotated[int, Form()],
+    y: Annotated[int, Form()],
+    scale: Annotated[float, Form()],
+    noise: Annotated[int, Form()],
+    image_file: Annotated[UploadFile, File()],
+    overlay_file: Annotated[UploadFile | None, File()] = None,
+    overlay_id: Annotated[str | None, Form()] = None,
+):
+    image = image_file.file.read()
+    overlay_data = overlay_file.file.read() if overlay_file is not None else None
+    content = preview_fracture(
+        hashlib.sha256(image).hexdigest(),
+        image,
+        overlay_id,
+        overlay_data,
+        x,
+        y,
+        scale,
+        noise,
     )
+    return Response(content=content, media_type=previews.media_type)
 
 
 @router.post("/apply_fracture")
@@ -188,21 +498,21 @@ def fracture(
     scale: Annotated[float, Form()],
     noise: Annotated[int, Form()],
     image_file: Annotated[UploadFile, File()],
-    overlay_file: Annotated[UploadFile, File()],
+    overlay_file: Annotated[UploadFile | None, File()] = None,
+    overlay_id: Annotated[str | None, Form()] = None,
 ):
 
     image_np = cv2.imdecode(
         np.frombuffer(image_file.file.read(), np.uint8), cv2.IMREAD_COLOR
     )
-    overlay_np = cv2.imdecode(
-        np.frombuffer(overlay_file.file.read(), np.uint8), cv2.IMREAD_UNCHANGED
-    )
-    if image_np is None or overlay_np is None:
+    if image_np is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid image or overlay file",
         )
-    result_img = apply_fracture(image_np.copy(), overlay_np, x, y, scale, noise)
+    overlay_data = overlay_file.file.read() if overlay_file is not None else None
+    overlay_np = scaled_overlay(overlay_id, overlay_data, scale)
+    result_img = place_fracture(image_np, overlay_np, x, y, noise)
 
     _, encoded_img = cv2.imencode(".png", result_img)
     with tempfile.NamedTemporaryFile(
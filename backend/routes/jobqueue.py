@@ -1,18 +1,35 @@
+import asyncio
+import bisect
+import heapq
+import secrets
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
 from enum import Enum, StrEnum, auto
+from operator import itemgetter
 from typing import Tuple
 
-from anyio import SpooledTemporaryFile
+from anyio import to_thread
 from fastapi import UploadFile
 
 from ..storage import Storage
+from .blobstore import BlobStore
+from .carousel import CarouselArchive, CarouselRing
+from .journal import Journal
+from .scheduler import JobDeque, Scheduler
+from .uploads import Upload, UploadPipeline, UploadState, UploadStatus
 
-ImageInMemoryStorageT = SpooledTemporaryFile[bytes]
+# the id of an image in the BlobStore
+BlobId = str
+
+# how many jobs the change log remembers, clients further behind reload everything
+CHANGE_LOG_SIZE = 1000
 
 """Represents a job that includes an image file and associated metadata.
 
     Attributes:
         c_id (int): A class variable to keep track of the job IDs.
-        file (ImageInMemoryStorageT): The image file associated with the job.
+        blob (BlobId): The image associated with the job, the job holds a reference on it.
         owner_ref (int | str): A reference for the owner, either an ID or an upload link.
         first_name (str): The first name of the owner.
         last_name (str): The last name of the owner.
@@ -21,6 +38,11 @@ ImageInMemoryStorageT = SpooledTemporaryFile[bytes]
         broken_bone (bool): Indicates if the animal has a broken bone. Defaults to False.
         id (int): The unique ID of the job.
         number_of_results (int): The number of results expected for this job.
+        retries (int): How often the results of the job were rejected and retried.
+        archive (BlobId | None): The image as uploaded, if it was normalized and the upload
+            is kept for the storage. The job holds a reference on it.
+        added (float): The ``time.time()`` the job was added or last retried, jobs awaiting
+            approval are listed in this order. Defaults to now.
 """
 
 
@@ -30,7 +52,7 @@ class Job:
 
     def __init__(
         self,
-        file: ImageInMemoryStorageT,
+        blob: BlobId,
         owner_ref: int | str,
         first_name: str,
         last_name: str,
@@ -38,8 +60,11 @@ class Job:
         animal_type: str = "other",
         broken_bone: bool = False,
         number_of_results: int = 1,
+        archive: BlobId | None = None,
+        added: float | None = None,
     ):
-        self.file = file
+        self.blob = blob
+        self.archive = archive
         self.owner_ref = owner_ref  # either id or upload link
         self.first_name = first_name
         self.last_name = last_name
@@ -48,10 +73,82 @@ class Job:
         self.broken_bone = broken_bone
         self.id = Job.c_id
         self.number_of_results = number_of_results
+        self.retries = 0
+        self.added = added if added is not None else time.time()
         Job.c_id += 1
 
 
-Result = list[SpooledTemporaryFile[bytes]]
+Result = list[BlobId]
+
+# a position in the listing of the jobs awaiting approval, when the job was added and its id
+Cursor = Tuple[float, int]
+
+"""Selects jobs awaiting approval, see :meth:`JobQueueBackend.pending_page`.
+
+    Attributes:
+        animal_type (str | None): Only jobs of this animal type.
+        complete (bool | None): Only jobs with all their results, or only jobs still
+            missing some.
+        added_after (float | None): Only jobs added at or after this ``time.time()``.
+        added_before (float | None): Only jobs added at or before this ``time.time()``.
+"""
+
+
+class PendingFilter:
+    def __init__(
+        self,
+        animal_type: str | None = None,
+        complete: bool | None = None,
+        added_after: float | None = None,
+        added_before: float | None = None,
+    ):
+        self.animal_type = animal_type
+        self.complete = complete
+        self.added_after = added_after
+        self.added_before = added_before
+
+    """Checks a single job against the filter.
+
+        Args:
+            job (Job): The job.
+            results (Result): The results of the job.
+            results_per_image (int): The number of results a complete job has.
+
+        Returns:
+            bool: Whether the job is selected.
+    """
+
+    def matches(self, job: Job, results: Result, results_per_image: int) -> bool:
+        if self.animal_type is not None and job.animal_type != self.animal_type:
+            return False
+        if (
+            self.complete is not None
+            and (len(results) >= results_per_image) != self.complete
+        ):
+            return False
+        if self.added_after is not None and job.added < self.added_after:
+            return False
+        if self.added_before is not None and job.added > self.added_before:
+            return False
+        return True
+
+
+"""A single dispatch of a job to a worker that is expected to return a result.
+
+    Attributes:
+        job (Job): The dispatched job.
+        deadline (float): The time by which the result has to arrive, ``time.monotonic()``
+            for the in-memory queue and ``time.time()`` for queues shared between processes.
+        token (str): A random token identifying the lease.
+"""
+
+
+class Lease:
+    def __init__(self, job: Job, deadline: float):
+        self.job = job
+        self.deadline = deadline
+        self.token = secrets.token_urlsafe(16)
+
 
 """Enumeration for job confirmation statuses."""
 
@@ -62,30 +159,263 @@ class ConfirmJobEnum(StrEnum):
     cancel = auto()
 
 
-"""Manages a queue of jobs and their associated results.
+"""Base class for the backends that hold the jobs, their results and the carousel.
+
+    The API only talks to a backend through these methods, so the in-memory
+    :class:`JobQueue` can be replaced by one that several processes share.
 
     Attributes:
-        queue (list[Job]): A list of jobs currently in the queue.
+        blobs: The store the images of jobs, results and the carousel are kept in.
+        uploads (UploadPipeline): Uploads the images of confirmed jobs to the storage.
+        archive (CarouselArchive | None): Keeps every item that entered the carousel.
+        lease_timeout (float): Seconds a worker has to deliver a result before the job is dispatched again.
+"""
+
+
+class JobQueueBackend(ABC):
+    """Queues a job, taking over the reference it holds on its image."""
+
+    @abstractmethod
+    def add_job(self, job: Job) -> None:
+        pass
+
+    """Leases the next job or returns None if the queue is empty."""
+
+    @abstractmethod
+    def lease_job(self) -> None | Lease:
+        pass
+
+    """Leases up to n jobs, a job that needs several results can appear more than once."""
+
+    def lease_jobs(self, n: int) -> list[Lease]:
+        leases: list[Lease] = []
+        while len(leases) < n and (lease := self.lease_job()) is not None:
+            leases.append(lease)
+        return leases
+
+    """Waits up to timeout seconds for a job and leases it."""
+
+    @abstractmethod
+    async def wait_for_job(self, timeout: float) -> None | Lease:
+        pass
+
+    """Dispatches the jobs of expired leases again and returns their number."""
+
+    @abstractmethod
+    def expire_leases(self, now: float | None = None) -> int:
+        pass
+
+    """Expires leases until cancelled."""
+
+    @abstractmethod
+    async def reap_leases(self, interval: float = 1.0) -> None:
+        pass
+
+    """Adds a result to a job, raises ValueError for an unknown job or lease."""
+
+    @abstractmethod
+    async def submit_job(
+        self, id: int, result: bytes, lease_token: str | None = None
+    ) -> None:
+        pass
+
+    """Replaces a result of a job, raises ValueError for an unknown job or choice."""
+
+    @abstractmethod
+    async def replace_result(self, id: int, choice: int, result: bytes) -> None:
+        pass
+
+    """Confirms, retries or cancels a job, raises ValueError for an unknown job."""
+
+    @abstractmethod
+    async def confirm_job(
+        self, id: int, confirm: ConfirmJobEnum, choice: int, image: UploadFile | None
+    ) -> None:
+        pass
+
+    """Returns the number of jobs waiting to be dispatched."""
+
+    @abstractmethod
+    def queued(self) -> int:
+        pass
+
+    """Returns a job awaiting approval and its results, or None."""
+
+    @abstractmethod
+    def get_pending(self, id: int) -> None | Tuple[Job, Result]:
+        pass
+
+    """Returns every job awaiting approval with its results, oldest first."""
+
+    @abstractmethod
+    def pending(self) -> list[Tuple[Job, Result]]:
+        pass
+
+    """Returns up to limit jobs awaiting approval that match the filter.
+
+        They are listed in the order of :meth:`pending` starting behind the cursor
+        after, with the cursor to continue from, None if there are no more jobs.
+    """
+
+    @abstractmethod
+    def pending_page(
+        self, filter: PendingFilter, after: None | Cursor, limit: int
+    ) -> Tuple[list[Tuple[Job, Result]], None | Cursor]:
+        pass
+
+    """Returns the current version of the jobs awaiting approval and the changed ids.
+
+        The ids are of the jobs added, changed or removed after version since, least
+        recently changed first, or None if the change log does not reach back to since.
+    """
+
+    @abstractmethod
+    def changes(self, since: int) -> Tuple[int, None | list[int]]:
+        pass
+
+    """Returns the X-ray and original images in the carousel, newest first."""
+
+    @abstractmethod
+    def get_carousel(self) -> list[Tuple[BlobId, BlobId]]:
+        pass
+
+    """Returns the X-ray and original image of the index-th newest carousel item.
+
+        None if there is no such item. Takes constant time.
+    """
+
+    @abstractmethod
+    def carousel_item(self, index: int) -> None | Tuple[BlobId, BlobId]:
+        pass
+
+    """Returns the state of the uploads of a confirmed job, or None."""
+
+    def upload_status(self, id: int) -> None | dict:
+        state = self.uploads.status(id)
+        return state.as_dict() if state is not None else None
+
+    """Returns the state of the uploads of the recently confirmed jobs, oldest first."""
+
+    def upload_statuses(self) -> list[dict]:
+        return [state.as_dict() for state in self.uploads.statuses()]
+
+    """Queues the failed uploads of a confirmed job again, returns whether they failed."""
+
+    def retry_upload(self, id: int) -> bool:
+        return self.uploads.retry(id) is not None
+
+    def _upload_files(self, job: Job, xray: BlobId) -> list[Upload]:
+        return [
+            Upload("normal", job.archive or job.blob, f"{job.id}_original.png"),
+            Upload("xray", xray, f"{job.id}_result.png"),
+        ]
+
+    def _upload(self, job: Job, xray: BlobId) -> None:
+        # the pipeline takes its own references, so the images can leave the carousel
+        self.uploads.submit(
+            job.id, job.owner_ref, self.blobs, self._upload_files(job, xray)
+        )
+        if job.archive is not None:
+            # only the storage needs the image as uploaded
+            self.blobs.release(job.archive)
+            job.archive = None
+
+    async def _archive(self, xray: BlobId, original: BlobId) -> None:
+        if self.archive is None:
+            return
+        # the carousel may move on while the images are written
+        self.blobs.incref(xray)
+        self.blobs.incref(original)
+        try:
+            await to_thread.run_sync(
+                self.archive.append,
+                xray,
+                original,
+                self.blobs.view(xray),
+                self.blobs.view(original),
+            )
+        finally:
+            self.blobs.release(xray)
+            self.blobs.release(original)
+
+    """Restores the state left by a previous run."""
+
+    async def recover(self) -> None:
+        pass
+
+    """Releases the resources of the backend."""
+
+    def close(self) -> None:
+        pass
+
+
+"""Manages a queue of jobs and their associated results in the memory of a single process.
+
+    Attributes:
+        queue (Scheduler): The jobs currently waiting to be dispatched, in the order of the scheduling policy.
         awaiting_approval (dict[int, Tuple[Job, Result]]): A dictionary mapping job IDs to jobs and their results.
-        carrousel (list[Tuple[SpooledTemporaryFile, SpooledTemporaryFile]]): A list of images for the carousel.
+        carrousel (CarouselRing): The X-ray and original images in the carousel, newest first.
         carrousel_size (int): The maximum number of images allowed in the carousel.
         results_per_image (int): The number of results expected for each image.
         storage (Storage): The storage system used to upload files.
+        lease_timeout (float): Seconds a worker has to deliver a result before the job is dispatched again.
+        leases (dict[str, Lease]): The outstanding leases by token.
+        journal (Journal | None): Records every state transition so the queue survives a restart.
+        blobs (BlobStore): Holds the images, the queue holds one reference per job, result and carousel entry.
+        uploads (UploadPipeline): Uploads confirmed images in the background, created from storage if omitted.
+        version (int): Grows with every change of the jobs awaiting approval.
+        archive (CarouselArchive | None): Keeps every item that entered the carousel, the
+            carousel is restored from it if there is no journal.
 """
 
 
-class JobQueue:
-    def __init__(self, results_per_image: int, carrousel_size: int, storage: Storage):
-        # Queue holding spooled temporary files because the memory might get full and
-        # it supports async operations
-        self.queue: list[Job] = []
+class JobQueue(JobQueueBackend):
+    def __init__(
+        self,
+        results_per_image: int,
+        carrousel_size: int,
+        storage: Storage,
+        lease_timeout: float = 300.0,
+        journal: Journal | None = None,
+        scheduler: Scheduler | None = None,
+        blobs: BlobStore | None = None,
+        uploads: UploadPipeline | None = None,
+        archive: CarouselArchive | None = None,
+    ):
+        self.queue = scheduler if scheduler is not None else JobDeque()
         # first is the original and the following are results from the AI
         self.awaiting_approval: dict[int, Tuple[Job, Result]] = {}
         # queue manages the carrousel
-        self.carrousel: list[Tuple[SpooledTemporaryFile, SpooledTemporaryFile]] = []
+        self.carrousel = CarouselRing(carrousel_size)
         self.carrousel_size = carrousel_size
         self.results_per_image = results_per_image
         self.storage = storage
+        # workers long-polling for a job, oldest first
+        self._waiters: deque[asyncio.Future[Lease]] = deque()
+        # dispatched jobs whose results have not arrived yet
+        self.lease_timeout = lease_timeout
+        self.leases: dict[str, Lease] = {}
+        self._job_leases: dict[int, dict[str, Lease]] = {}
+        # min-heap of (deadline, token), entries of resolved leases are skipped lazily
+        self._lease_deadlines: list[tuple[float, str]] = []
+        self.journal = journal
+        self.blobs = blobs if blobs is not None else BlobStore()
+        self.uploads = uploads if uploads is not None else UploadPipeline(storage)
+        if journal is not None:
+            self.uploads.on_change = self._journal_upload
+        self.archive = archive
+        # starts at the clock, so a restarted queue never reuses a version
+        self.version = time.time_ns() // 1000
+        # the version of the last change of each job, least recently changed first
+        self._changes: OrderedDict[int, int] = OrderedDict()
+        # changes up to this version are forgotten
+        self._changes_floor = self.version
+        # secondary indexes of the jobs awaiting approval, each sorted by cursor
+        self._listing: list[Cursor] = []
+        self._by_type: dict[str, list[Cursor]] = {}
+        self._by_complete: dict[bool, list[Cursor]] = {True: [], False: []}
+        # the cursor and completeness each job is indexed under
+        self._indexed: dict[int, tuple[Cursor, bool]] = {}
 
     """Retrieves the next job from the queue.
 
@@ -94,41 +424,356 @@ class JobQueue:
     """
 
     def get_job(self) -> None | Job:
-        if len(self.queue) == 0:
+        job = self.queue.peek()
+        if job is None:
             return None
-        job = self.queue[-1]
         job.number_of_results -= 1
         if job.number_of_results <= 0:
-            self.queue.pop()
+            self.queue.popleft()
         return job
 
+    """Leases the next job from the queue.
+
+        The lease has to be resolved by submitting a result before its deadline,
+        otherwise the dispatch is handed out again by :meth:`expire_leases`.
+
+        Returns:
+            Lease | None: The lease on the next job or None if the queue is empty.
+    """
+
+    def lease_job(self) -> None | Lease:
+        job = self.get_job()
+        if job is None:
+            return None
+        lease = Lease(job, time.monotonic() + self.lease_timeout)
+        self.leases[lease.token] = lease
+        self._job_leases.setdefault(job.id, {})[lease.token] = lease
+        heapq.heappush(self._lease_deadlines, (lease.deadline, lease.token))
+        return lease
+
+    """Waits until a job is available and leases it.
+
+        Waiting workers are served in the order they arrived and every job
+        dispatch goes to exactly one of them, so new work never wakes more
+        workers than it can keep busy.
+
+        Args:
+            timeout (float): The maximum number of seconds to wait.
+
+        Returns:
+            Lease | None: The lease on the next job or None if the timeout ran out.
+    """
+
+    async def wait_for_job(self, timeout: float) -> None | Lease:
+        lease = self.lease_job()
+        if lease is not None or timeout <= 0:
+            return lease
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except TimeoutError:
+            # the job might have been handed over right as the timeout hit
+            if waiter.done() and not waiter.cancelled():
+                return waiter.result()
+            return None
+        except asyncio.CancelledError:
+            # the worker went away, give its job to somebody else
+            if waiter.done() and not waiter.cancelled():
+                self._revoke_lease(waiter.result())
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    """Hands queued jobs to waiting workers, one dispatch per worker."""
+
+    def _wake_waiters(self) -> None:
+        while self._waiters and len(self.queue) > 0:
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            lease = self.lease_job()
+            assert lease is not None
+            waiter.set_result(lease)
+
+    """Removes a lease from the bookkeeping.
+
+        Its entry in the deadline heap is left behind and skipped once it comes up.
+
+        Args:
+            lease (Lease): The lease to remove.
+    """
+
+    def _release_lease(self, lease: Lease) -> None:
+        self.leases.pop(lease.token, None)
+        job_leases = self._job_leases.get(lease.job.id, {})
+        job_leases.pop(lease.token, None)
+        if not job_leases:
+            self._job_leases.pop(lease.job.id, None)
+
+    """Takes back a dispatch and puts its job at the head of the queue.
+
+        Args:
+            lease (Lease): The lease of the dispatch that will not deliver a result.
+    """
+
+    def _revoke_lease(self, lease: Lease) -> None:
+        if lease.token not in self.leases:
+            return
+        self._release_lease(lease)
+        job = lease.job
+        if job.id not in self.awaiting_approval:
+            return
+        job.number_of_results += 1
+        if job not in self.queue:
+            self.queue.appendleft(job)
+        self._wake_waiters()
+
+    """Revokes every lease whose deadline has passed.
+
+        Args:
+            now (float | None): The current ``time.monotonic()``, for testing.
+
+        Returns:
+            int: The number of revoked leases.
+    """
+
+    def expire_leases(self, now: float | None = None) -> int:
+        if now is None:
+            now = time.monotonic()
+        expired = 0
+        while self._lease_deadlines and self._lease_deadlines[0][0] <= now:
+            _, token = heapq.heappop(self._lease_deadlines)
+            lease = self.leases.get(token)
+            if lease is not None:
+                self._revoke_lease(lease)
+                expired += 1
+        return expired
+
+    """Background task that revokes expired leases until it is cancelled.
+
+        Args:
+            interval (float): The maximum number of seconds between checks.
+    """
+
+    async def reap_leases(self, interval: float = 1.0) -> None:
+        while True:
+            self.expire_leases()
+            delay = interval
+            if self._lease_deadlines:
+                delay = min(interval, self._lease_deadlines[0][0] - time.monotonic())
+            await asyncio.sleep(max(delay, 0))
+
+    def _touch(self, id: int) -> None:
+        self.version += 1
+        self._changes[id] = self.version
+        self._changes.move_to_end(id)
+        while len(self._changes) > CHANGE_LOG_SIZE:
+            _, self._changes_floor = self._changes.popitem(last=False)
+
+    def _index(self, id: int) -> None:
+        self._unindex(id)
+        job, results = self.awaiting_approval[id]
+        cursor = job.added, id
+        complete = len(results) >= self.results_per_image
+        for index in (
+            self._listing,
+            self._by_type.setdefault(job.animal_type, []),
+            self._by_complete[complete],
+        ):
+            # jobs are mostly added in order, so this appends
+            bisect.insort(index, cursor)
+        self._indexed[id] = cursor, complete
+
+    def _unindex(self, id: int) -> None:
+        if id not in self._indexed:
+            return
+        cursor, complete = self._indexed.pop(id)
+        animal_type = self.awaiting_approval[id][0].animal_type
+        for index in (
+            self._listing,
+            self._by_type[animal_type],
+            self._by_complete[complete],
+        ):
+            del index[bisect.bisect_left(index, cursor)]
+        if not self._by_type[animal_type]:
+            del self._by_type[animal_type]
+
+    """Lists the jobs awaiting approval that match a filter, a page at a time.
+
+        The smallest index the filter selects from is walked from the cursor on, the
+        other conditions are checked for the jobs in it only.
+
+        Args:
+            filter (PendingFilter): The jobs to list.
+            after (None | Cursor): The cursor returned with the previous page, None for
+                the first page.
+            limit (int): The most jobs in the page.
+
+        Returns:
+            Tuple[list[Tuple[Job, Result]], None | Cursor]: The jobs with their results
+            and the cursor of the next page, or None if this is the last one.
+    """
+
+    def pending_page(
+        self, filter: PendingFilter, after: None | Cursor, limit: int
+    ) -> Tuple[list[Tuple[Job, Result]], None | Cursor]:
+        candidates = [self._listing]
+        if filter.animal_type is not None:
+            candidates.append(self._by_type.get(filter.animal_type, []))
+        if filter.complete is not None:
+            candidates.append(self._by_complete[filter.complete])
+        index = min(candidates, key=len)
+        start = 0 if after is None else bisect.bisect_right(index, after)
+        if filter.added_after is not None:
+            start = max(
+                start, bisect.bisect_left(index, filter.added_after, key=itemgetter(0))
+            )
+        stop = len(index)
+        if filter.added_before is not None:
+            stop = bisect.bisect_right(index, filter.added_before, key=itemgetter(0))
+        page: list[Tuple[Job, Result]] = []
+        for _, id in index[start:stop]:
+            entry = self.awaiting_approval[id]
+            if not filter.matches(*entry, self.results_per_image):
+                continue
+            if len(page) == limit:
+                last = page[-1][0]
+                return page, (last.added, last.id)
+            page.append(entry)
+        return page, None
+
+    """Lists the jobs awaiting approval that changed since a version.
+
+        Args:
+            since (int): A version returned earlier.
+
+        Returns:
+            Tuple[int, None | list[int]]: The current version and the ids of the jobs
+            added, changed or removed since, or None if they are not known anymore.
+    """
+
+    def changes(self, since: int) -> Tuple[int, None | list[int]]:
+        if since < self._changes_floor or since > self.version:
+            return self.version, None
+        ids = []
+        # walk back from the latest change, only the changed jobs are visited
+        for id in reversed(self._changes):
+            if self._changes[id] <= since:
+                break
+            ids.append(id)
+        return self.version, ids[::-1]
+
     """Adds a new job to the queue.
 
+        The queue takes over the reference the job holds on its image.
+
         Args:
             job (Job): The job to be added to the queue.
     """
 
     def add_job(self, job: Job) -> None:
-        self.queue.insert(0, job)
+        if self.journal is not None:
+            self.journal.record(
+                {
+                    "op": "add",
+                    "job": {
+                        "id": job.id,
+                        "owner_ref": job.owner_ref,
+                        "first_name": job.first_name,
+                        "last_name": job.last_name,
+                        "animal_name": job.animal_name,
+                        "animal_type": job.animal_type,
+                        "broken_bone": job.broken_bone,
+                        "number_of_results": job.number_of_results,
+                        "added": job.added,
+                    },
+                    "blob": job.blob,
+                },
+                self.blobs.view(job.blob),
+            )
+            if job.archive is not None:
+                self.journal.record(
+                    {"op": "archive", "id": job.id, "blob": job.archive},
+                    self.blobs.view(job.archive),
+                )
         self.awaiting_approval[job.id] = job, []
+        self._index(job.id)
+        self._touch(job.id)
+        self._enqueue(job)
+
+    def _enqueue(self, job: Job) -> None:
+        self.queue.append(job)
+        self._wake_waiters()
 
     """Submits the result for a specific job.
 
         Args:
             id (int): The ID of the job to which the result belongs.
             result (bytes): The result data to be submitted.
+            lease_token (str | None): The token of the lease the result fulfils.
+                Without a token the oldest lease on the job is resolved.
 
         Raises:
-            ValueError: If the job ID is invalid.
+            ValueError: If the job ID is invalid or the lease expired.
     """
 
-    async def submit_job(self, id: int, result: bytes) -> None:
-        stf = SpooledTemporaryFile[bytes]()
-        await stf.write(result)
+    async def submit_job(
+        self, id: int, result: bytes, lease_token: str | None = None
+    ) -> None:
         if id not in self.awaiting_approval:
             raise ValueError("Invalid id")
-        entry = self.awaiting_approval[id]
-        entry[1].append(stf)
+        if lease_token is not None:
+            lease = self.leases.get(lease_token)
+            if lease is None or lease.job.id != id:
+                raise ValueError("Invalid or expired lease")
+            self._release_lease(lease)
+        elif job_leases := self._job_leases.get(id):
+            self._release_lease(next(iter(job_leases.values())))
+        blob = await self.blobs.put(result)
+        if id not in self.awaiting_approval:
+            # confirmed or cancelled while storing the result
+            self.blobs.release(blob)
+            return
+        self.awaiting_approval[id][1].append(blob)
+        self._index(id)
+        self._touch(id)
+        if self.journal is not None:
+            self.journal.record({"op": "submit", "id": id, "blob": blob}, result)
+
+    """Replaces one of the results of a job, e.g. after editing it.
+
+        Args:
+            id (int): The ID of the job to which the result belongs.
+            choice (int): The index of the result to replace.
+            result (bytes): The new result data.
+
+        Raises:
+            ValueError: If the job ID or the choice is invalid.
+    """
+
+    async def replace_result(self, id: int, choice: int, result: bytes) -> None:
+        if id not in self.awaiting_approval:
+            raise ValueError("Invalid id")
+        results = self.awaiting_approval[id][1]
+        if choice < 0 or choice >= len(results):
+            raise ValueError("Invalid choice")
+        blob = await self.blobs.put(result)
+        if (
+            id not in self.awaiting_approval
+            or self.awaiting_approval[id][1] is not results
+        ):
+            # the results were dropped while storing the new one
+            self.blobs.release(blob)
+            raise ValueError("Invalid id")
+        self.blobs.release(results[choice])
+        results[choice] = blob
+        self._touch(id)
+        if self.journal is not None:
+            self.journal.record(
+                {"op": "replace", "id": id, "choice": choice, "blob": blob}, result
+            )
 
     """Confirms the status of a job based on user input.
 
@@ -141,13 +786,13 @@ class JobQueue:
             choice (int): The index of the result to upload if confirmed.
 
         Raises:
-            ValueError: If the job ID is invalid.
+            ValueError: If the job ID is invalid, or the choice when confirming.
 
         This method performs the following actions based on the confirmation status:
-            - If confirmed, it uploads the original image and the selected result image to storage,
-              and adds the result to the carousel.
-            - If retrying, it closes the result files and re-adds the job to the queue.
-            - If canceled, it closes all associated files and removes the job from the queue.
+            - If confirmed, it queues the original image and the selected result image for upload
+              to storage, and adds the result to the carousel. The uploads run in the background.
+            - If retrying, it drops the results and re-adds the job to the queue.
+            - If canceled, it drops all associated images and removes the job from the queue.
     """
 
     async def confirm_job(
@@ -155,58 +800,191 @@ class JobQueue:
     ) -> None:
         if id not in self.awaiting_approval:
             raise ValueError("Invalid id")
+        if confirm == ConfirmJobEnum.confirm and not 0 <= choice < len(
+            self.awaiting_approval[id][1]
+        ):
+            raise ValueError("Invalid choice")
+        self._unindex(id)
         job, results = self.awaiting_approval.pop(id)
-        if image is not None:
-            results[choice] = SpooledTemporaryFile[bytes]()
+        self._touch(id)
+        # results still in flight are not needed anymore
+        for lease in list(self._job_leases.get(id, {}).values()):
+            self._release_lease(lease)
+        override = None
+        if image is not None and confirm == ConfirmJobEnum.confirm:
             await image.seek(0)
-            await results[choice].write(await image.read())
-            await results[choice].seek(0)
+            override = await image.read()
+            self.blobs.release(results[choice])
+            results[choice] = await self.blobs.put(override)
+        if confirm == ConfirmJobEnum.retry:
+            # listed again behind the jobs awaiting approval now
+            job.added = time.time()
+        if self.journal is not None:
+            record = {"op": confirm.value, "id": id}
+            if confirm == ConfirmJobEnum.confirm:
+                record.update(choice=choice, carrousel_size=self.carrousel_size)
+                if override is not None:
+                    record.update(blob=results[choice])
+                # the uploads are carried on after a restart until they are done
+                files = self._upload_files(job, results[choice])
+                record.update(
+                    upload={
+                        "owner_ref": job.owner_ref,
+                        "files": [[f.type, f.blob, f.filename] for f in files],
+                    }
+                )
+            elif confirm == ConfirmJobEnum.retry:
+                record.update(number_of_results=self.results_per_image, added=job.added)
+            self.journal.record(record, override)
 
         # Remove the job from the queue if it exist
-        if job in self.queue:
-            self.queue.remove(job)
+        self.queue.discard(job.id)
         if confirm == ConfirmJobEnum.confirm:
-            await job.file.seek(0)
-
-            # Upload the original image to storage
-            self.storage.upload_file(
-                job.owner_ref,
-                "normal",
-                job.file.wrapped,
-                f"{job.id}_original.png",
-            )
-            await results[choice].seek(0)
-
-            # Upload the selected result image to storage
-            self.storage.upload_file(
-                job.owner_ref,
-                "xray",
-                results[choice].wrapped,
-                f"{job.id}_result.png",
-            )
-            # Add the result to the carousel
-            self.carrousel.insert(0, (results[choice], job.file))
-            # Maintain the carousel size limit
-            if len(self.carrousel) > self.carrousel_size:
-                self.carrousel.pop()
+            # Upload the original and the selected result in the background
+            self._upload(job, results[choice])
+            # The carousel takes over the references on both images
+            for i, blob in enumerate(results):
+                if i != choice:
+                    self.blobs.release(blob)
+            evicted = self.carrousel.push((results[choice], job.blob))
+            if evicted is not None:
+                for blob in evicted:
+                    self.blobs.release(blob)
+            await self._archive(results[choice], job.blob)
         elif confirm == ConfirmJobEnum.retry:
-            # Close all result files and re-add the job to the queue
-            for file in results:
-                await file.aclose()
+            # Drop the results and re-add the job to the queue
+            for blob in results:
+                self.blobs.release(blob)
             job.number_of_results = self.results_per_image
-            self.add_job(job)
+            job.retries += 1
+            self.awaiting_approval[job.id] = job, []
+            self._index(job.id)
+            self._enqueue(job)
         else:  # confirm == ConfirmJobEnum.cancel
-            # Close all result files and the job file
-            for file in results:
-                await file.aclose()
-            await job.file.aclose()
+            # Drop the results and the original image
+            for blob in results:
+                self.blobs.release(blob)
+            self.blobs.release(job.blob)
+            if job.archive is not None:
+                self.blobs.release(job.archive)
 
     """Retrieves the current list of images in the carousel.
 
         Returns:
-            list[Tuple[SpooledTemporaryFile, SpooledTemporaryFile]]: A list of tuples containing
-            the X-ray and original images in the carousel.
+            list[Tuple[BlobId, BlobId]]: A list of tuples containing the ids of the
+            X-ray and original images in the carousel.
+    """
+
+    def get_carousel(self) -> list[Tuple[BlobId, BlobId]]:
+        return list(self.carrousel)
+
+    def carousel_item(self, index: int) -> None | Tuple[BlobId, BlobId]:
+        if not 0 <= index < len(self.carrousel):
+            return None
+        return self.carrousel[index]
+
+    def queued(self) -> int:
+        return len(self.queue)
+
+    def get_pending(self, id: int) -> None | Tuple[Job, Result]:
+        return self.awaiting_approval.get(id)
+
+    def pending(self) -> list[Tuple[Job, Result]]:
+        return list(self.awaiting_approval.values())
+
+    """Stops journaling and drops the images."""
+
+    def close(self) -> None:
+        if self.journal is not None:
+            self.journal.close()
+        self.blobs.close()
+
+    """Restores the queue from its journal and starts journaling.
+
+        Jobs waiting for results are queued again in the order they were added. Leases
+        do not survive a restart, so dispatches without a result are handed out again.
+        Uploads that were not done carry on, failed ones wait to be retried.
+        Without a journal only the carousel is restored, from the archive if there is one.
     """
 
-    def get_carousel(self) -> list[Tuple[SpooledTemporaryFile, SpooledTemporaryFile]]:
-        return self.carrousel
+    async def recover(self) -> None:
+        if self.journal is None:
+            await self._recover_carousel()
+            return
+        journal = self.journal
+
+        def read_state() -> tuple[dict, dict[str, bytes]]:
+            state = journal.recover()
+            digests = {digest for pair in state["carrousel"] for digest in pair}
+            for entry in state["jobs"].values():
+                digests.add(entry["file"])
+                digests.update(entry["results"])
+                if "archive" in entry:
+                    digests.add(entry["archive"])
+            for upload in state["uploads"].values():
+                digests.update(blob for _, blob, _ in upload["files"])
+            return state, {digest: journal.read_blob(digest) for digest in digests}
+
+        state, blobs = await to_thread.run_sync(read_state)
+
+        async def load(digest: str) -> BlobId:
+            return await self.blobs.put(blobs[digest])
+
+        for entry in sorted(state["jobs"].values(), key=lambda e: e["seq"]):
+            results = [await load(digest) for digest in entry["results"]]
+            metadata = dict(entry["job"])
+            id = metadata.pop("id")
+            job = Job(blob=await load(entry["file"]), **metadata)
+            if "archive" in entry:
+                job.archive = await load(entry["archive"])
+            job.id = id
+            job.number_of_results -= len(results)
+            self.awaiting_approval[job.id] = job, results
+            self._index(job.id)
+            if job.number_of_results > 0:
+                self.queue.append(job)
+        # the journal keeps the newest first
+        for xray, original in reversed(state["carrousel"][: self.carrousel_size]):
+            self.carrousel.push((await load(xray), await load(original)))
+        # the pipeline takes over the references of the loaded files
+        for id, entry in state["uploads"].items():
+            files = [
+                Upload(type, await load(blob), filename)
+                for type, blob, filename in entry["files"]
+            ]
+            upload = UploadState(int(id), entry["owner_ref"], files)
+            upload.uploaded = entry["uploaded"]
+            if entry["failed"]:
+                upload.status = UploadStatus.failed
+            self.uploads.resume(upload, self.blobs)
+        Job.c_id = max(Job.c_id, state["next_id"])
+        self.journal.start()
+
+    def _journal_upload(self, state: UploadState) -> None:
+        self.journal.record(
+            {
+                "op": "upload",
+                "id": state.job_id,
+                "uploaded": state.uploaded,
+                "status": state.status.value,
+            }
+        )
+
+    """Restores the carousel from the newest items of the archive."""
+
+    async def _recover_carousel(self) -> None:
+        if self.archive is None:
+            return
+        archive = self.archive
+
+        def read_items() -> list[tuple[bytes, bytes]]:
+            return [
+                (archive.read(xray), archive.read(original))
+                for _, xray, original, _ in archive.entries(0, self.carrousel_size)
+            ]
+
+        items = await to_thread.run_sync(read_items)
+        for xray, original in reversed(items):
+            self.carrousel.push(
+                (await self.blobs.put(xray), await self.blobs.put(original))
+            )
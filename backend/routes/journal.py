@@ -0,0 +1,294 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import queue
+import threading
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+"""Applies a single journal record to a journal state.
+
+    The state mirrors what the JobQueue holds in memory, with images replaced by the
+    content hash of their blob:
+
+    .. code-block:: python
+
+        {
+            "jobs": {"<id>": {"job": {...}, "file": "<hash>", "results": ["<hash>"], "seq": 0}},
+            # jobs whose upload was normalized and kept also have "archive": "<hash>"
+            "carrousel": [["<xray hash>", "<original hash>"]],
+            # the uploads of confirmed jobs that are not in the storage yet
+            "uploads": {"<id>": {"owner_ref": 0, "files": [["xray", "<hash>", "<name>"]],
+                                 "uploaded": 0, "failed": False}},
+            "next_id": 0,
+            "seq": 0,
+        }
+
+    Args:
+        state (dict): The state to update in place.
+        record (dict): The journal record.
+"""
+
+
+def apply_record(state: dict, record: dict) -> None:
+    op = record["op"]
+    jobs = state["jobs"]
+    if op == "add":
+        job = record["job"]
+        jobs[str(job["id"])] = {
+            "job": job,
+            "file": record["blob"],
+            "results": [],
+            "seq": state["seq"],
+        }
+        state["next_id"] = max(state["next_id"], job["id"] + 1)
+    elif op == "archive":
+        jobs[str(record["id"])]["archive"] = record["blob"]
+    elif op == "submit":
+        jobs[str(record["id"])]["results"].append(record["blob"])
+    elif op == "replace":
+        jobs[str(record["id"])]["results"][record["choice"]] = record["blob"]
+    elif op == "retry":
+        entry = jobs[str(record["id"])]
+        entry["results"] = []
+        entry["job"]["number_of_results"] = record["number_of_results"]
+        if "added" in record:
+            entry["job"]["added"] = record["added"]
+        entry["seq"] = state["seq"]
+    elif op == "confirm":
+        entry = jobs[str(record["id"])]
+        xray = record.get("blob") or entry["results"][record["choice"]]
+        del jobs[str(record["id"])]
+        state["carrousel"].insert(0, [xray, entry["file"]])
+        del state["carrousel"][record["carrousel_size"] :]
+        if "upload" in record:
+            upload = dict(record["upload"], uploaded=0, failed=False)
+            state["uploads"][str(record["id"])] = upload
+    elif op == "upload":
+        uploads = state["uploads"]
+        upload = uploads.get(str(record["id"]))
+        if upload is None:
+            pass
+        elif record["status"] == "done":
+            del uploads[str(record["id"])]
+        else:
+            upload["uploaded"] = record["uploaded"]
+            upload["failed"] = record["status"] == "failed"
+    elif op == "cancel":
+        jobs.pop(str(record["id"]))
+    else:
+        raise ValueError(f"Unknown journal record {op}")
+    state["seq"] += 1
+
+
+def empty_state() -> dict:
+    return {"jobs": {}, "carrousel": [], "uploads": {}, "next_id": 0, "seq": 0}
+
+
+"""Append-only journal of JobQueue state transitions with snapshot compaction.
+
+    Records are written by a background thread: :meth:`record` only puts them on a
+    queue, so the event loop never waits for the disk. The thread writes whatever has
+    piled up since its last round and then fsyncs once (group commit). Images are
+    stored once per content hash in ``blobs/`` and referenced from the records.
+
+    Every ``compact_every`` records the thread writes its current state to
+    ``snapshot.json``, truncates the log and removes blobs no longer referenced.
+
+    Attributes:
+        directory (pathlib.Path): The directory holding the log, snapshot and blobs.
+        compact_every (int): The number of records after which a snapshot is taken.
+"""
+
+
+class Journal:
+    LOG = "journal.log"
+    SNAPSHOT = "snapshot.json"
+    BLOBS = "blobs"
+
+    def __init__(self, directory: str | os.PathLike, compact_every: int = 1000):
+        self.directory = pathlib.Path(directory)
+        self.compact_every = compact_every
+        self._state = empty_state()
+        self._since_snapshot = 0
+        self._queue: queue.SimpleQueue[Any] = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self._log = None
+
+    def _blob_path(self, digest: str) -> pathlib.Path:
+        return self.directory / self.BLOBS / digest[:2] / digest
+
+    """Reads a blob back from the journal directory.
+
+        Args:
+            digest (str): The SHA-256 hex digest of the blob.
+
+        Returns:
+            bytes: The content of the blob.
+    """
+
+    def read_blob(self, digest: str) -> bytes:
+        return self._blob_path(digest).read_bytes()
+
+    def _write_blob(self, data: bytes | memoryview, digest: str | None = None) -> str:
+        if digest is None:
+            digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        return digest
+
+    """Loads the last snapshot and replays the log written after it.
+
+        A torn record at the end of the log, left by a crash in the middle of a write,
+        is ignored.
+
+        Returns:
+            dict: The recovered state, see :func:`apply_record`.
+    """
+
+    def recover(self) -> dict:
+        state = empty_state()
+        snapshot = self.directory / self.SNAPSHOT
+        if snapshot.exists():
+            state = json.loads(snapshot.read_text())
+            # snapshots taken before uploads were journaled
+            state.setdefault("uploads", {})
+        log = self.directory / self.LOG
+        replayed = 0
+        if log.exists():
+            with open(log, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    # the snapshot might have been written without truncating the log
+                    if record["seq"] < state["seq"]:
+                        continue
+                    apply_record(state, record)
+                    replayed += 1
+        self._state = state
+        self._since_snapshot = replayed
+        return state
+
+    """Starts the background writer thread."""
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        (self.directory / self.BLOBS).mkdir(parents=True, exist_ok=True)
+        self._log = open(self.directory / self.LOG, "ab")
+        self._thread = threading.Thread(
+            target=self._run, name="jobqueue-journal", daemon=True
+        )
+        self._thread.start()
+
+    """Queues a record to be written to the journal.
+
+        Args:
+            record (dict): The record, with at least an ``op`` key.
+            blob (bytes | memoryview | None): The image that belongs to the record, if any. Its
+                hash is stored as ``blob`` in the record unless the record already
+                carries it.
+    """
+
+    def record(self, record: dict, blob: bytes | memoryview | None = None) -> None:
+        self._queue.put((record, blob))
+
+    """Blocks until everything recorded so far is on disk.
+
+        Args:
+            timeout (float | None): The maximum number of seconds to wait.
+    """
+
+    def flush(self, timeout: float | None = None) -> None:
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    """Writes outstanding records and stops the writer thread."""
+
+    def close(self) -> None:
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        assert self._log is not None
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            waiting: list[threading.Event] = []
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    waiting.append(item)
+                else:
+                    # a record the state cannot take is dropped, not the journal
+                    try:
+                        self._write(*item)
+                    except Exception:
+                        logger.exception("Dropped journal record %r", item[0])
+            try:
+                self._log.flush()
+                os.fsync(self._log.fileno())
+                if self._since_snapshot >= self.compact_every:
+                    self._compact()
+            except OSError:
+                logger.exception("Could not write the journal")
+            for event in waiting:
+                event.set()
+        self._log.close()
+
+    def _write(self, record: dict, blob: bytes | memoryview | None) -> None:
+        if blob is not None:
+            record["blob"] = self._write_blob(blob, record.get("blob"))
+        record["seq"] = self._state["seq"]
+        apply_record(self._state, record)
+        self._log.write(json.dumps(record).encode() + b"\n")
+        self._since_snapshot += 1
+
+    def _compact(self) -> None:
+        snapshot = self.directory / self.SNAPSHOT
+        tmp = snapshot.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self._state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, snapshot)
+        self._log.close()
+        self._log = open(self.directory / self.LOG, "wb")
+        self._since_snapshot = 0
+
+        referenced = {entry["file"] for entry in self._state["jobs"].values()}
+        for entry in self._state["jobs"].values():
+            referenced.update(entry["results"])
+            if "archive" in entry:
+                referenced.add(entry["archive"])
+        for xray, original in self._state["carrousel"]:
+            referenced.update((xray, original))
+        for upload in self._state["uploads"].values():
+            referenced.update(blob for _, blob, _ in upload["files"])
+        for path in (self.directory / self.BLOBS).glob("*/*"):
+            if path.name not in referenced:
+                path.unlink()
@@ -0,0 +1,58 @@
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+"""Rejects request bodies larger than a limit while they are still arriving.
+
+    A declared ``Content-Length`` beyond the limit is answered with 413 before the
+    body is read. Bodies without one are counted as they are received and the
+    request fails with 413 as soon as the count crosses the limit, so an oversized
+    upload is never parsed or spooled to the end.
+
+    Args:
+        app (ASGIApp): The application to protect.
+        max_body_size (int): The largest body accepted in bytes.
+        limits (dict[str, int] | None, optional): Other limits for some paths, e.g.
+            for routes taking several files at once.
+"""
+
+
+class BodySizeLimit:
+    def __init__(
+        self, app: ASGIApp, max_body_size: int, limits: dict[str, int] | None = None
+    ):
+        self.app = app
+        self.max_body_size = max_body_size
+        self.limits = limits or {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        max_body_size = self.limits.get(scope["path"], self.max_body_size)
+        headers = dict(scope["headers"])
+        length = headers.get(b"content-length")
+        if length is not None and length.isdigit():
+            if int(length) > max_body_size:
+                response = JSONResponse(
+                    {"detail": "Request body too large"},
+                    status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+                )
+                await response(scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_body_size:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+                        detail="Request body too large",
+                    )
+            return message
+
+        await self.app(scope, limited, send)
@@ -0,0 +1,121 @@
+import logging
+from collections import OrderedDict
+from typing import Protocol
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+"""Something whose bytes can be moved from memory to disk."""
+
+
+class Spillable(Protocol):
+    async def rollover(self) -> None: ...
+
+
+"""Keeps track of how many image bytes are held in memory across the process.
+
+    Whoever holds bytes in memory reports their size with :meth:`resize` and reports
+    when they were moved to disk with :meth:`resize_spilled`. Whenever the resident
+    bytes exceed ``budget``, :meth:`enforce` rolls the least recently used holders
+    over to disk until the total fits again. Holders larger than ``spill_threshold``
+    are expected to go to disk right away.
+
+    Attributes:
+        budget (int): The maximum number of bytes kept in memory.
+        spill_threshold (int): The size in bytes from which a single holder goes to disk.
+        resident (int): The bytes currently held in memory.
+        spilled (int): The bytes currently held on disk.
+"""
+
+
+class MemoryAccountant:
+    def __init__(self, budget: int = 256 * MB, spill_threshold: int = 16 * MB):
+        self.budget = budget
+        self.spill_threshold = spill_threshold
+        self.resident = 0
+        self.spilled = 0
+        # resident holders from least to most recently used, with their size
+        self._lru: OrderedDict[Spillable, int] = OrderedDict()
+        self._spilled: dict[Spillable, int] = {}
+        # holders being rolled over, already taken out of resident
+        self._rolling: dict[Spillable, int] = {}
+
+    """Reports the current memory usage.
+
+        Returns:
+            dict[str, int]: The budget, the resident and spilled bytes and the number of holders.
+    """
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "budget": self.budget,
+            "spill_threshold": self.spill_threshold,
+            "resident": self.resident,
+            "spilled": self.spilled,
+            "resident_buffers": len(self._lru),
+            "spilled_buffers": len(self._spilled),
+        }
+
+    """Records the size of a holder's bytes in memory and marks it as used.
+
+        Args:
+            holder (Spillable): The holder of the bytes.
+            size (int): The number of bytes it holds in memory.
+    """
+
+    def resize(self, holder: Spillable, size: int) -> None:
+        self._rolling.pop(holder, None)
+        self.resident += size - self._lru.get(holder, 0)
+        self._lru[holder] = size
+        self._lru.move_to_end(holder)
+
+    """Records that a holder's bytes are on disk now.
+
+        Args:
+            holder (Spillable): The holder of the bytes.
+            size (int): The number of bytes it holds on disk.
+    """
+
+    def resize_spilled(self, holder: Spillable, size: int) -> None:
+        self._rolling.pop(holder, None)
+        self.resident -= self._lru.pop(holder, 0)
+        self.spilled += size - self._spilled.get(holder, 0)
+        self._spilled[holder] = size
+
+    """Marks a holder as recently used."""
+
+    def touch(self, holder: Spillable) -> None:
+        if holder in self._lru:
+            self._lru.move_to_end(holder)
+
+    """Stops tracking a holder, e.g. because its bytes were freed."""
+
+    def forget(self, holder: Spillable) -> None:
+        self._rolling.pop(holder, None)
+        self.resident -= self._lru.pop(holder, 0)
+        self.spilled -= self._spilled.pop(holder, 0)
+
+    """Rolls the least recently used holders over to disk until the budget is met.
+
+        A holder that could not be written keeps counting as resident, and the budget
+        is enforced again on the next call; the error is logged rather than raised, it
+        is not the fault of whoever added bytes.
+    """
+
+    async def enforce(self) -> None:
+        while self.resident > self.budget and self._lru:
+            # take the victim out of the LRU first so concurrent calls pick others
+            holder, size = self._lru.popitem(last=False)
+            self.resident -= size
+            self._rolling[holder] = size
+            try:
+                await holder.rollover()
+            except Exception:
+                logger.exception("Could not move %d bytes to disk", size)
+            if self._rolling.pop(holder, None) is not None:
+                # neither spilled nor freed, the bytes are still in memory
+                self.resident += size
+                self._lru[holder] = size
+                self._lru.move_to_end(holder, last=False)
+                return
@@ -0,0 +1,113 @@
+import io
+from typing import BinaryIO
+
+from anyio import CapacityLimiter, to_thread
+from PIL import ExifTags, Image, ImageOps
+
+# Pillow's name of the codec and the mode it can encode
+FORMATS = {
+    "jpeg": ("JPEG", "RGB"),
+    "webp": ("WEBP", "RGBA"),
+    "png": ("PNG", "RGBA"),
+}
+
+"""Turns an image upright and scales it down to fit into a square.
+
+    JPEGs are decoded at a reduced scale right away when they are much larger than
+    needed. Images smaller than the square are not enlarged.
+
+    Args:
+        image (Image.Image): The image, opened but not loaded yet.
+        max_edge (int): The longest edge of the result in pixels.
+        format (str): The codec of the result, "jpeg", "webp" or "png".
+        quality (int): The quality of lossy codecs, from 1 to 100.
+
+    Returns:
+        bytes: The encoded image, without EXIF data.
+"""
+
+
+def shrink(image: Image.Image, max_edge: int, format: str, quality: int) -> bytes:
+    codec, mode = FORMATS[format]
+    # JPEGs can skip decoding most of the pixels that are thrown away anyway
+    image.draft("RGB", (max_edge, max_edge))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    if image.mode not in ("RGB", mode):
+        image = image.convert(mode if "A" in image.getbands() else "RGB")
+    out = io.BytesIO()
+    image.save(out, codec, quality=quality)
+    return out.getvalue()
+
+
+"""Raised when an upload cannot be decoded as an image."""
+
+
+class UnsupportedImage(ValueError):
+    pass
+
+
+"""Brings uploaded photos to the size and format the rest of the pipeline needs.
+
+    Every image is decoded once, turned upright according to its EXIF orientation,
+    scaled down so that its long edge is at most ``max_edge`` and encoded with
+    ``format`` at ``quality``, see :func:`shrink`. Images that are upright, small
+    enough and already in the format are kept as they are, so they don't lose quality.
+    Re-encoding drops the EXIF data, including the location phones store in it.
+
+    The work runs in worker threads, at most ``workers`` at a time, so neither the
+    event loop nor the memory is swamped when many uploads arrive at once.
+
+    Args:
+        max_edge (int): The longest edge of a normalized image in pixels.
+        format (str): The codec of normalized images, "jpeg", "webp" or "png".
+        quality (int): The quality of lossy codecs, from 1 to 100.
+        workers (int): How many images are normalized at the same time.
+"""
+
+
+class Normalizer:
+    def __init__(
+        self,
+        max_edge: int = 2048,
+        format: str = "jpeg",
+        quality: int = 90,
+        workers: int = 2,
+    ):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown image format {format}")
+        if max_edge < 1:
+            raise ValueError("max_edge must be at least 1")
+        self.max_edge = max_edge
+        self.format = format
+        self.quality = quality
+        self.limiter = CapacityLimiter(workers)
+
+    """Normalizes an image without blocking the event loop.
+
+        Args:
+            file (BinaryIO): The image, e.g. opened from the blob store.
+
+        Returns:
+            bytes | None: The normalized image, or None if the image can be kept as it is.
+
+        Raises:
+            UnsupportedImage: If the file is not an image Pillow can read.
+    """
+
+    async def normalize(self, file: BinaryIO) -> bytes | None:
+        return await to_thread.run_sync(self.normalize_sync, file, limiter=self.limiter)
+
+    def normalize_sync(self, file: BinaryIO) -> bytes | None:
+        try:
+            image = Image.open(file)
+            orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+            if (
+                image.format == FORMATS[self.format][0]
+                and orientation == 1
+                and max(image.size) <= self.max_edge
+            ):
+                return None
+            return shrink(image, self.max_edge, self.format, self.quality)
+        except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+            raise UnsupportedImage(f"Cannot read the image: {e}")
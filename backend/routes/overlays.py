@@ -0,0 +1,171 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from .memory import MB
+
+"""Decodes an overlay, a PNG with an alpha channel.
+
+    Args:
+        data (bytes | memoryview): The encoded overlay.
+
+    Returns:
+        np.ndarray: The BGRA pixels.
+
+    Raises:
+        ValueError: If the data is not an image or has no alpha channel.
+"""
+
+
+def decode_overlay(data: bytes | memoryview) -> np.ndarray:
+    overlay = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if overlay is None:
+        raise ValueError("Invalid overlay file")
+    if overlay.ndim != 3 or overlay.shape[2] != 4:
+        raise ValueError("The overlay needs an alpha channel")
+    return overlay
+
+
+"""The fracture overlays, registered once and then referenced by id.
+
+    Overlays are kept as uploaded and identified by the SHA-256 hex digest of the
+    file, so registering one again gives the same id. The decoded pixels and the
+    resized variants are kept in least recently used order within ``budget`` bytes,
+    keyed by the id and the scale in steps of ``scale_step``, so repeated edits with
+    the same stencil skip the decode and the resize. Scales within half a step of
+    each other share a variant.
+
+    The overlays live in the process; with several worker processes an overlay has
+    to be registered with each of them, which registering again does.
+
+    Args:
+        budget (int): The most bytes of decoded and resized overlays kept.
+        scale_step (float): The steps scales are rounded to.
+"""
+
+
+class OverlayLibrary:
+    def __init__(self, budget: int = 32 * MB, scale_step: float = 0.01):
+        if scale_step <= 0:
+            raise ValueError("The scale step must be positive")
+        self.budget = budget
+        self.scale_step = scale_step
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._files: dict[str, bytes] = {}
+        self._cache: OrderedDict[tuple[str, int], np.ndarray] = OrderedDict()
+        # overlays are used from the thread pool of the fracture endpoints
+        self._lock = threading.Lock()
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._files
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def ids(self) -> list[str]:
+        return list(self._files)
+
+    def steps(self, scale: float) -> int:
+        return max(round(scale / self.scale_step), 1)
+
+    """Registers an overlay.
+
+        Args:
+            data (bytes): The encoded overlay.
+
+        Returns:
+            str: The id of the overlay.
+
+        Raises:
+            ValueError: If the data is not an image with an alpha channel.
+    """
+
+    def register(self, data: bytes) -> str:
+        overlay = decode_overlay(data)
+        id = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._files[id] = bytes(data)
+            self._store((id, self.steps(1.0)), overlay)
+        return id
+
+    """Forgets an overlay and its variants.
+
+        Args:
+            id (str): The id of the overlay.
+
+        Returns:
+            bool: Whether the overlay was registered.
+    """
+
+    def remove(self, id: str) -> bool:
+        with self._lock:
+            if self._files.pop(id, None) is None:
+                return False
+            for key in [key for key in self._cache if key[0] == id]:
+                self.bytes -= self._cache.pop(key).nbytes
+        return True
+
+    """Returns an overlay at a scale, decoding and resizing it if needed.
+
+        Args:
+            id (str): The id of the overlay.
+            scale (float): The scale, rounded to ``scale_step``.
+
+        Returns:
+            np.ndarray: The BGRA pixels, read only.
+
+        Raises:
+            KeyError: If the overlay is not registered.
+    """
+
+    def get(self, id: str, scale: float) -> np.ndarray:
+        key = (id, self.steps(scale))
+        unscaled = (id, self.steps(1.0))
+        with self._lock:
+            overlay = self._cache.get(key)
+            if overlay is not None:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return overlay
+            self.misses += 1
+            data = self._files[id]
+            original = self._cache.get(unscaled)
+        # decoded and resized outside the lock, a race only costs a second resize
+        if original is None:
+            original = decode_overlay(data)
+            with self._lock:
+                self._store(unscaled, original)
+        if key == unscaled:
+            return original
+        step = key[1] * self.scale_step
+        overlay = cv2.resize(original, (0, 0), fx=step, fy=step)
+        with self._lock:
+            self._store(key, overlay)
+        return overlay
+
+    def _store(self, key: tuple[str, int], overlay: np.ndarray) -> None:
+        # shared between requests, nobody may paint on them
+        overlay.flags.writeable = False
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self.bytes -= old.nbytes
+        self._cache[key] = overlay
+        self.bytes += overlay.nbytes
+        while self.bytes > self.budget and self._cache:
+            _, old = self._cache.popitem(last=False)
+            self.bytes -= old.nbytes
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "overlays": len(self._files),
+            "overlay_variants": len(self._cache),
+            "overlay_bytes": self.bytes,
+            "overlay_budget": self.budget,
+            "overlay_hits": self.hits,
+            "overlay_misses": self.misses,
+        }
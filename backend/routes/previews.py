@@ -0,0 +1,141 @@
+import io
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+from .memory import MB
+from .thumbnails import MEDIA_TYPES
+
+# the fast codecs previews can be sent in, with their quality parameter
+ENCODINGS = {
+    "jpeg": (".jpg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+# EXIF orientations that turn the image by 90 degrees
+TRANSPOSED = {5, 6, 7, 8}
+
+"""A scaled-down copy of an image to paint previews on.
+
+    Attributes:
+        pixels (np.ndarray): The BGR pixels, read only.
+        fx (float): The width of the copy over the width of the image.
+        fy (float): The height of the copy over the height of the image.
+"""
+
+
+class Preview:
+    def __init__(self, pixels: np.ndarray, fx: float, fy: float):
+        self.pixels = pixels
+        self.fx = fx
+        self.fy = fy
+
+
+"""Scaled-down copies of the images fractures are painted on, for previews.
+
+    While the admin places a fracture, every preview paints it on a copy no larger
+    than ``max_edge`` and sends it with a fast codec; only the final placement is
+    painted at full resolution. The copies are keyed by the SHA-256 hex digest of
+    the image, the id of a stored result, and kept in least recently used order
+    within ``budget`` bytes, so a preview after the first skips the decode.
+
+    Args:
+        max_edge (int): The longest edge of the copies in pixels.
+        budget (int): The most bytes of copies kept.
+        format (str): The codec of the previews, "jpeg" or "webp".
+        quality (int): The quality of the codec, from 1 to 100.
+"""
+
+
+class PreviewCache:
+    def __init__(
+        self,
+        max_edge: int = 1024,
+        budget: int = 64 * MB,
+        format: str = "jpeg",
+        quality: int = 80,
+    ):
+        if format not in ENCODINGS:
+            raise ValueError(f"Unknown preview format {format}")
+        if max_edge < 1:
+            raise ValueError("max_edge must be at least 1")
+        self.max_edge = max_edge
+        self.budget = budget
+        self.format = format
+        self.media_type = MEDIA_TYPES[format]
+        self.quality = quality
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[str, Preview] = OrderedDict()
+        # previews are painted in the thread pool
+        self._lock = threading.Lock()
+
+    """Returns the scaled-down copy of an image, decoding it if needed.
+
+        Args:
+            id (str): The SHA-256 hex digest of the image.
+            data (bytes | memoryview): The encoded image.
+
+        Returns:
+            Preview: The copy.
+
+        Raises:
+            ValueError: If the data is not an image.
+    """
+
+    def get(self, id: str, data: bytes | memoryview) -> Preview:
+        with self._lock:
+            preview = self._cache.get(id)
+            if preview is not None:
+                self.hits += 1
+                self._cache.move_to_end(id)
+                return preview
+            self.misses += 1
+        preview = self._decode(data)
+        with self._lock:
+            self._store(id, preview)
+        return preview
+
+    def _decode(self, data: bytes | memoryview) -> Preview:
+        try:
+            image = Image.open(io.BytesIO(data))
+            width, height = image.size
+            if image.getexif().get(0x0112) in TRANSPOSED:
+                width, height = height, width
+            # JPEGs skip decoding most of the pixels that are thrown away anyway
+            image.draft("RGB", (self.max_edge, self.max_edge))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((self.max_edge, self.max_edge))
+            pixels = cv2.cvtColor(np.asarray(image.convert("RGB")), cv2.COLOR_RGB2BGR)
+        except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+            raise ValueError(f"Cannot read the image: {e}")
+        pixels.flags.writeable = False
+        return Preview(pixels, pixels.shape[1] / width, pixels.shape[0] / height)
+
+    def _store(self, id: str, preview: Preview) -> None:
+        old = self._cache.pop(id, None)
+        if old is not None:
+            self.bytes -= old.pixels.nbytes
+        self._cache[id] = preview
+        self.bytes += preview.pixels.nbytes
+        while self.bytes > self.budget and self._cache:
+            _, old = self._cache.popitem(last=False)
+            self.bytes -= old.pixels.nbytes
+
+    def encode(self, pixels: np.ndarray) -> bytes:
+        extension, quality = ENCODINGS[self.format]
+        _, encoded = cv2.imencode(extension, pixels, [quality, self.quality])
+        return encoded.tobytes()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "previews": len(self._cache),
+            "preview_bytes": self.bytes,
+            "preview_budget": self.budget,
+            "preview_hits": self.hits,
+            "preview_misses": self.misses,
+        }
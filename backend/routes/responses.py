@@ -0,0 +1,174 @@
+import pathlib
+
+from fastapi import Request, Response, status
+from fastapi.responses import FileResponse
+
+"""Checks whether the client already has the content of an ETag.
+
+    Args:
+        request (Request): The request, possibly with an ``If-None-Match`` header.
+        etag (str): The strong ETag of the current content, quoted.
+
+    Returns:
+        bool: True if the client can be answered with 304 Not Modified.
+"""
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+"""Builds the caching headers of content that is addressed by its version.
+
+    A URL with the current version always has the same content, so it is cached for
+    good. Without a version, or with an outdated one, the client has to revalidate
+    with the ETag on every use.
+
+    Args:
+        etag (str): The strong ETag of the content, quoted.
+        version (str | None): The version the client asked for.
+        current (str): The version of the content.
+
+    Returns:
+        dict[str, str]: The ``ETag`` and ``Cache-Control`` headers.
+"""
+
+
+def cache_headers(etag: str, version: str | None, current: str) -> dict[str, str]:
+    if version == current:
+        return {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+
+"""Parses a ``Range`` header asking for a single byte range.
+
+    Args:
+        header (str): The value of the header, e.g. ``bytes=0-1023`` or ``bytes=-512``.
+        size (int): The size of the content.
+
+    Returns:
+        tuple[int, int] | None: The start and the end (exclusive) of the range, or None
+        if the header is malformed or asks for several ranges and is to be ignored.
+
+    Raises:
+        ValueError: If the range lies outside of the content.
+"""
+
+
+def byte_range(header: str, size: int) -> tuple[int, int] | None:
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash or not (first.isdigit() or last.isdigit()):
+        return None
+    if not first:
+        # the last bytes of the content
+        start, end = max(size - int(last), 0), size
+        if int(last) == 0:
+            raise ValueError("Empty suffix range")
+    else:
+        start = int(first)
+        end = min(int(last) + 1, size) if last.isdigit() else size
+        if last and not last.isdigit():
+            return None
+    if start >= size or start >= end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+"""Serves content held in memory, honoring a single byte range.
+
+    Args:
+        request (Request): The request, possibly with ``Range`` and ``If-Range`` headers.
+        content (bytes | memoryview): The content.
+        media_type (str): The media type of the content.
+        headers (dict[str, str]): Further headers, e.g. from :func:`cache_headers`.
+
+    Returns:
+        Response: The whole content, the requested range with 206 Partial Content, or
+        416 Range Not Satisfiable.
+"""
+
+
+def content_response(
+    request: Request,
+    content: bytes | memoryview,
+    media_type: str,
+    headers: dict[str, str],
+) -> Response:
+    size = len(content)
+    headers = {**headers, "Accept-Ranges": "bytes"}
+    header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if header is None or (if_range is not None and if_range != headers.get("ETag")):
+        return Response(content=content, media_type=media_type, headers=headers)
+    try:
+        span = byte_range(header, size)
+    except ValueError:
+        return Response(
+            status_code=status.HTTP_416_RANGE_NOT_SATISFIABLE,
+            headers={**headers, "Content-Range": f"bytes */{size}"},
+        )
+    if span is None:
+        return Response(content=content, media_type=media_type, headers=headers)
+    start, end = span
+    return Response(
+        content=content[start:end],
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=media_type,
+        headers={**headers, "Content-Range": f"bytes {start}-{end - 1}/{size}"},
+    )
+
+
+"""Serves a file without copying it through Python where possible.
+
+    A proxy in front of the backend can take over the transfer: with the configured
+    ``<directory>=<location>`` mapping nginx serves the files in that directory from an
+    internal location, and gets an ``X-Accel-Redirect`` to the file instead of its
+    content. nginx announces itself by sending the same mapping in an
+    ``X-Accel-Mapping`` request header; the header only has to match, so a client
+    cannot steer the redirect. Clients that reach the backend directly, and files
+    outside the directory, get a :class:`FileResponse`, which supports ranges and HEAD
+    and uses ``sendfile`` where the server offers it.
+
+    Args:
+        request (Request): The request, possibly with an ``X-Accel-Mapping`` header.
+        path (pathlib.Path): The file.
+        media_type (str): The media type of the file.
+        headers (dict[str, str]): Further headers, e.g. from :func:`cache_headers`.
+        redirect (bool): False if the proxy must not take over, e.g. because the
+            response carries headers nginx does not pass on after a redirect.
+        accel_mapping (str): The ``<directory>=<location>`` mapping of the proxy, empty
+            to always send the file.
+
+    Returns:
+        Response: The response handing out the file.
+"""
+
+
+def file_response(
+    request: Request,
+    path: pathlib.Path,
+    media_type: str,
+    headers: dict[str, str],
+    redirect: bool = True,
+    accel_mapping: str = "",
+) -> Response:
+    mapping = request.headers.get("x-accel-mapping")
+    if redirect and accel_mapping and mapping == accel_mapping:
+        directory, _, location = accel_mapping.partition("=")
+        if location and path.is_relative_to(directory):
+            file = path.relative_to(directory).as_posix()
+            return Response(
+                media_type=media_type,
+                headers={
+                    **headers,
+                    "X-Accel-Redirect": location.rstrip("/") + "/" + file,
+                },
+            )
+    return FileResponse(path, media_type=media_type, headers=headers)
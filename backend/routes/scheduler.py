@@ -0,0 +1,355 @@
+import heapq
+import itertools
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Iterator
+
+if TYPE_CHECKING:
+    from .jobqueue import Job
+
+"""Base class for the policies that decide which pending job is dispatched next.
+
+    A scheduler holds every job that still has results to hand out. ``JobQueue.get_job``
+    looks at the job returned by :meth:`peek` and removes it with :meth:`popleft` once
+    all of its results have been dispatched.
+"""
+
+
+class Scheduler(ABC):
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    """Iterates over the queued jobs, in dispatch order only for FIFO."""
+
+    @abstractmethod
+    def __iter__(self) -> Iterator["Job"]:
+        pass
+
+    @abstractmethod
+    def __contains__(self, job: "Job") -> bool:
+        pass
+
+    """Queues a job according to the policy."""
+
+    @abstractmethod
+    def append(self, job: "Job") -> None:
+        pass
+
+    """Queues a job so it is dispatched before everything else."""
+
+    @abstractmethod
+    def appendleft(self, job: "Job") -> None:
+        pass
+
+    """Returns the job to dispatch next without removing it."""
+
+    @abstractmethod
+    def peek(self) -> "None | Job":
+        pass
+
+    """Removes and returns the job to dispatch next."""
+
+    @abstractmethod
+    def popleft(self) -> "Job":
+        pass
+
+    """Removes a job by id if it is queued."""
+
+    @abstractmethod
+    def discard(self, id: int) -> "None | Job":
+        pass
+
+
+"""The FIFO scheduling policy: a queue of pending jobs with an index from job id to its position.
+
+    Backed by an OrderedDict, which is a hash map over a doubly linked list, so
+    enqueueing at either end, dequeueing from the head and removing an arbitrary
+    job by id are all O(1).
+"""
+
+
+class JobDeque(Scheduler):
+    def __init__(self):
+        self._jobs: OrderedDict[int, "Job"] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def __iter__(self) -> Iterator["Job"]:
+        return iter(self._jobs.values())
+
+    def __contains__(self, job: "Job") -> bool:
+        return self._jobs.get(job.id) is job
+
+    """Appends a job to the tail of the queue, or moves it there if already queued.
+
+        Args:
+            job (Job): The job to enqueue.
+    """
+
+    def append(self, job: "Job") -> None:
+        self._jobs[job.id] = job
+        self._jobs.move_to_end(job.id)
+
+    """Puts a job at the head of the queue so it is dispatched next.
+
+        Args:
+            job (Job): The job to enqueue.
+    """
+
+    def appendleft(self, job: "Job") -> None:
+        self._jobs[job.id] = job
+        self._jobs.move_to_end(job.id, last=False)
+
+    """Returns the job at the head of the queue without removing it.
+
+        Returns:
+            Job | None: The oldest job or None if the queue is empty.
+    """
+
+    def peek(self) -> "None | Job":
+        if not self._jobs:
+            return None
+        return self._jobs[next(iter(self._jobs))]
+
+    """Removes and returns the job at the head of the queue.
+
+        Raises:
+            IndexError: If the queue is empty.
+    """
+
+    def popleft(self) -> "Job":
+        if not self._jobs:
+            raise IndexError("pop from an empty JobDeque")
+        return self._jobs.popitem(last=False)[1]
+
+    """Removes a job by id if it is queued.
+
+        Args:
+            id (int): The ID of the job to remove.
+
+        Returns:
+            Job | None: The removed job or None if it was not queued.
+    """
+
+    def discard(self, id: int) -> "None | Job":
+        return self._jobs.pop(id, None)
+
+
+"""Dispatches the jobs with the largest head start first.
+
+    A job's priority is a number of seconds it is treated as if it had been queued
+    earlier. Since all queued jobs age at the same rate, the order never changes
+    after enqueueing and a heap keeps it in O(log n). Aging is built in: a job
+    without priority waits at most the largest head start longer than it would
+    under FIFO, so it can't starve.
+
+    Args:
+        priority (Callable[[Job], float]): The head start of a job in seconds.
+"""
+
+
+class PriorityScheduler(Scheduler):
+    def __init__(self, priority: Callable[["Job"], float]):
+        self.priority = priority
+        # heap of (key, seq, job id), entries of removed jobs are skipped lazily
+        self._heap: list[tuple[float, int, int]] = []
+        self._keys: dict[int, tuple[float, int]] = {}
+        self._jobs: dict[int, "Job"] = {}
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def __iter__(self) -> Iterator["Job"]:
+        return iter(list(self._jobs.values()))
+
+    def __contains__(self, job: "Job") -> bool:
+        return self._jobs.get(job.id) is job
+
+    def _push(self, job: "Job", key: float, seq: int) -> None:
+        self._jobs[job.id] = job
+        self._keys[job.id] = key, seq
+        heapq.heappush(self._heap, (key, seq, job.id))
+        # drop stale entries once they make up most of the heap
+        if len(self._heap) > 2 * len(self._keys) + 64:
+            self._heap = [(k, s, id) for id, (k, s) in self._keys.items()]
+            heapq.heapify(self._heap)
+
+    def _prune(self) -> None:
+        while self._heap:
+            key, seq, id = self._heap[0]
+            if self._keys.get(id) == (key, seq):
+                return
+            heapq.heappop(self._heap)
+
+    def append(self, job: "Job") -> None:
+        key = time.monotonic() - self.priority(job)
+        self._push(job, key, next(self._counter))
+
+    def appendleft(self, job: "Job") -> None:
+        self._push(job, float("-inf"), -next(self._counter))
+
+    def peek(self) -> "None | Job":
+        self._prune()
+        if not self._heap:
+            return None
+        return self._jobs[self._heap[0][2]]
+
+    def popleft(self) -> "Job":
+        self._prune()
+        if not self._heap:
+            raise IndexError("pop from an empty PriorityScheduler")
+        _, _, id = heapq.heappop(self._heap)
+        del self._keys[id]
+        return self._jobs.pop(id)
+
+    def discard(self, id: int) -> "None | Job":
+        self._keys.pop(id, None)
+        return self._jobs.pop(id, None)
+
+
+"""Shares the dispatches between classes of jobs according to their weights.
+
+    Every class, e.g. an animal type, has its own FIFO. Classes are served by
+    stride scheduling: each dispatch advances the class' pass by ``1 / weight`` and
+    the non-empty class with the smallest pass goes next, picked from a heap in
+    O(log k) for k classes. A class that was idle starts at the current pass
+    instead of its old one, so it can't save up dispatches and every class with
+    jobs gets its share, which rules out starvation.
+
+    Args:
+        classify (Callable[[Job], str]): The class of a job.
+        weights (dict[str, float]): The weight of each class. Unlisted classes weigh 1.
+"""
+
+
+class FairScheduler(Scheduler):
+    def __init__(
+        self, classify: Callable[["Job"], str], weights: dict[str, float] | None = None
+    ):
+        self.classify = classify
+        self.weights = weights or {}
+        self._queues: dict[str, JobDeque] = {}
+        self._pass: dict[str, float] = {}
+        # heap of (pass, seq, class) for classes with jobs, stale entries are skipped
+        self._active: list[tuple[float, int, str]] = []
+        self._class_of: dict[int, str] = {}
+        self._vtime = 0.0
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._class_of)
+
+    def __iter__(self) -> Iterator["Job"]:
+        return itertools.chain.from_iterable(list(q) for q in self._queues.values())
+
+    def __contains__(self, job: "Job") -> bool:
+        cls = self._class_of.get(job.id)
+        return cls is not None and job in self._queues[cls]
+
+    def _enqueue(self, job: "Job", left: bool) -> None:
+        cls = self.classify(job)
+        if self._class_of.get(job.id, cls) != cls:
+            self.discard(job.id)
+        queue = self._queues.setdefault(cls, JobDeque())
+        if len(queue) == 0:
+            self._pass[cls] = max(self._pass.get(cls, 0.0), self._vtime)
+            heapq.heappush(self._active, (self._pass[cls], next(self._counter), cls))
+        if left:
+            queue.appendleft(job)
+        else:
+            queue.append(job)
+        self._class_of[job.id] = cls
+
+    def append(self, job: "Job") -> None:
+        self._enqueue(job, left=False)
+
+    def appendleft(self, job: "Job") -> None:
+        self._enqueue(job, left=True)
+
+    def _next_class(self) -> None | str:
+        while self._active:
+            pass_, _, cls = self._active[0]
+            if len(self._queues[cls]) > 0 and self._pass[cls] == pass_:
+                return cls
+            heapq.heappop(self._active)
+        return None
+
+    def peek(self) -> "None | Job":
+        cls = self._next_class()
+        if cls is None:
+            return None
+        return self._queues[cls].peek()
+
+    def popleft(self) -> "Job":
+        cls = self._next_class()
+        if cls is None:
+            raise IndexError("pop from an empty FairScheduler")
+        heapq.heappop(self._active)
+        job = self._queues[cls].popleft()
+        del self._class_of[job.id]
+        self._vtime = self._pass[cls]
+        self._pass[cls] += 1 / self.weights.get(cls, 1.0)
+        if len(self._queues[cls]) > 0:
+            heapq.heappush(self._active, (self._pass[cls], next(self._counter), cls))
+        return job
+
+    def discard(self, id: int) -> "None | Job":
+        cls = self._class_of.pop(id, None)
+        if cls is None:
+            return None
+        return self._queues[cls].discard(id)
+
+
+"""Creates the scheduler for a scheduling policy.
+
+    Args:
+        policy (str): One of ``fifo``, ``priority`` or ``fair``.
+        broken_bone_boost (float): Head start in seconds of teddies with a broken bone (``priority``).
+        retry_boost (float): Head start in seconds of retried jobs (``priority``).
+        animal_type_boosts (dict[str, float] | None): Head start in seconds per animal type (``priority``).
+        weights (dict[str, float] | None): Weight per class (``fair``). Jobs are classed
+            as ``retry``, ``broken_bone`` or by their animal type, in that order.
+
+    Raises:
+        ValueError: If the policy is unknown.
+
+    Returns:
+        Scheduler: The scheduler.
+"""
+
+
+def create_scheduler(
+    policy: str,
+    broken_bone_boost: float = 0.0,
+    retry_boost: float = 0.0,
+    animal_type_boosts: dict[str, float] | None = None,
+    weights: dict[str, float] | None = None,
+) -> Scheduler:
+    animal_type_boosts = animal_type_boosts or {}
+
+    def priority(job: "Job") -> float:
+        boost = animal_type_boosts.get(job.animal_type, 0.0)
+        if job.broken_bone:
+            boost += broken_bone_boost
+        if job.retries:
+            boost += retry_boost
+        return boost
+
+    def classify(job: "Job") -> str:
+        if job.retries:
+            return "retry"
+        if job.broken_bone:
+            return "broken_bone"
+        return job.animal_type
+
+    if policy == "fifo":
+        return JobDeque()
+    if policy == "priority":
+        return PriorityScheduler(priority)
+    if policy == "fair":
+        return FairScheduler(classify, weights)
+    raise ValueError(f"Unknown scheduling policy {policy}")
@@ -0,0 +1,1160 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import pathlib
+import secrets
+import sqlite3
+import time
+from collections import deque
+from typing import AsyncIterable, BinaryIO, Iterator, Tuple
+
+from anyio import to_thread
+from fastapi import UploadFile
+
+from ..storage import Storage
+from .blobstore import HASH_IN_THREAD, ingest
+from .carousel import CarouselArchive
+from .jobqueue import (
+    CHANGE_LOG_SIZE,
+    BlobId,
+    ConfirmJobEnum,
+    Cursor,
+    Job,
+    JobQueueBackend,
+    Lease,
+    PendingFilter,
+    Result,
+)
+from .scheduler import FairScheduler, JobDeque, PriorityScheduler, Scheduler
+from .uploads import Upload, UploadPipeline, UploadState, UploadStatus
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    blob TEXT NOT NULL,
+    -- the image as uploaded, if it was normalized and is kept for the storage
+    archive TEXT,
+    owner_ref,
+    first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL,
+    animal_name TEXT NOT NULL,
+    animal_type TEXT NOT NULL,
+    broken_bone INTEGER NOT NULL,
+    number_of_results INTEGER NOT NULL,
+    retries INTEGER NOT NULL,
+    -- whether the job waits to be dispatched, in the order of class pass and sort_key
+    queued INTEGER NOT NULL,
+    sort_key REAL NOT NULL,
+    class TEXT NOT NULL,
+    -- the order in which jobs are listed for approval
+    added REAL NOT NULL,
+    -- whether all results arrived
+    complete INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (queued, sort_key);
+CREATE INDEX IF NOT EXISTS jobs_class ON jobs (queued, class, sort_key);
+CREATE INDEX IF NOT EXISTS jobs_added ON jobs (added);
+CREATE TABLE IF NOT EXISTS results (
+    job_id INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    blob TEXT NOT NULL,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE TABLE IF NOT EXISTS leases (
+    token TEXT PRIMARY KEY,
+    job_id INTEGER NOT NULL,
+    deadline REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS leases_deadline ON leases (deadline);
+CREATE INDEX IF NOT EXISTS leases_job ON leases (job_id, deadline);
+CREATE TABLE IF NOT EXISTS carousel (
+    pos INTEGER PRIMARY KEY AUTOINCREMENT,
+    xray TEXT NOT NULL,
+    original TEXT NOT NULL
+);
+-- stride scheduling state of the fair policy
+CREATE TABLE IF NOT EXISTS classes (
+    class TEXT PRIMARY KEY,
+    pass REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    id TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL
+);
+-- the uploads of confirmed jobs, so every process can report them
+CREATE TABLE IF NOT EXISTS uploads (
+    job_id INTEGER PRIMARY KEY,
+    status TEXT NOT NULL,
+    uploaded INTEGER NOT NULL,
+    files INTEGER NOT NULL,
+    attempts INTEGER NOT NULL,
+    error TEXT,
+    updated REAL NOT NULL,
+    -- the owner and files as JSON until uploaded, the row holds a reference on each
+    manifest TEXT,
+    -- when another process may take over the uploads
+    deadline REAL
+);
+CREATE INDEX IF NOT EXISTS uploads_updated ON uploads (updated);
+-- the version of the last change of every job awaiting approval or removed from it
+CREATE TABLE IF NOT EXISTS changes (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL UNIQUE
+);
+"""
+
+# what the uploads of a job are reported with
+UPLOAD_COLUMNS = "job_id, status, uploaded, files, attempts, error, updated"
+# uploads in flight that no process renewed in time
+ABANDONED_UPLOADS = (
+    "manifest IS NOT NULL AND status NOT IN ('done', 'failed') AND deadline <= ?"
+)
+
+# created once the columns exist, after the migrations of older databases
+INDEXES = """
+CREATE INDEX IF NOT EXISTS jobs_type ON jobs (animal_type, added);
+CREATE INDEX IF NOT EXISTS jobs_complete ON jobs (complete, added);
+"""
+
+"""Opens a connection to the queue database, creating the tables if needed.
+
+    Args:
+        path (str | os.PathLike): The database file.
+        timeout (float): Seconds to wait for a lock held by another process.
+
+    Returns:
+        sqlite3.Connection: A connection in autocommit mode, transactions are explicit.
+"""
+
+
+def connect(path: str | os.PathLike, timeout: float = 30.0) -> sqlite3.Connection:
+    # the queue is used from the event loop, which need not be the creating thread
+    db = sqlite3.connect(
+        path, timeout=timeout, isolation_level=None, check_same_thread=False
+    )
+    db.row_factory = sqlite3.Row
+    # readers never block the writer and the other way round
+    db.execute("PRAGMA journal_mode=WAL")
+    # a commit survives a crash of the process, only a power loss can undo it
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    # databases created before uploads were normalized
+    columns = {row["name"] for row in db.execute("PRAGMA table_info(jobs)")}
+    if "archive" not in columns:
+        db.execute("ALTER TABLE jobs ADD COLUMN archive TEXT")
+    # databases created before the listing could be filtered
+    if "complete" not in columns:
+        db.execute("ALTER TABLE jobs ADD COLUMN complete INTEGER NOT NULL DEFAULT 0")
+    # databases created before uploads survived a restart
+    columns = {row["name"] for row in db.execute("PRAGMA table_info(uploads)")}
+    if "manifest" not in columns:
+        db.execute("ALTER TABLE uploads ADD COLUMN manifest TEXT")
+        db.execute("ALTER TABLE uploads ADD COLUMN deadline REAL")
+    db.executescript(INDEXES)
+    return db
+
+
+"""Runs a block in a write transaction, or in the one already open.
+
+    Args:
+        db (sqlite3.Connection): The connection.
+"""
+
+
+@contextlib.contextmanager
+def transaction(db: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    if db.in_transaction:
+        yield db
+        return
+    # take the write lock right away, so the transaction never has to be retried
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+"""Runs a block in a read transaction, so it sees a single state of the database.
+
+    Args:
+        db (sqlite3.Connection): The connection.
+"""
+
+
+@contextlib.contextmanager
+def snapshot(db: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    if db.in_transaction:
+        yield db
+        return
+    db.execute("BEGIN")
+    try:
+        yield db
+    finally:
+        db.execute("COMMIT")
+
+
+"""Content-addressed image store in a directory shared by several processes.
+
+    Works like :class:`BlobStore`, but the blobs always live in files and their
+    reference counts in the queue database, so every process sees the same blobs.
+    Views are memory-mapped from the files.
+
+    Attributes:
+        directory (pathlib.Path): The directory holding the blobs.
+"""
+
+
+class SQLiteBlobStore:
+    def __init__(self, directory: str | os.PathLike, db: sqlite3.Connection):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._db = db
+
+    def __contains__(self, id: str) -> bool:
+        return (
+            self._db.execute("SELECT 1 FROM blobs WHERE id = ?", (id,)).fetchone()
+            is not None
+        )
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+
+    def _path(self, id: str) -> pathlib.Path:
+        return self.directory / id[:2] / id
+
+    def _write(self, id: str, data: bytes) -> pathlib.Path:
+        path = self._path(id)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(f"{id}.{os.getpid()}.{secrets.token_hex(4)}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        return tmp
+
+    """Stores an image and takes a reference on it.
+
+        Args:
+            data (bytes): The content of the image.
+
+        Returns:
+            str: The id of the blob, the SHA-256 hex digest of the content.
+    """
+
+    async def put(self, data: bytes) -> str:
+        if len(data) >= HASH_IN_THREAD:
+            id = await to_thread.run_sync(lambda: hashlib.sha256(data).hexdigest())
+        else:
+            id = hashlib.sha256(data).hexdigest()
+        with transaction(self._db):
+            cursor = self._db.execute(
+                "UPDATE blobs SET refs = refs + 1 WHERE id = ?", (id,)
+            )
+            if cursor.rowcount > 0:
+                return id
+        if len(data) >= HASH_IN_THREAD:
+            tmp = await to_thread.run_sync(self._write, id, data)
+        else:
+            tmp = self._write(id, data)
+        return self._add(id, len(data), tmp)
+
+    """Stores an image read piece by piece and takes a reference on it.
+
+        The content is written straight to a file, it is never held in memory as a whole.
+
+        Args:
+            chunks (AsyncIterable[bytes]): The content of the image.
+            limit (int | None): The largest size accepted, unlimited if None.
+
+        Returns:
+            str: The id of the blob, the SHA-256 hex digest of the content.
+
+        Raises:
+            BlobTooLarge: If the content exceeds the limit, nothing is stored.
+    """
+
+    async def put_stream(
+        self, chunks: AsyncIterable[bytes], limit: int | None = None
+    ) -> str:
+        # empty content stays in the buffer, everything else goes to a file
+        id, size, data, tmp = await ingest(chunks, self.directory, limit, 0)
+        if tmp is None:
+            return await self.put(bytes(data))
+        try:
+            with transaction(self._db):
+                cursor = self._db.execute(
+                    "UPDATE blobs SET refs = refs + 1 WHERE id = ?", (id,)
+                )
+                if cursor.rowcount > 0:
+                    return id
+            self._path(id).parent.mkdir(exist_ok=True)
+            return self._add(id, size, tmp)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def _add(self, id: str, size: int, tmp: pathlib.Path) -> str:
+        try:
+            with transaction(self._db):
+                (refs,) = self._db.execute(
+                    "INSERT INTO blobs (id, size, refs) VALUES (?, ?, 1) "
+                    "ON CONFLICT (id) DO UPDATE SET refs = refs + 1 RETURNING refs",
+                    (id, size),
+                ).fetchone()
+                if refs == 1:
+                    # under the write lock, so a release can't unlink it right after
+                    os.replace(tmp, self._path(id))
+        finally:
+            tmp.unlink(missing_ok=True)
+        return id
+
+    """Takes another reference on a blob.
+
+        Args:
+            id (str): The id of the blob.
+
+        Returns:
+            str: The id of the blob, for chaining.
+
+        Raises:
+            KeyError: If the blob does not exist.
+    """
+
+    def incref(self, id: str) -> str:
+        with transaction(self._db):
+            cursor = self._db.execute(
+                "UPDATE blobs SET refs = refs + 1 WHERE id = ?", (id,)
+            )
+            if cursor.rowcount == 0:
+                raise KeyError(f"Unknown blob {id}")
+        return id
+
+    """Gives back a reference on a blob and removes the blob with its last reference.
+
+        Args:
+            id (str): The id of the blob.
+
+        Raises:
+            KeyError: If the blob does not exist.
+    """
+
+    def release(self, id: str) -> None:
+        with transaction(self._db):
+            row = self._db.execute(
+                "UPDATE blobs SET refs = refs - 1 WHERE id = ? RETURNING refs", (id,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(f"Unknown blob {id}")
+            if row["refs"] <= 0:
+                self._db.execute("DELETE FROM blobs WHERE id = ?", (id,))
+                self._path(id).unlink(missing_ok=True)
+
+    """Gives read access to a blob without copying it.
+
+        The view stays valid after the blob is released.
+
+        Args:
+            id (str): The id of the blob.
+
+        Returns:
+            memoryview: The content of the blob.
+
+        Raises:
+            KeyError: If the blob does not exist.
+    """
+
+    def view(self, id: str) -> memoryview:
+        try:
+            with open(self._path(id), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return memoryview(b"")
+                return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except FileNotFoundError:
+            raise KeyError(f"Unknown blob {id}")
+
+    """Returns a copy of the content of a blob.
+
+        Args:
+            id (str): The id of the blob.
+
+        Returns:
+            bytes: The content of the blob.
+
+        Raises:
+            KeyError: If the blob does not exist.
+    """
+
+    def read(self, id: str) -> bytes:
+        return bytes(self.view(id))
+
+    """Opens a blob as a file, e.g. to hand it to a storage backend.
+
+        Args:
+            id (str): The id of the blob.
+
+        Returns:
+            BinaryIO: A file positioned at the start, to be closed by the caller.
+
+        Raises:
+            KeyError: If the blob does not exist.
+    """
+
+    def open(self, id: str) -> BinaryIO:
+        try:
+            return open(self._path(id), "rb")
+        except FileNotFoundError:
+            raise KeyError(f"Unknown blob {id}")
+
+    """Returns the file of a blob, so it can be sent without reading it into Python.
+
+        Args:
+            id (str): The id of the blob.
+
+        Returns:
+            pathlib.Path: The file of the blob.
+
+        Raises:
+            KeyError: If the blob does not exist.
+    """
+
+    def path(self, id: str) -> pathlib.Path:
+        path = self._path(id)
+        if not path.exists():
+            raise KeyError(f"Unknown blob {id}")
+        return path
+
+    """Reports the number and size of the stored blobs.
+
+        Returns:
+            dict[str, int]: The number of blobs, their total size and the number of references.
+    """
+
+    def stats(self) -> dict[str, int]:
+        row = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refs), 0) FROM blobs"
+        ).fetchone()
+        return {"blobs": row[0], "bytes": row[1], "refs": row[2]}
+
+    def close(self) -> None:
+        pass
+
+
+"""A job queue that several processes on one host share through SQLite.
+
+    Jobs, results, leases and the carousel live in a SQLite database in WAL mode and
+    the images in a shared directory, so the API can run with several worker
+    processes. Every operation is a short transaction that takes the write lock up
+    front, which serializes the processes without lost updates. The state is durable
+    by itself, so no journal is needed.
+
+    The scheduling policy is taken from ``scheduler``: FIFO and priority order the
+    queue by enqueue time minus the head start, the fair policy keeps the pass of
+    every class in the database. Waiting workers are woken right away by jobs added
+    in their own process and poll for jobs added by other processes.
+
+    Args:
+        path (str | os.PathLike): The database file.
+        blob_dir (str | os.PathLike): The directory holding the images.
+        results_per_image (int): The number of results expected for each image.
+        carrousel_size (int): The maximum number of images in the carousel.
+        storage (Storage): The storage system confirmed images are uploaded to.
+        lease_timeout (float): Seconds a worker has to deliver a result.
+        scheduler (Scheduler | None): The scheduling policy, FIFO if omitted.
+        poll_interval (float): Seconds between checks for jobs from other processes.
+        uploads (UploadPipeline | None): Uploads confirmed images in the background,
+            created from storage if omitted. Its states are kept in the database.
+        upload_timeout (float): Seconds after which the uploads of a process that
+            stopped renewing them are taken over by another, or by the same after a
+            restart.
+        archive (CarouselArchive | None): Keeps every item that entered the carousel.
+"""
+
+
+class SQLiteJobQueue(JobQueueBackend):
+    def __init__(
+        self,
+        path: str | os.PathLike,
+        blob_dir: str | os.PathLike,
+        results_per_image: int,
+        carrousel_size: int,
+        storage: Storage,
+        lease_timeout: float = 300.0,
+        scheduler: Scheduler | None = None,
+        poll_interval: float = 0.1,
+        uploads: UploadPipeline | None = None,
+        upload_timeout: float = 30.0,
+        archive: CarouselArchive | None = None,
+    ):
+        self._db = connect(path)
+        self.blobs = SQLiteBlobStore(blob_dir, self._db)
+        self.results_per_image = results_per_image
+        self.carrousel_size = carrousel_size
+        self.storage = storage
+        self.lease_timeout = lease_timeout
+        self.scheduler = scheduler if scheduler is not None else JobDeque()
+        if not isinstance(self.scheduler, (JobDeque, PriorityScheduler, FairScheduler)):
+            raise ValueError(f"Unsupported scheduler {type(self.scheduler).__name__}")
+        self.poll_interval = poll_interval
+        # workers of this process waiting for a job, oldest first
+        self._waiters: deque[asyncio.Future[None]] = deque()
+        self.uploads = uploads if uploads is not None else UploadPipeline(storage)
+        self.uploads.on_change = self._record_upload
+        self.upload_timeout = upload_timeout
+        self.archive = archive
+        with transaction(self._db):
+            # the jobs of older databases, or of a different number of results per image
+            self._db.execute(
+                "UPDATE jobs SET complete = ((SELECT COUNT(*) FROM results "
+                "WHERE job_id = jobs.id) >= ?)",
+                (results_per_image,),
+            )
+
+    def _class(self, job: Job) -> str:
+        if isinstance(self.scheduler, FairScheduler):
+            return self.scheduler.classify(job)
+        return ""
+
+    def _sort_key(self, job: Job) -> float:
+        if isinstance(self.scheduler, PriorityScheduler):
+            return time.time() - self.scheduler.priority(job)
+        return time.time()
+
+    def _job(self, row: sqlite3.Row) -> Job:
+        job = Job(
+            blob=row["blob"],
+            owner_ref=row["owner_ref"],
+            first_name=row["first_name"],
+            last_name=row["last_name"],
+            animal_name=row["animal_name"],
+            animal_type=row["animal_type"],
+            broken_bone=bool(row["broken_bone"]),
+            number_of_results=row["number_of_results"],
+            archive=row["archive"],
+        )
+        job.id = row["id"]
+        job.retries = row["retries"]
+        job.added = row["added"]
+        return job
+
+    def _exists(self, id: int) -> bool:
+        row = self._db.execute("SELECT 1 FROM jobs WHERE id = ?", (id,)).fetchone()
+        return row is not None
+
+    def _results(self, id: int) -> Result:
+        return [
+            row["blob"]
+            for row in self._db.execute(
+                "SELECT blob FROM results WHERE job_id = ? ORDER BY idx", (id,)
+            )
+        ]
+
+    def _activate_class(self, cls: str) -> None:
+        # an idle class starts at the current pass, like in FairScheduler
+        if not isinstance(self.scheduler, FairScheduler):
+            return
+        busy = self._db.execute(
+            "SELECT 1 FROM jobs WHERE queued AND class = ? LIMIT 1", (cls,)
+        ).fetchone()
+        if busy is not None:
+            return
+        vtime = self._meta("vtime", 0.0)
+        self._db.execute(
+            "INSERT INTO classes (class, pass) VALUES (?, ?) "
+            "ON CONFLICT (class) DO UPDATE SET pass = MAX(pass, excluded.pass)",
+            (cls, vtime),
+        )
+
+    def _meta(self, key: str, default):
+        row = self._db.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return default if row is None else row["value"]
+
+    def _set_meta(self, key: str, value) -> None:
+        self._db.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+    def _touch(self, id: int) -> None:
+        # replacing the row of the job moves it to the end with a new version
+        version = self._db.execute(
+            "INSERT OR REPLACE INTO changes (job_id) VALUES (?)", (id,)
+        ).lastrowid
+        floor = version - CHANGE_LOG_SIZE
+        if floor > self._meta("changes_floor", 0):
+            self._db.execute("DELETE FROM changes WHERE version <= ?", (floor,))
+            self._set_meta("changes_floor", floor)
+
+    def changes(self, since: int) -> Tuple[int, None | list[int]]:
+        with snapshot(self._db):
+            row = self._db.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'changes'"
+            ).fetchone()
+            version = 0 if row is None else row["seq"]
+            if since < self._meta("changes_floor", 0) or since > version:
+                return version, None
+            ids = [
+                row["job_id"]
+                for row in self._db.execute(
+                    "SELECT job_id FROM changes WHERE version > ? ORDER BY version",
+                    (since,),
+                )
+            ]
+        return version, ids
+
+    def _wake_waiters(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def add_job(self, job: Job) -> None:
+        cls = self._class(job)
+        with transaction(self._db):
+            self._activate_class(cls)
+            job.id = self._db.execute(
+                "INSERT INTO jobs (blob, archive, owner_ref, first_name, last_name, "
+                "animal_name, animal_type, broken_bone, number_of_results, retries, "
+                "queued, sort_key, class, added) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?, ?)",
+                (
+                    job.blob,
+                    job.archive,
+                    job.owner_ref,
+                    job.first_name,
+                    job.last_name,
+                    job.animal_name,
+                    job.animal_type,
+                    job.broken_bone,
+                    job.number_of_results,
+                    job.retries,
+                    self._sort_key(job),
+                    cls,
+                    job.added,
+                ),
+            ).lastrowid
+            self._touch(job.id)
+        self._wake_waiters()
+
+    def _head(self) -> None | sqlite3.Row:
+        if not isinstance(self.scheduler, FairScheduler):
+            return self._db.execute(
+                "SELECT * FROM jobs WHERE queued ORDER BY sort_key, id LIMIT 1"
+            ).fetchone()
+        # the class with jobs and the smallest pass goes next
+        cls = self._db.execute(
+            "SELECT class FROM classes WHERE EXISTS (SELECT 1 FROM jobs "
+            "WHERE queued AND jobs.class = classes.class) ORDER BY pass, class LIMIT 1"
+        ).fetchone()
+        if cls is None:
+            return None
+        return self._db.execute(
+            "SELECT * FROM jobs WHERE queued AND class = ? "
+            "ORDER BY sort_key, id LIMIT 1",
+            (cls["class"],),
+        ).fetchone()
+
+    def lease_job(self) -> None | Lease:
+        # idle workers poll an empty queue, which must not take the write lock
+        if (
+            not self._db.in_transaction
+            and self._db.execute("SELECT 1 FROM jobs WHERE queued LIMIT 1").fetchone()
+            is None
+        ):
+            return None
+        with transaction(self._db):
+            row = self._head()
+            if row is None:
+                return None
+            job = self._job(row)
+            job.number_of_results -= 1
+            done = job.number_of_results <= 0
+            self._db.execute(
+                "UPDATE jobs SET number_of_results = ?, queued = ? WHERE id = ?",
+                (job.number_of_results, not done, job.id),
+            )
+            if done and isinstance(self.scheduler, FairScheduler):
+                cls = row["class"]
+                (pass_,) = self._db.execute(
+                    "SELECT pass FROM classes WHERE class = ?", (cls,)
+                ).fetchone()
+                self._set_meta("vtime", pass_)
+                self._db.execute(
+                    "UPDATE classes SET pass = ? WHERE class = ?",
+                    (pass_ + 1 / self.scheduler.weights.get(cls, 1.0), cls),
+                )
+            lease = Lease(job, time.time() + self.lease_timeout)
+            self._db.execute(
+                "INSERT INTO leases (token, job_id, deadline) VALUES (?, ?, ?)",
+                (lease.token, job.id, lease.deadline),
+            )
+        return lease
+
+    """Waits until a job is available and leases it.
+
+        Workers of this process are woken in the order they arrived when a job is
+        added here; jobs added by other processes are picked up by polling.
+
+        Args:
+            timeout (float): The maximum number of seconds to wait.
+
+        Returns:
+            Lease | None: The lease on the next job or None if the timeout ran out.
+    """
+
+    async def wait_for_job(self, timeout: float) -> None | Lease:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            lease = self.lease_job()
+            remaining = deadline - loop.time()
+            if lease is not None or remaining <= 0:
+                return lease
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, min(remaining, self.poll_interval))
+            except TimeoutError:
+                pass
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def _revoke(self, token: str) -> None:
+        row = self._db.execute(
+            "DELETE FROM leases WHERE token = ? RETURNING job_id", (token,)
+        ).fetchone()
+        if row is None:
+            return
+        job = self._db.execute(
+            "SELECT queued, class FROM jobs WHERE id = ?", (row["job_id"],)
+        ).fetchone()
+        if job is None:
+            return
+        if not job["queued"]:
+            self._activate_class(job["class"])
+        # put the job at the head of the queue
+        self._db.execute(
+            "UPDATE jobs SET number_of_results = number_of_results + 1, queued = 1, "
+            "sort_key = CASE WHEN queued THEN sort_key ELSE "
+            "(SELECT COALESCE(MIN(sort_key), ?) FROM jobs WHERE queued) - 1 END "
+            "WHERE id = ?",
+            (time.time(), row["job_id"]),
+        )
+
+    def expire_leases(self, now: float | None = None) -> int:
+        if now is None:
+            now = time.time()
+        # every process reaps every second, without leases due it only reads
+        if (
+            not self._db.in_transaction
+            and self._db.execute(
+                "SELECT 1 FROM leases WHERE deadline <= ? LIMIT 1", (now,)
+            ).fetchone()
+            is None
+        ):
+            return 0
+        with transaction(self._db):
+            tokens = [
+                row["token"]
+                for row in self._db.execute(
+                    "SELECT token FROM leases WHERE deadline <= ?", (now,)
+                )
+            ]
+            for token in tokens:
+                self._revoke(token)
+        for _ in tokens:
+            self._wake_waiters()
+        return len(tokens)
+
+    async def reap_leases(self, interval: float = 1.0) -> None:
+        while True:
+            self.expire_leases()
+            self.claim_uploads()
+            await asyncio.sleep(interval)
+
+    async def submit_job(
+        self, id: int, result: bytes, lease_token: str | None = None
+    ) -> None:
+        if not self._exists(id):
+            raise ValueError("Invalid id")
+        blob = await self.blobs.put(result)
+        try:
+            with transaction(self._db):
+                if not self._exists(id):
+                    raise ValueError("Invalid id")
+                if lease_token is not None:
+                    cursor = self._db.execute(
+                        "DELETE FROM leases WHERE token = ? AND job_id = ?",
+                        (lease_token, id),
+                    )
+                    if cursor.rowcount == 0:
+                        raise ValueError("Invalid or expired lease")
+                else:
+                    self._db.execute(
+                        "DELETE FROM leases WHERE token = (SELECT token FROM leases "
+                        "WHERE job_id = ? ORDER BY deadline LIMIT 1)",
+                        (id,),
+                    )
+                self._db.execute(
+                    "INSERT INTO results (job_id, idx, blob) VALUES (?, "
+                    "(SELECT COUNT(*) FROM results WHERE job_id = ?), ?)",
+                    (id, id, blob),
+                )
+                self._db.execute(
+                    "UPDATE jobs SET complete = ((SELECT COUNT(*) FROM results "
+                    "WHERE job_id = ?) >= ?) WHERE id = ?",
+                    (id, self.results_per_image, id),
+                )
+                self._touch(id)
+        except ValueError:
+            self.blobs.release(blob)
+            raise
+
+    async def replace_result(self, id: int, choice: int, result: bytes) -> None:
+        blob = await self.blobs.put(result)
+        try:
+            with transaction(self._db):
+                if not self._exists(id):
+                    raise ValueError("Invalid id")
+                row = self._db.execute(
+                    "SELECT blob FROM results WHERE job_id = ? AND idx = ?",
+                    (id, choice),
+                ).fetchone()
+                if row is None:
+                    raise ValueError("Invalid choice")
+                self._db.execute(
+                    "UPDATE results SET blob = ? WHERE job_id = ? AND idx = ?",
+                    (blob, id, choice),
+                )
+                self.blobs.release(row["blob"])
+                self._touch(id)
+        except ValueError:
+            self.blobs.release(blob)
+            raise
+
+    async def confirm_job(
+        self, id: int, confirm: ConfirmJobEnum, choice: int, image: UploadFile | None
+    ) -> None:
+        override = None
+        if image is not None and confirm == ConfirmJobEnum.confirm:
+            await image.seek(0)
+            override = await self.blobs.put(await image.read())
+        try:
+            with transaction(self._db):
+                row = self._db.execute(
+                    "SELECT * FROM jobs WHERE id = ?", (id,)
+                ).fetchone()
+                if row is None:
+                    raise ValueError("Invalid id")
+                job = self._job(row)
+                results = self._results(id)
+                if confirm == ConfirmJobEnum.confirm and not 0 <= choice < len(results):
+                    raise ValueError("Invalid choice")
+                self._touch(id)
+                # results still in flight are not needed anymore
+                self._db.execute("DELETE FROM leases WHERE job_id = ?", (id,))
+                self._db.execute("DELETE FROM results WHERE job_id = ?", (id,))
+                if confirm == ConfirmJobEnum.confirm:
+                    if override is not None:
+                        self.blobs.release(results[choice])
+                        results[choice] = override
+                    xray = results[choice]
+                    for i, blob in enumerate(results):
+                        if i != choice:
+                            self.blobs.release(blob)
+                    # the carousel takes over the references on both images
+                    self._db.execute("DELETE FROM jobs WHERE id = ?", (id,))
+                    self._db.execute(
+                        "INSERT INTO carousel (xray, original) VALUES (?, ?)",
+                        (xray, job.blob),
+                    )
+                    evicted = self._db.execute(
+                        "DELETE FROM carousel WHERE pos NOT IN (SELECT pos FROM carousel "
+                        "ORDER BY pos DESC LIMIT ?) RETURNING xray, original",
+                        (self.carrousel_size,),
+                    ).fetchall()
+                    # keep the images alive until they are archived
+                    self.blobs.incref(xray)
+                    self.blobs.incref(job.blob)
+                    # the uploads hold their own references, the job's on the
+                    # archive goes with the job
+                    files = self._upload_files(job, xray)
+                    for file in files:
+                        self.blobs.incref(file.blob)
+                    if job.archive is not None:
+                        self.blobs.release(job.archive)
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO uploads (job_id, status, uploaded, "
+                        "files, attempts, error, updated, manifest, deadline) "
+                        "VALUES (?, ?, 0, ?, 0, NULL, ?, ?, ?)",
+                        (
+                            id,
+                            UploadStatus.queued.value,
+                            len(files),
+                            time.time(),
+                            json.dumps(
+                                {
+                                    "owner_ref": job.owner_ref,
+                                    "files": [
+                                        [f.type, f.blob, f.filename] for f in files
+                                    ],
+                                }
+                            ),
+                            time.time() + self.upload_timeout,
+                        ),
+                    )
+                    for pair in evicted:
+                        for blob in pair:
+                            self.blobs.release(blob)
+                elif confirm == ConfirmJobEnum.retry:
+                    for blob in results:
+                        self.blobs.release(blob)
+                    job.retries += 1
+                    cls = self._class(job)
+                    self._db.execute("UPDATE jobs SET queued = 0 WHERE id = ?", (id,))
+                    self._activate_class(cls)
+                    self._db.execute(
+                        "UPDATE jobs SET number_of_results = ?, retries = ?, queued = 1, "
+                        "sort_key = ?, class = ?, added = ?, complete = 0 WHERE id = ?",
+                        (
+                            self.results_per_image,
+                            job.retries,
+                            self._sort_key(job),
+                            cls,
+                            time.time(),
+                            id,
+                        ),
+                    )
+                else:  # confirm == ConfirmJobEnum.cancel
+                    for blob in results:
+                        self.blobs.release(blob)
+                    self.blobs.release(job.blob)
+                    if job.archive is not None:
+                        self.blobs.release(job.archive)
+                    self._db.execute("DELETE FROM jobs WHERE id = ?", (id,))
+            # the override belongs to the carousel now
+            override = None
+        finally:
+            if override is not None:
+                self.blobs.release(override)
+
+        if confirm == ConfirmJobEnum.confirm:
+            try:
+                self.uploads.resume(UploadState(id, job.owner_ref, files), self.blobs)
+                await self._archive(xray, job.blob)
+            finally:
+                self.blobs.release(xray)
+                self.blobs.release(job.blob)
+        elif confirm == ConfirmJobEnum.retry:
+            self._wake_waiters()
+
+    def queued(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM jobs WHERE queued").fetchone()[0]
+
+    def get_pending(self, id: int) -> None | Tuple[Job, Result]:
+        with snapshot(self._db):
+            row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (id,)).fetchone()
+            if row is None:
+                return None
+            return self._job(row), self._results(id)
+
+    def pending(self) -> list[Tuple[Job, Result]]:
+        with snapshot(self._db):
+            jobs = [
+                self._job(row)
+                for row in self._db.execute("SELECT * FROM jobs ORDER BY added, id")
+            ]
+            results: dict[int, Result] = {job.id: [] for job in jobs}
+            for row in self._db.execute(
+                "SELECT job_id, blob FROM results ORDER BY job_id, idx"
+            ):
+                results.get(row["job_id"], []).append(row["blob"])
+        return [(job, results[job.id]) for job in jobs]
+
+    def pending_page(
+        self, filter: PendingFilter, after: None | Cursor, limit: int
+    ) -> Tuple[list[Tuple[Job, Result]], None | Cursor]:
+        clauses = []
+        params: list = []
+        if filter.animal_type is not None:
+            clauses.append("animal_type = ?")
+            params.append(filter.animal_type)
+        if filter.complete is not None:
+            clauses.append("complete = ?")
+            params.append(filter.complete)
+        if filter.added_after is not None:
+            clauses.append("added >= ?")
+            params.append(filter.added_after)
+        if filter.added_before is not None:
+            clauses.append("added <= ?")
+            params.append(filter.added_before)
+        if after is not None:
+            clauses.append("(added, id) > (?, ?)")
+            params.extend(after)
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+        with snapshot(self._db):
+            # one more than asked for tells whether there is a next page
+            jobs = [
+                self._job(row)
+                for row in self._db.execute(
+                    f"SELECT * FROM jobs {where}ORDER BY added, id LIMIT ?",
+                    (*params, limit + 1),
+                )
+            ]
+            results: dict[int, Result] = {job.id: [] for job in jobs[:limit]}
+            for row in self._db.execute(
+                "SELECT job_id, blob FROM results WHERE job_id IN "
+                f"({', '.join('?' * len(results))}) ORDER BY job_id, idx",
+                tuple(results),
+            ):
+                results[row["job_id"]].append(row["blob"])
+        page = [(job, results[job.id]) for job in jobs[:limit]]
+        if len(jobs) <= limit:
+            return page, None
+        last = jobs[limit - 1]
+        return page, (last.added, last.id)
+
+    def _record_upload(self, state: UploadState) -> None:
+        with transaction(self._db):
+            # the pipeline releases the files after a done upload is recorded
+            self._db.execute(
+                "UPDATE uploads SET status = ?, uploaded = ?, files = ?, attempts = ?, "
+                "error = ?, updated = ?, deadline = ?, "
+                "manifest = CASE WHEN ? THEN NULL ELSE manifest END WHERE job_id = ?",
+                (
+                    state.status.value,
+                    state.uploaded,
+                    len(state.files),
+                    state.attempts,
+                    state.error,
+                    state.updated,
+                    state.updated + self.upload_timeout,
+                    state.status == UploadStatus.done,
+                    state.job_id,
+                ),
+            )
+            if state.status == UploadStatus.done:
+                # keep the history of the pipeline, shared by all processes
+                self._db.execute(
+                    "DELETE FROM uploads WHERE status = ? AND job_id NOT IN "
+                    "(SELECT job_id FROM uploads ORDER BY updated DESC LIMIT ?)",
+                    (UploadStatus.done, self.uploads.history),
+                )
+
+    def _resumed(self, row: sqlite3.Row) -> UploadState:
+        manifest = json.loads(row["manifest"])
+        files = [Upload(*file) for file in manifest["files"]]
+        state = UploadState(row["job_id"], manifest["owner_ref"], files)
+        state.uploaded = row["uploaded"]
+        return state
+
+    """Renews the uploads of this process and takes over those nobody renewed.
+
+        Uploads in flight are renewed every call, so the uploads of a process that
+        crashed or was stopped are carried on by the next process calling this once
+        ``upload_timeout`` ran out. Failed uploads wait for ``retry_upload``.
+
+        Args:
+            now (float | None): The current time, defaults to ``time.time()``.
+
+        Returns:
+            int: The number of uploads taken over.
+    """
+
+    def claim_uploads(self, now: float | None = None) -> int:
+        now = time.time() if now is None else now
+        ours = [
+            state.job_id
+            for state in self.uploads.statuses()
+            if state.status not in (UploadStatus.done, UploadStatus.failed)
+        ]
+        # an idle process only reads
+        if (
+            not ours
+            and self._db.execute(
+                f"SELECT 1 FROM uploads WHERE {ABANDONED_UPLOADS} LIMIT 1", (now,)
+            ).fetchone()
+            is None
+        ):
+            return 0
+        with transaction(self._db):
+            self._db.execute(
+                "UPDATE uploads SET deadline = ? WHERE job_id IN "
+                f"({', '.join('?' * len(ours))})",
+                (now + self.upload_timeout, *ours),
+            )
+            rows = self._db.execute(
+                f"UPDATE uploads SET status = ?, deadline = ? WHERE {ABANDONED_UPLOADS} "
+                "RETURNING job_id, uploaded, manifest",
+                (UploadStatus.queued.value, now + self.upload_timeout, now),
+            ).fetchall()
+        # the rows hand their references over to the pipeline
+        for row in rows:
+            self.uploads.resume(self._resumed(row), self.blobs)
+        return len(rows)
+
+    def retry_upload(self, id: int) -> bool:
+        with transaction(self._db):
+            row = self._db.execute(
+                "UPDATE uploads SET status = ?, attempts = 0, deadline = ? "
+                "WHERE job_id = ? AND status = ? AND manifest IS NOT NULL "
+                "RETURNING job_id, uploaded, manifest",
+                (
+                    UploadStatus.queued.value,
+                    time.time() + self.upload_timeout,
+                    id,
+                    UploadStatus.failed.value,
+                ),
+            ).fetchone()
+        if row is None:
+            return False
+        # failed in another process, or before a restart
+        if self.uploads.retry(id) is None:
+            self.uploads.resume(self._resumed(row), self.blobs)
+        return True
+
+    def upload_status(self, id: int) -> None | dict:
+        row = self._db.execute(
+            f"SELECT {UPLOAD_COLUMNS} FROM uploads WHERE job_id = ?", (id,)
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def upload_statuses(self) -> list[dict]:
+        return [
+            dict(row)
+            for row in self._db.execute(
+                f"SELECT {UPLOAD_COLUMNS} FROM uploads ORDER BY updated"
+            )
+        ]
+
+    def get_carousel(self) -> list[Tuple[BlobId, BlobId]]:
+        return [
+            (row["xray"], row["original"])
+            for row in self._db.execute(
+                "SELECT xray, original FROM carousel ORDER BY pos DESC"
+            )
+        ]
+
+    def carousel_item(self, index: int) -> None | Tuple[BlobId, BlobId]:
+        if index < 0:
+            return None
+        # the carousel holds at most carrousel_size rows
+        row = self._db.execute(
+            "SELECT xray, original FROM carousel ORDER BY pos DESC LIMIT 1 OFFSET ?",
+            (index,),
+        ).fetchone()
+        return None if row is None else (row["xray"], row["original"])
+
+    def close(self) -> None:
+        self._db.close()
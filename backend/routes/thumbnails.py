@@ -0,0 +1,163 @@
+import asyncio
+from collections import OrderedDict
+from typing import BinaryIO, Callable
+
+from anyio import CapacityLimiter, to_thread
+from PIL import Image
+
+from .memory import MB
+from .normalize import FORMATS, shrink
+
+MEDIA_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+
+"""Scaled-down renditions of the stored images, for pages that show many of them.
+
+    Renditions are keyed by the id of the image and the size. Ids are content
+    hashes, so a rendition never goes stale: an image that is replaced gets a new
+    id, and :meth:`invalidate` only frees the renditions of the old one early.
+    They are rendered on first request, or ahead of time with :meth:`prefetch`,
+    and kept in least recently used order within ``budget`` bytes. Concurrent
+    requests for the same rendition wait for a single render; if the request
+    rendering it is cancelled, one of them renders it instead.
+
+    Args:
+        sizes (tuple[int, ...]): The longest edges in pixels renditions can be requested at.
+        budget (int): The most bytes of renditions kept.
+        format (str): The codec of the renditions, "jpeg", "webp" or "png".
+        quality (int): The quality of lossy codecs, from 1 to 100.
+        workers (int): How many renditions are rendered at the same time.
+"""
+
+
+class ThumbnailCache:
+    def __init__(
+        self,
+        sizes: tuple[int, ...] = (256, 768),
+        budget: int = 64 * MB,
+        format: str = "webp",
+        quality: int = 80,
+        workers: int = 2,
+    ):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown image format {format}")
+        self.sizes = sorted(sizes)
+        self.budget = budget
+        self.format = format
+        self.media_type = MEDIA_TYPES[format]
+        self.quality = quality
+        self.limiter = CapacityLimiter(workers)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[tuple[str, int], bytes] = OrderedDict()
+        self._rendering: dict[tuple[str, int], asyncio.Future[bytes]] = {}
+        self._prefetching: set[asyncio.Task] = set()
+
+    """Returns a rendition of an image, rendering it if needed.
+
+        Args:
+            open (Callable[[str], BinaryIO]): Opens an image by id, e.g. ``BlobStore.open``.
+            id (str): The id of the image.
+            size (int): One of ``sizes``.
+
+        Returns:
+            bytes: The rendition, encoded with ``format``.
+
+        Raises:
+            ValueError: If the size is not offered.
+            KeyError: If the image does not exist.
+    """
+
+    async def get(self, open: Callable[[str], BinaryIO], id: str, size: int) -> bytes:
+        if size not in self.sizes:
+            raise ValueError(f"Size must be one of {self.sizes}")
+        key = (id, size)
+        data = self._cache.get(key)
+        if data is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return data
+        while key in self._rendering:
+            self.hits += 1
+            rendering = self._rendering[key]
+            try:
+                return await asyncio.shield(rendering)
+            except asyncio.CancelledError:
+                if not rendering.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                # the request rendering it went away, this one takes over
+        self.misses += 1
+        file = open(id)
+        future = asyncio.get_running_loop().create_future()
+        self._rendering[key] = future
+        try:
+            with file:
+                data = await to_thread.run_sync(
+                    self._render, file, size, limiter=self.limiter
+                )
+        except asyncio.CancelledError:
+            # not an error of the rendition, the waiting requests render it instead
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # only the requests waiting for it see the error
+            future.exception()
+            raise
+        finally:
+            del self._rendering[key]
+        future.set_result(data)
+        self._store(key, data)
+        return data
+
+    def _render(self, file: BinaryIO, size: int) -> bytes:
+        return shrink(Image.open(file), size, self.format, self.quality)
+
+    def _store(self, key: tuple[str, int], data: bytes) -> None:
+        self._cache[key] = data
+        self.bytes += len(data)
+        while self.bytes > self.budget and self._cache:
+            _, old = self._cache.popitem(last=False)
+            self.bytes -= len(old)
+
+    """Renders all sizes of an image in the background, e.g. when a result arrives.
+
+        Args:
+            open (Callable[[str], BinaryIO]): Opens an image by id.
+            id (str): The id of the image.
+    """
+
+    def prefetch(self, open: Callable[[str], BinaryIO], id: str) -> None:
+        async def render_all() -> None:
+            for size in self.sizes:
+                if (id, size) not in self._cache:
+                    try:
+                        await self.get(open, id, size)
+                    except Exception:
+                        # the image was dropped or is broken, a request will tell
+                        return
+
+        task = asyncio.create_task(render_all())
+        self._prefetching.add(task)
+        task.add_done_callback(self._prefetching.discard)
+
+    """Drops the renditions of an image, e.g. when it was replaced.
+
+        Args:
+            id (str): The id of the image.
+    """
+
+    def invalidate(self, id: str) -> None:
+        for size in self.sizes:
+            data = self._cache.pop((id, size), None)
+            if data is not None:
+                self.bytes -= len(data)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "thumbnails": len(self._cache),
+            "thumbnail_bytes": self.bytes,
+            "thumbnail_budget": self.budget,
+            "thumbnail_hits": self.hits,
+            "thumbnail_misses": self.misses,
+        }
@@ -0,0 +1,324 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from enum import StrEnum, auto
+from typing import Callable, Protocol
+
+from anyio import to_thread
+
+from ..storage import Storage
+
+
+class UploadStatus(StrEnum):
+    queued = auto()
+    uploading = auto()
+    retrying = auto()
+    done = auto()
+    failed = auto()
+
+
+"""The blob stores the pipeline reads from, it holds a reference per file until uploaded."""
+
+
+class Blobs(Protocol):
+    def incref(self, id: str) -> str: ...
+
+    def release(self, id: str) -> None: ...
+
+    def open(self, id: str): ...
+
+
+"""A file of a job that goes to the storage.
+
+    Attributes:
+        type (str): The folder of the owner, "normal" or "xray".
+        blob (str): The id of the image in the blob store.
+        filename (str): The name of the file in the storage.
+"""
+
+
+class Upload:
+    def __init__(self, type: str, blob: str, filename: str):
+        self.type = type
+        self.blob = blob
+        self.filename = filename
+
+
+"""The progress of the uploads of a confirmed job.
+
+    Attributes:
+        job_id (int): The confirmed job.
+        owner_ref (int | str): The owner the files are uploaded for.
+        files (list[Upload]): The files to upload, in order.
+        uploaded (int): How many of the files are in the storage already.
+        status (UploadStatus): Where the uploads are at.
+        attempts (int): The attempts made on the current file.
+        error (str | None): The last error of the storage, if any.
+        updated (float): When the state last changed, as ``time.time()``.
+"""
+
+
+class UploadState:
+    def __init__(self, job_id: int, owner_ref: int | str, files: list[Upload]):
+        self.job_id = job_id
+        self.owner_ref = owner_ref
+        self.files = files
+        self.uploaded = 0
+        self.status = UploadStatus.queued
+        self.attempts = 0
+        self.error: str | None = None
+        self.updated = time.time()
+        # the blob store holding the files, dropped once uploaded
+        self.blobs: Blobs | None = None
+
+    def as_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "status": self.status.value,
+            "uploaded": self.uploaded,
+            "files": len(self.files),
+            "attempts": self.attempts,
+            "error": self.error,
+            "updated": self.updated,
+        }
+
+
+"""Uploads the images of confirmed jobs to the storage in the background.
+
+    The storage clients block on the network, so the uploads run in worker threads
+    and ``submit`` returns right away. At most ``concurrency`` jobs upload at the
+    same time, the files of a job one after the other. A failed upload is retried
+    after ``backoff`` seconds, doubling up to ``max_backoff``, until ``retries``
+    retries are used up and the job is marked failed. The pipeline holds a
+    reference on every file until it is uploaded; a failed job keeps its files until
+    it is retried with ``retry``.
+
+    The workers are started by the first submit on the running event loop and follow
+    the loop if it changes, uploads that were waiting carry over.
+
+    Args:
+        storage (Storage): The storage system the files are uploaded to.
+        concurrency (int): The maximum number of jobs uploading at the same time.
+        retries (int): How often a failed upload is retried.
+        backoff (float): Seconds before the first retry.
+        max_backoff (float): The longest wait between two retries.
+        history (int): How many finished jobs are kept for status queries.
+        on_change (Callable[[UploadState], None] | None): Called with every state change.
+"""
+
+
+class UploadPipeline:
+    def __init__(
+        self,
+        storage: Storage,
+        concurrency: int = 2,
+        retries: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        history: int = 1000,
+        on_change: Callable[[UploadState], None] | None = None,
+    ):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self.storage = storage
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.history = history
+        self.on_change = on_change
+        self.states: OrderedDict[int, UploadState] = OrderedDict()
+        self._pending: deque[UploadState] = deque()
+        self._active = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._idle: asyncio.Event | None = None
+        self._workers: list[asyncio.Task] = []
+
+    """Queues the files of a confirmed job for upload.
+
+        Args:
+            job_id (int): The confirmed job.
+            owner_ref (int | str): The owner the files are uploaded for.
+            blobs (Blobs): The blob store holding the files.
+            files (list[Upload]): The files to upload, in order.
+
+        Returns:
+            UploadState: The state of the uploads, updated as they progress.
+    """
+
+    def submit(
+        self, job_id: int, owner_ref: int | str, blobs: Blobs, files: list[Upload]
+    ) -> UploadState:
+        state = UploadState(job_id, owner_ref, files)
+        for file in files:
+            blobs.incref(file.blob)
+        state.blobs = blobs
+        self._enqueue(state)
+        return state
+
+    """Takes over the uploads of a confirmed job whose files are referenced already.
+
+        Used to carry on with the uploads of a previous run. A failed state stays
+        failed until retried, any other is queued from the file it was at.
+
+        Args:
+            state (UploadState): The state to carry on with.
+            blobs (Blobs): The blob store holding the files, with a reference on
+                each that the pipeline takes over.
+    """
+
+    def resume(self, state: UploadState, blobs: Blobs) -> None:
+        state.blobs = blobs
+        if state.status == UploadStatus.failed:
+            self.states[state.job_id] = state
+            self.states.move_to_end(state.job_id)
+            self._changed(state)
+            return
+        state.status = UploadStatus.queued
+        self._enqueue(state)
+
+    """Queues the uploads of a failed job again, with fresh attempts.
+
+        Args:
+            job_id (int): The confirmed job.
+
+        Returns:
+            UploadState | None: The state of the uploads, None if they did not fail.
+    """
+
+    def retry(self, job_id: int) -> UploadState | None:
+        state = self.states.get(job_id)
+        if state is None or state.status != UploadStatus.failed:
+            return None
+        state.status = UploadStatus.queued
+        state.attempts = 0
+        self._enqueue(state)
+        return state
+
+    def _enqueue(self, state: UploadState) -> None:
+        self.states[state.job_id] = state
+        self.states.move_to_end(state.job_id)
+        self._pending.append(state)
+        self._changed(state)
+        self._start()
+        self._idle.clear()
+        self._wakeup.set()
+
+    def status(self, job_id: int) -> UploadState | None:
+        return self.states.get(job_id)
+
+    def statuses(self) -> list[UploadState]:
+        return list(self.states.values())
+
+    def _changed(self, state: UploadState) -> None:
+        state.updated = time.time()
+        if self.on_change is not None:
+            self.on_change(state)
+
+    def _start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if loop is self._loop and all(not w.done() for w in self._workers):
+            return
+        for worker in self._workers:
+            worker.cancel()
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._active = 0
+        self._workers = [
+            loop.create_task(self._work()) for _ in range(self.concurrency)
+        ]
+        if self._pending:
+            self._wakeup.set()
+        else:
+            self._idle.set()
+
+    async def _work(self) -> None:
+        while True:
+            while not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            state = self._pending.popleft()
+            self._active += 1
+            try:
+                await self._upload(state)
+            except asyncio.CancelledError:
+                # shut down or moved to another loop, start over from the current file
+                state.status = UploadStatus.queued
+                self._pending.appendleft(state)
+                raise
+            finally:
+                self._active -= 1
+                if not self._pending and not self._active:
+                    self._idle.set()
+
+    async def _upload(self, state: UploadState) -> None:
+        while state.uploaded < len(state.files):
+            file = state.files[state.uploaded]
+            state.status = UploadStatus.uploading
+            state.attempts += 1
+            self._changed(state)
+            try:
+                await to_thread.run_sync(self._upload_file, state, file)
+            except Exception as e:
+                state.error = f"{type(e).__name__}: {e}"
+                if state.attempts > self.retries:
+                    state.status = UploadStatus.failed
+                    break
+                state.status = UploadStatus.retrying
+                self._changed(state)
+                delay = self.backoff * 2 ** (state.attempts - 1)
+                await asyncio.sleep(min(delay, self.max_backoff))
+                continue
+            state.uploaded += 1
+            state.attempts = 0
+            state.error = None
+        else:
+            state.status = UploadStatus.done
+        self._finish(state)
+
+    def _upload_file(self, state: UploadState, file: Upload) -> None:
+        with state.blobs.open(file.blob) as f:
+            self.storage.upload_file(state.owner_ref, file.type, f, file.filename)
+
+    def _finish(self, state: UploadState) -> None:
+        # recorded before the files go, so a crash in between leaks rather than
+        # uploading twice
+        self._changed(state)
+        if state.status == UploadStatus.done:
+            for file in state.files:
+                state.blobs.release(file.blob)
+            state.blobs = None
+        # forget the oldest uploaded jobs, the others are still needed
+        excess = len(self.states) - self.history
+        for job_id, old in list(self.states.items()):
+            if excess <= 0:
+                break
+            if old.status == UploadStatus.done:
+                del self.states[job_id]
+                excess -= 1
+
+    """Waits until all submitted uploads are done or failed."""
+
+    async def join(self) -> None:
+        if self._pending or self._active:
+            self._start()
+            await self._idle.wait()
+
+    """Waits for the outstanding uploads up to ``timeout`` seconds and stops the workers.
+
+        Uploads that did not finish in time stay queued in the state ``queued``.
+    """
+
+    async def aclose(self, timeout: float = 30.0) -> None:
+        if self._pending or self._active:
+            try:
+                await asyncio.wait_for(self.join(), timeout)
+            except TimeoutError:
+                pass
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._loop = None
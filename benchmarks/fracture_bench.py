@@ -0,0 +1,233 @@
+"""Benchmarks of the fracture tool against its old implementations.
+
+Places overlays of several sizes on a bright image whose nearest dark pixels lie
+close to the edge of the overlay, so both color searches walk most of the rings, and
+reports the time per call. Then composites a fracture onto ROIs of several sizes
+with the banded kernel and the old full-ROI float64 one and reports the time and the
+peak memory allocated per call. Run from the repository root with
+``python -m benchmarks.fracture_bench``.
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from backend.routes.fracture_tool4 import apply_gradient_to_mask, sample_color_gradient
+
+
+def sample_color_gradient_loop(img: np.ndarray, mask: np.ndarray, x: int, y: int):
+    # the implementation before the search was vectorized, kept as the reference
+    gray_thresh = 120
+    x = x % img.shape[1]
+    y = y % img.shape[0]
+    h, w = mask.shape
+    center_x = x + w // 2
+    center_y = y + h // 2
+    max_radius = max(h, w) // 2
+    alpha_mask = mask / 255.0
+
+    sample1 = sample2 = None
+    dir_vector = np.array([0, 0])
+
+    for r in range(1, max_radius):
+        for angle in np.linspace(0, 2 * np.pi, 64):
+            dx = int(round(r * np.cos(angle)))
+            dy = int(round(r * np.sin(angle)))
+            sx = center_x + dx
+            sy = center_y + dy
+
+            if 0 <= sx < img.shape[1] and 0 <= sy < img.shape[0]:
+                if np.mean(img[sy, sx]) < gray_thresh:
+                    sample1 = (sx, sy)
+                    dir_vector = np.array([dx, dy])
+                    break
+        if sample1 is not None:
+            break
+
+    if sample1 is None:
+        return img[50, 50].astype(np.float32), img[1, 1].astype(np.float32), (1, 0)
+
+    for r in range(1, max_radius):
+        dx, dy = -dir_vector * r
+        sx = center_x + int(round(dx))
+        sy = center_y + int(round(dy))
+
+        mask_y = sy - y
+        mask_x = sx - x
+        if (
+            0 <= sx < img.shape[1]
+            and 0 <= sy < img.shape[0]
+            and 0 <= mask_x < alpha_mask.shape[1]
+            and 0 <= mask_y < alpha_mask.shape[0]
+        ):
+            if alpha_mask[mask_y, mask_x] > 0 and np.mean(img[sy, sx]) < gray_thresh:
+                sample2 = (sx, sy)
+                break
+
+    if sample2 is None:
+        return (
+            img[1, 1].astype(np.float32),
+            img[sample1[1], sample1[0]].astype(np.float32),
+            dir_vector,
+        )
+
+    color1 = img[sample1[1], sample1[0]].astype(np.float32)
+    color2 = img[sample2[1], sample2[0]].astype(np.float32)
+    gradient_direction = np.array(sample2) - np.array(sample1)
+
+    return color1, color2, gradient_direction
+
+
+def apply_gradient_to_mask_float64(
+    img: np.ndarray,
+    x: int,
+    y: int,
+    overlay: np.ndarray,
+    gradient_dir: np.ndarray,
+    color1: np.ndarray,
+    color2: np.ndarray,
+    noise_std: int,
+):
+    # the implementation before the compositing was banded, kept as the reference,
+    # without its debug prints
+    UPPER_TRESH_MASK = np.array(255)
+    LOWER_TRESH_MASK = np.array(90)
+    x = x % img.shape[1]
+    y = y % img.shape[0]
+    x = int(x)
+    y = int(y)
+    h, w = overlay.shape[:2]
+
+    if np.allclose(gradient_dir, 0):
+        gradient_dir = np.array([1, 0], dtype=float)
+
+    start_x = max(0, x)
+    start_y = max(0, y)
+    end_x = min(x + w, img.shape[1])
+    end_y = min(y + h, img.shape[0])
+
+    roi = img[start_y:end_y, start_x:end_x]
+    overlay = overlay[(start_y - y) : (end_y - y), (start_x - x) : (end_x - x)]
+
+    if overlay.shape[0] == 0 or overlay.shape[1] == 0:
+        return img
+
+    alpha = overlay[:, :, 3] / 255.0
+    mask = np.repeat(alpha[..., np.newaxis], 3, axis=2)
+
+    gray_roi = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+    bone_mask = cv2.inRange(gray_roi, LOWER_TRESH_MASK, UPPER_TRESH_MASK) / 255.0
+
+    kernel = np.ones((3, 3), np.uint8)
+    bone_mask_expanded = (
+        cv2.dilate((bone_mask * 255).astype(np.uint8), kernel, iterations=1) / 255.0
+    )
+    bone_mask_3ch = np.repeat(bone_mask_expanded[..., np.newaxis], 3, axis=2)
+
+    combined_mask = mask * bone_mask_3ch
+
+    grad_norm = gradient_dir / (np.linalg.norm(gradient_dir) + 1e-6)
+    Y, X = np.meshgrid(
+        np.arange(overlay.shape[0]), np.arange(overlay.shape[1]), indexing="ij"
+    )
+    rel_coords = np.stack(
+        (X - overlay.shape[1] // 2, Y - overlay.shape[0] // 2), axis=-1
+    )
+    projections = rel_coords @ grad_norm
+
+    mask_nonzero = alpha > 0
+    if np.any(mask_nonzero):
+        min_proj = np.min(projections[mask_nonzero])
+        max_proj = np.max(projections[mask_nonzero])
+    else:
+        min_proj, max_proj = 0.0, 1.0
+
+    norm_proj = (projections - min_proj) / (max_proj - min_proj + 1e-6)
+    norm_proj = np.clip(norm_proj, 0, 1)
+
+    gradient = (1 - norm_proj[..., None]) * color1 + norm_proj[..., None] * color2
+    gradient = gradient.astype(np.uint8)
+    noise = np.random.normal(0, noise_std, gradient.shape).astype(np.int16)
+    gradient_noisy = np.clip(gradient.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+    blended = (1 - combined_mask) * roi + combined_mask * gradient_noisy
+
+    img[start_y:end_y, start_x:end_x] = blended.astype(np.uint8)
+    return img
+
+
+def make_case(size: int) -> tuple[np.ndarray, np.ndarray, int, int]:
+    # bright bone with dark spots just inside the edge of the overlay
+    img = np.full((size * 2, size * 2, 3), 200, dtype=np.uint8)
+    center = size
+    edge = size // 2 - 3
+    img[center, center + edge] = 40
+    img[center, center - edge] = 60
+    mask = np.full((size, size), 255, dtype=np.uint8)
+    return img, mask, center - size // 2, center - size // 2
+
+
+def timed(fn, args, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.perf_counter() - start) / repeat
+
+
+def make_composite(size: int) -> tuple:
+    # bone everywhere and a crack along the diagonal with soft edges
+    rng = np.random.default_rng(0)
+    img = rng.integers(90, 256, (size, size, 3), dtype=np.uint8)
+    yy, xx = np.mgrid[0:size, 0:size]
+    distance = np.abs(xx - yy).astype(np.float64)
+    alpha = np.clip(255 - distance * 4, 0, 255).astype(np.uint8)
+    overlay = np.dstack([np.full((size, size, 3), 30, np.uint8), alpha])
+    colors = np.array([60, 70, 80], np.float32), np.array([200, 190, 180], np.float32)
+    return img, 0, 0, overlay, np.array([3, 4]), *colors, 10
+
+
+def profiled(fn, args, repeat: int) -> tuple[float, int]:
+    # time per call and peak memory allocated by numpy and cv2 in a call
+    img, *rest = args
+    seconds = timed(lambda: fn(img.copy(), *rest), (), repeat)
+    copy = img.copy()
+    tracemalloc.start()
+    fn(copy, *rest)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 128, 256, 512])
+    parser.add_argument("--rois", type=int, nargs="+", default=[500, 1000, 2000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for size in args.rois:
+        case = make_composite(size)
+        old, old_peak = profiled(apply_gradient_to_mask_float64, case, args.repeat)
+        new, new_peak = profiled(apply_gradient_to_mask, case, args.repeat)
+        print(
+            f"roi {size:4d}px  float64 {old * 1e3:8.2f} ms {old_peak / 2**20:7.1f} MB  "
+            f"banded {new * 1e3:7.2f} ms {new_peak / 2**20:6.1f} MB  "
+            f"{old / new:4.1f}x time {old_peak / new_peak:5.1f}x memory"
+        )
+    for size in args.sizes:
+        case = make_case(size)
+        expected = sample_color_gradient_loop(*case)
+        actual = sample_color_gradient(*case)
+        assert all(np.array_equal(a, b) for a, b in zip(expected, actual))
+        old = timed(sample_color_gradient_loop, case, args.repeat)
+        new = timed(sample_color_gradient, case, args.repeat)
+        print(
+            f"overlay {size:4d}px  loop {old * 1e3:8.2f} ms  "
+            f"vectorized {new * 1e3:7.2f} ms  {old / new:6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
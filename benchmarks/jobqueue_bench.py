@@ -0,0 +1,77 @@
+"""Micro-benchmark comparing the indexed JobDeque with the old list based queue.
+
+Run from the repository root with ``python -m benchmarks.jobqueue_bench``.
+"""
+
+import argparse
+import random
+import time
+
+from backend.routes.jobqueue import Job, JobDeque
+
+
+def make_jobs(n: int) -> list[Job]:
+    return [
+        Job(
+            blob="",
+            owner_ref=i,
+            first_name="Bench",
+            last_name="Mark",
+            animal_name=f"Teddy {i}",
+        )
+        for i in range(n)
+    ]
+
+
+def run_list(jobs: list[Job], cancel: list[Job], retry: list[Job]) -> float:
+    start = time.perf_counter()
+    queue: list[Job] = []
+    for job in jobs:
+        queue.insert(0, job)
+    for job in cancel:
+        if job in queue:
+            queue.remove(job)
+    for job in retry:
+        if job in queue:
+            queue.remove(job)
+        queue.insert(0, job)
+    while queue:
+        queue.pop()
+    return time.perf_counter() - start
+
+
+def run_deque(jobs: list[Job], cancel: list[Job], retry: list[Job]) -> float:
+    start = time.perf_counter()
+    queue = JobDeque()
+    for job in jobs:
+        queue.append(job)
+    for job in cancel:
+        queue.discard(job.id)
+    for job in retry:
+        queue.append(job)
+    while queue:
+        queue.popleft()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=10_000, help="number of jobs")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    jobs = make_jobs(args.n)
+    # cancel and retry a tenth of the jobs each, like a busy admin page would
+    cancel = rng.sample(jobs, args.n // 10)
+    retry = rng.sample(jobs, args.n // 10)
+
+    t_list = min(run_list(jobs, cancel, retry) for _ in range(args.repeat))
+    t_deque = min(run_deque(jobs, cancel, retry) for _ in range(args.repeat))
+    print(f"jobs: {args.n}")
+    print(f"list:     {t_list * 1000:9.2f} ms")
+    print(f"JobDeque: {t_deque * 1000:9.2f} ms  ({t_list / t_deque:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
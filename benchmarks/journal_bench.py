@@ -0,0 +1,65 @@
+"""Benchmark for recovering a JobQueue from its journal.
+
+Journals 1k uploads with results and measures how long recovery takes, with and
+without compaction into a snapshot. Run from the repository root with
+``python -m benchmarks.journal_bench``.
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from backend.routes.jobqueue import Job, JobQueue
+from backend.routes.journal import Journal
+
+
+async def fill(directory: str, n: int, size: int, compact_every: int) -> float:
+    job_queue = JobQueue(1, 10, None, journal=Journal(directory, compact_every))
+    await job_queue.recover()
+    start = time.perf_counter()
+    for i in range(n):
+        job = Job(
+            blob=await job_queue.blobs.put(os.urandom(size)),
+            owner_ref=i,
+            first_name="Bench",
+            last_name="Mark",
+            animal_name=f"Teddy {i}",
+        )
+        job_queue.add_job(job)
+        lease = job_queue.lease_job()
+        await job_queue.submit_job(lease.job.id, os.urandom(size), lease.token)
+    elapsed = time.perf_counter() - start
+    job_queue.journal.close()
+    return elapsed
+
+
+async def recover(directory: str, compact_every: int) -> tuple[float, int]:
+    job_queue = JobQueue(1, 10, None, journal=Journal(directory, compact_every))
+    start = time.perf_counter()
+    await job_queue.recover()
+    elapsed = time.perf_counter() - start
+    job_queue.journal.close()
+    return elapsed, len(job_queue.awaiting_approval)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=1000, help="number of jobs")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="image bytes")
+    args = parser.parse_args()
+
+    for compact_every in [10 * args.n, 1000]:
+        with tempfile.TemporaryDirectory() as directory:
+            t_fill = await fill(directory, args.n, args.size, compact_every)
+            t_recover, jobs = await recover(directory, compact_every)
+        print(
+            f"compact every {compact_every:6d}: journaling {args.n} jobs took "
+            f"{t_fill * 1000:8.1f} ms, recovering {jobs} jobs took "
+            f"{t_recover * 1000:8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
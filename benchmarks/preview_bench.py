@@ -0,0 +1,79 @@
+"""Benchmark of fracture previews against painting at full resolution.
+
+Places a registered stencil on a phone-sized X-ray, once as a preview on the
+scaled-down copy, with the first preview decoding the image, and once at full
+resolution with the PNG encode ``/apply_fracture_queue`` does, and reports the time
+per call. Run from the repository root with ``python -m benchmarks.preview_bench``.
+"""
+
+import argparse
+import hashlib
+import time
+
+import cv2
+import numpy as np
+
+from backend.routes.fracture_tool4 import (
+    overlays,
+    place_fracture,
+    preview_fracture,
+    previews,
+)
+
+
+def make_xray(width: int, height: int) -> bytes:
+    # bright bones on a dark background with some grain, as a JPEG from a phone
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:height, 0:width]
+    bones = ((xx // 300 + yy // 400) % 3 == 0) * 140
+    gray = 40 + bones + rng.integers(0, 30, (height, width))
+    img = np.repeat(gray[..., None], 3, axis=2).astype(np.uint8)
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+def make_stencil(size: int) -> bytes:
+    yy, xx = np.mgrid[0:size, 0:size]
+    alpha = (np.abs(xx - yy - (xx // 7) % 3) < size // 8) * 255
+    overlay = np.dstack([np.full((size, size, 3), 30), alpha]).astype(np.uint8)
+    return cv2.imencode(".png", overlay)[1].tobytes()
+
+
+def full_resolution(image: bytes, overlay_id: str, x: int, y: int) -> bytes:
+    img = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    place_fracture(img, overlays.get(overlay_id, 1.0), x, y, 10)
+    return cv2.imencode(".png", img)[1].tobytes()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=4032)
+    parser.add_argument("--height", type=int, default=3024)
+    parser.add_argument("--stencil", type=int, default=600)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    image = make_xray(args.width, args.height)
+    id = hashlib.sha256(image).hexdigest()
+    overlay_id = overlays.register(make_stencil(args.stencil))
+    # dragged across the image
+    xs = np.linspace(0, args.width - args.stencil, args.repeat).astype(int)
+    y = (args.height - args.stencil) // 2
+
+    start = time.perf_counter()
+    preview_fracture(id, image, overlay_id, None, int(xs[0]), y, 1.0, 10)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    for x in xs:
+        preview_fracture(id, image, overlay_id, None, int(x), y, 1.0, 10)
+    warm = (time.perf_counter() - start) / args.repeat
+    start = time.perf_counter()
+    full_resolution(image, overlay_id, int(xs[0]), y)
+    full = time.perf_counter() - start
+    print(
+        f"{args.width}x{args.height} to {previews.max_edge}px {previews.format}  "
+        f"first preview {cold * 1e3:7.1f} ms  preview {warm * 1e3:6.1f} ms  "
+        f"full resolution {full * 1e3:7.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
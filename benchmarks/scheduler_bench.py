@@ -0,0 +1,94 @@
+"""Benchmark of the scheduling policies under a mixed workload.
+
+Keeps a backlog of pending jobs (a fifth with broken bones, a tenth retried, a
+handful of animal types) while uploads, dispatches and cancellations interleave,
+and reports the time per operation and the mean wait, in dispatches, per class.
+Run from the repository root with ``python -m benchmarks.scheduler_bench``.
+"""
+
+import argparse
+import random
+import time
+from collections import defaultdict
+
+from backend.routes.jobqueue import Job
+from backend.routes.scheduler import create_scheduler
+
+ANIMAL_TYPES = ["bear", "giraffe", "minion", "pikachu", "other"]
+
+
+def make_job(rng: random.Random) -> Job:
+    job = Job(
+        blob="",
+        owner_ref=0,
+        first_name="Bench",
+        last_name="Mark",
+        animal_name="Teddy",
+        animal_type=rng.choice(ANIMAL_TYPES),
+        broken_bone=rng.random() < 0.2,
+    )
+    job.retries = int(rng.random() < 0.1)
+    return job
+
+
+def job_class(job: Job) -> str:
+    if job.retries:
+        return "retry"
+    if job.broken_bone:
+        return "broken_bone"
+    return "other"
+
+
+def run(policy: str, backlog: int, operations: int, seed: int) -> None:
+    rng = random.Random(seed)
+    scheduler = create_scheduler(
+        policy,
+        broken_bone_boost=120,
+        retry_boost=300,
+        animal_type_boosts={"pikachu": 60},
+        weights={"retry": 4, "broken_bone": 2},
+    )
+    jobs = [make_job(rng) for _ in range(backlog + operations)]
+    actions = [rng.random() for _ in range(operations)]
+    for job in jobs[:backlog]:
+        scheduler.append(job)
+    queued_at = {job.id: 0 for job in jobs[:backlog]}
+    waits: dict[str, list[int]] = defaultdict(list)
+    next_job = backlog
+    dispatches = 0
+
+    start = time.perf_counter()
+    for action in actions:
+        if action < 0.45:
+            job = jobs[next_job]
+            next_job += 1
+            scheduler.append(job)
+            queued_at[job.id] = dispatches
+        elif action < 0.95:
+            job = scheduler.popleft()
+            waits[job_class(job)].append(dispatches - queued_at.pop(job.id))
+            dispatches += 1
+        else:
+            scheduler.discard(jobs[rng.randrange(next_job)].id)
+    elapsed = time.perf_counter() - start
+
+    mean_waits = ", ".join(
+        f"{cls} {sum(w) / len(w):7.1f}" for cls, w in sorted(waits.items())
+    )
+    print(
+        f"{policy:8s} {elapsed / operations * 1e6:6.2f} us/op  mean wait: {mean_waits}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backlog", type=int, default=10_000)
+    parser.add_argument("--operations", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for policy in ["fifo", "priority", "fair"]:
+        run(policy, args.backlog, args.operations, args.seed)
+
+
+if __name__ == "__main__":
+    main()
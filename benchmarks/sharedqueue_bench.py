@@ -0,0 +1,140 @@
+"""Throughput benchmark of the SQLite job queue shared by several worker processes.
+
+Every process opens its own SQLiteJobQueue on the same database, like the worker
+processes of the API do, and runs complete job cycles: upload, lease, submit the
+results and confirm. Reports the jobs per second for 1, 2, 4 and 8 processes.
+Run from the repository root with ``python -m benchmarks.sharedqueue_bench``.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+from backend.routes.jobqueue import ConfirmJobEnum, Job
+from backend.routes.sqlitequeue import SQLiteJobQueue
+from backend.storage import Storage
+
+
+class NullStorage(Storage):
+    def create_storage_for_user(self) -> str:
+        return ""
+
+    def upload_file(self, user_id, type, file_path, filename):
+        file_path.read()
+
+
+class Images:
+    """Distinct images without paying for os.urandom on every one."""
+
+    def __init__(self, size: int):
+        self.payload = os.urandom(size)
+        self.count = 0
+
+    def next(self) -> bytes:
+        self.count += 1
+        return b"%d:%d:" % (os.getpid(), self.count) + self.payload
+
+
+async def process(queue: SQLiteJobQueue, images: Images, results: int) -> int:
+    # the leases can be for jobs uploaded by any process
+    leases = queue.lease_jobs(results)
+    for lease in leases:
+        await queue.submit_job(lease.job.id, images.next(), lease.token)
+        pending = queue.get_pending(lease.job.id)
+        if pending is not None and len(pending[1]) == results:
+            try:
+                await queue.confirm_job(lease.job.id, ConfirmJobEnum.confirm, 0, None)
+            except ValueError:
+                pass  # confirmed by another process in the meantime
+    return len(leases)
+
+
+async def cycles(directory: str, n: int, size: int, results: int) -> None:
+    queue = SQLiteJobQueue(
+        os.path.join(directory, "queue.sqlite3"),
+        os.path.join(directory, "blobs"),
+        results,
+        10,
+        NullStorage(),
+    )
+    images = Images(size)
+    for i in range(n):
+        job = Job(
+            blob=await queue.blobs.put(images.next()),
+            owner_ref=i,
+            first_name="Bench",
+            last_name="Mark",
+            animal_name=f"Teddy {i}",
+            number_of_results=results,
+        )
+        queue.add_job(job)
+        await process(queue, images, results)
+    while await process(queue, images, results):
+        pass
+    await queue.uploads.aclose()
+    queue.close()
+
+
+def worker(directory: str, n: int, size: int, results: int, barrier) -> None:
+    barrier.wait()
+    asyncio.run(cycles(directory, n, size, results))
+
+
+def run(processes: int, n: int, size: int, results: int) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        # create the database up front, so the workers don't race for it
+        SQLiteJobQueue(
+            os.path.join(directory, "queue.sqlite3"),
+            os.path.join(directory, "blobs"),
+            results,
+            10,
+            NullStorage(),
+        ).close()
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(processes + 1)
+        workers = [
+            context.Process(
+                target=worker,
+                args=(directory, n // processes, size, results, barrier),
+            )
+            for _ in range(processes)
+        ]
+        for p in workers:
+            p.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for p in workers:
+            p.join()
+        elapsed = time.perf_counter() - start
+        queue = SQLiteJobQueue(
+            os.path.join(directory, "queue.sqlite3"),
+            os.path.join(directory, "blobs"),
+            results,
+            10,
+            NullStorage(),
+        )
+        assert queue.pending() == [], "jobs left unconfirmed"
+        queue.close()
+        return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=2000, help="number of jobs")
+    parser.add_argument("--size", type=int, default=256 * 1024, help="image bytes")
+    parser.add_argument("--results", type=int, default=3, help="results per image")
+    args = parser.parse_args()
+
+    for processes in [1, 2, 4, 8]:
+        elapsed = run(processes, args.n, args.size, args.results)
+        print(
+            f"{processes} worker(s): {args.n} jobs in {elapsed * 1000:8.1f} ms, "
+            f"{args.n / elapsed:8.1f} jobs/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import hashlib
+import io
+
+import pytest
+from fastapi import UploadFile
+
+from backend.routes.blobstore import BlobStore, BlobTooLarge, read_chunks
+from backend.routes.memory import MemoryAccountant
+
+
+@pytest.mark.anyio
+class TestBlobStore:
+    async def test_deduplicate(self, tmp_path):
+        blobs = BlobStore(tmp_path)
+        id = await blobs.put(b"teddy")
+        assert id == hashlib.sha256(b"teddy").hexdigest()
+        assert await blobs.put(b"teddy") == id
+        assert len(blobs) == 1
+        assert blobs.stats().items() >= {"blobs": 1, "bytes": 5, "refs": 2}.items()
+        blobs.release(id)
+        assert blobs.read(id) == b"teddy"
+        blobs.release(id)
+        assert id not in blobs
+        with pytest.raises(KeyError):
+            blobs.view(id)
+
+    async def test_spill_threshold(self, tmp_path):
+        blobs = BlobStore(tmp_path, MemoryAccountant(spill_threshold=10))
+        id = await blobs.put(b"x" * 11)
+        assert blobs.memory.resident == 0
+        assert blobs.memory.spilled == 11
+        assert (tmp_path / id[:2] / id).read_bytes() == b"x" * 11
+        view = blobs.view(id)
+        with blobs.open(id) as f:
+            assert f.read() == b"x" * 11
+        # a view handed out earlier survives the release of the blob
+        blobs.release(id)
+        assert not (tmp_path / id[:2] / id).exists()
+        assert view == b"x" * 11
+        assert blobs.memory.spilled == 0
+
+    async def test_path(self, tmp_path):
+        blobs = BlobStore(tmp_path, MemoryAccountant(spill_threshold=10))
+        small = await blobs.put(b"x")
+        large = await blobs.put(b"x" * 11)
+        # only spilled blobs can be sent as files
+        assert blobs.path(small) is None
+        assert blobs.path(large) == tmp_path / large[:2] / large
+        blobs.release(large)
+        with pytest.raises(KeyError):
+            blobs.path(large)
+
+    async def test_spill_least_recently_used(self, tmp_path):
+        blobs = BlobStore(tmp_path, MemoryAccountant(budget=250, spill_threshold=200))
+        first = await blobs.put(b"a" * 100)
+        second = await blobs.put(b"b" * 100)
+        blobs.view(first)
+        await blobs.put(b"c" * 100)
+        assert blobs.memory.resident == 200
+        assert (tmp_path / second[:2] / second).exists()
+        assert not (tmp_path / first[:2] / first).exists()
+        assert blobs.read(second) == b"b" * 100
+
+    async def test_stale_blobs_removed(self, tmp_path):
+        id = await BlobStore(tmp_path, MemoryAccountant(spill_threshold=0)).put(b"x")
+        (tmp_path / "keep.txt").write_text("not a blob")
+        BlobStore(tmp_path)
+        assert not (tmp_path / id[:2] / id).exists()
+        assert (tmp_path / "keep.txt").exists()
+
+    async def test_put_stream(self, tmp_path):
+        blobs = BlobStore(tmp_path, MemoryAccountant(spill_threshold=10))
+        small = await blobs.put_stream(read_chunks(UploadFile(io.BytesIO(b"teddy")), 2))
+        assert small == hashlib.sha256(b"teddy").hexdigest()
+        assert blobs.memory.resident == 5
+        # larger content goes to a file while it streams in
+        large = await blobs.put_stream(
+            read_chunks(UploadFile(io.BytesIO(b"x" * 25)), 4)
+        )
+        assert blobs.memory.spilled == 25
+        assert (tmp_path / large[:2] / large).read_bytes() == b"x" * 25
+        assert (
+            await blobs.put_stream(read_chunks(UploadFile(io.BytesIO(b"x" * 25))))
+            == large
+        )
+        assert blobs.stats()["refs"] == 3
+        assert list(tmp_path.glob("*.tmp")) == []
+
+    async def test_put_stream_limit(self, tmp_path):
+        blobs = BlobStore(tmp_path, MemoryAccountant(spill_threshold=10))
+        file = UploadFile(io.BytesIO(b"x" * 100))
+        with pytest.raises(BlobTooLarge):
+            await blobs.put_stream(read_chunks(file, 8), limit=20)
+        # the rest of the upload is not read anymore
+        assert file.file.tell() == 24
+        assert len(blobs) == 0
+        assert list(tmp_path.glob("*.tmp")) == []
@@ -0,0 +1,34 @@
+import io
+import zipfile
+
+from backend.routes.bundles import BundleCache, bundle
+
+
+def test_bundle():
+    data = bundle(b"x" * 100, memoryview(b"o" * 50))
+    with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+        assert zip_file.read("xray.png") == b"x" * 100
+        assert zip_file.read("original.png") == b"o" * 50
+        # already compressed images are not compressed again
+        assert {info.compress_type for info in zip_file.infolist()} == {
+            zipfile.ZIP_STORED
+        }
+
+
+def test_cache():
+    cache = BundleCache(budget=250)
+    assert cache.get("a", None) is None
+    cache.put("a", None, b"a" * 100)
+    cache.put("a", 256, b"t" * 10)
+    cache.put("b", None, b"b" * 100)
+    assert cache.get("a", None) == b"a" * 100
+    # the least recently used bundle made room for the new one
+    cache.put("c", None, b"c" * 100)
+    assert cache.get("b", None) is None
+    assert cache.stats()["bundle_bytes"] == 200
+    # bundles of items that left the carousel are dropped
+    cache.retain(["c"])
+    assert cache.get("a", None) is None
+    assert cache.get("c", None) == b"c" * 100
+    assert cache.stats()["bundles"] == 1
+    assert cache.stats()["bundle_bytes"] == 100
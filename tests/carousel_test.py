@@ -0,0 +1,57 @@
+import hashlib
+
+import pytest
+
+from backend.routes.carousel import RECORD, CarouselArchive, CarouselRing
+
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_ring():
+    ring = CarouselRing(3)
+    assert list(ring) == []
+    assert ring.push(("x1", "o1")) is None
+    assert ring.push(("x2", "o2")) is None
+    assert ring.push(("x3", "o3")) is None
+    assert list(ring) == [("x3", "o3"), ("x2", "o2"), ("x1", "o1")]
+    # the oldest item makes room once all slots are taken
+    assert ring.push(("x4", "o4")) == ("x1", "o1")
+    assert len(ring) == 3
+    assert ring[0] == ("x4", "o4")
+    assert ring[2] == ("x2", "o2")
+    with pytest.raises(IndexError):
+        ring[3]
+    with pytest.raises(ValueError):
+        CarouselRing(0)
+
+
+def test_archive(tmp_path):
+    archive = CarouselArchive(tmp_path)
+    assert len(archive) == 0
+    assert archive.entries(0, 10) == []
+    items = [(b"xray %d" % i, b"original %d" % i) for i in range(5)]
+    for i, (xray, original) in enumerate(items):
+        archive.append(digest(xray), digest(original), xray, original, added=100.0 + i)
+    assert len(archive) == 5
+    page = archive.entries(1, 2)
+    assert page == [
+        (3, digest(b"xray 3"), digest(b"original 3"), 103.0),
+        (2, digest(b"xray 2"), digest(b"original 2"), 102.0),
+    ]
+    assert [entry[0] for entry in archive.entries(3, 10)] == [1, 0]
+    assert archive.entries(5, 10) == []
+    assert archive.entry(0)[1] == digest(b"xray 0")
+    assert archive.entry(5) is None
+    assert archive.entry(-1) is None
+    assert archive.read(digest(b"original 4")) == b"original 4"
+    # a record torn by a crash is dropped when the archive is opened again
+    with open(tmp_path / CarouselArchive.INDEX, "ab") as f:
+        f.write(b"torn")
+    reopened = CarouselArchive(tmp_path)
+    assert len(reopened) == 5
+    reopened.append(digest(b"xray 0"), digest(b"original 0"), b"xray 0", b"original 0")
+    assert reopened.entry(5)[1:3] == (digest(b"xray 0"), digest(b"original 0"))
+    assert (tmp_path / CarouselArchive.INDEX).stat().st_size == 6 * RECORD.size
+    assert list(tmp_path.glob("images/*/*.tmp")) == []
@@ -17,7 +17,9 @@ class MockStorage(Storage):
         self.storage[self.id] = {"normal": {}, "xray": {}}
         self.id += 1
 
-    def upload_file(self, user_ref: int | str, type: str, file_path: PathLike | IO):
+    def upload_file(
+        self, user_ref: int | str, type: str, file_path: PathLike | IO, filename: str
+    ):
         if isinstance(file_path, PathLike):
             file_data = open(file_path, "rb")
         else:
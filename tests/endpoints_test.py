@@ -1,9 +1,26 @@
+import asyncio
+import json
+import zipfile
+from email.parser import BytesParser
 from io import BytesIO
+from unittest import mock
 
+import cv2
+import numpy as np
 from fastapi.testclient import TestClient
 from PIL import Image
 from PIL.Image import Transpose
 
+from backend.config import config
+from backend.routes import api
+from backend.routes.carousel import CarouselArchive
+from backend.routes.fracture_tool4 import apply_fracture
+from backend.routes.jobqueue import ConfirmJobEnum
+from backend.routes.memory import MB
+from backend.routes.previews import PreviewCache
+
+from .fracture_test import make_overlay, make_xray
+
 
 def test_upload(test_client: TestClient):
     # The new /upload endpoint requires form fields: first_name, last_name, animal_name, qr_content, animal_type, broken_bone
@@ -39,6 +56,25 @@ def test_upload(test_client: TestClient):
     assert r3.status_code == 200
 
 
+def test_upload_rejects_line_breaks(test_client: TestClient):
+    data = {
+        "first_name": "Test\r\nlease_token: forged",
+        "last_name": "User",
+        "animal_name": "Teddy",
+        "qr_content": "1",
+    }
+    r = test_client.post(
+        "/upload", files={"file": open("tests/img/teddy.jpg", "rb")}, data=data
+    )
+    assert r.status_code == 422
+    data["first_name"] = "Zoë"
+    data["animal_type"] = "bear\n"
+    r = test_client.post(
+        "/upload", files={"file": open("tests/img/teddy.jpg", "rb")}, data=data
+    )
+    assert r.status_code == 422
+
+
 def test_jobs(test_client: TestClient):
     response = test_client.get("/job")
     assert response.status_code == 200
@@ -60,3 +96,494 @@ def test_jobs(test_client: TestClient):
     test_client.get("/job")
     r = test_client.get("/job")
     assert r.status_code == 204
+
+
+def test_batch_jobs(test_client: TestClient):
+    # drain whatever the other tests left in the queue
+    while test_client.get("/jobs", params={"max": 64}).status_code == 200:
+        pass
+    data = {
+        "first_name": "Test",
+        "last_name": "User",
+        "animal_name": "Teddy",
+        "qr_content": "1",
+    }
+    r = test_client.post(
+        "/upload", files={"file": open("tests/img/teddy.jpg", "rb")}, data=data
+    )
+    job_id = r.json()["job_id"]
+    response = test_client.get("/jobs", params={"max": 5})
+    assert response.status_code == 200
+    message = BytesParser().parsebytes(
+        b"Content-Type: "
+        + response.headers["content-type"].encode()
+        + b"\r\n\r\n"
+        + response.content
+    )
+    parts = message.get_payload()
+    # the job is handed out once for every result it still needs
+    assert len(parts) == int(response.headers["job_count"])
+    assert all(part["img_id"] == str(job_id) for part in parts)
+    Image.open(BytesIO(parts[0].get_payload(decode=True)))
+    assert test_client.get("/jobs", params={"max": 5}).status_code == 204
+
+    r = test_client.post(
+        "/jobs",
+        data={"image_ids": [job_id, -1]},
+        files=[
+            ("results", ("a.png", parts[0].get_payload(decode=True), "image/png")),
+            ("results", ("b.png", parts[0].get_payload(decode=True), "image/png")),
+        ],
+    )
+    assert r.status_code == 200
+    statuses = r.json()["results"]
+    assert statuses[0]["status"] == "success"
+    assert statuses[1]["status"] == "error"
+
+
+def test_batch_jobs_cancelled(test_client: TestClient):
+    while test_client.get("/jobs", params={"max": 64}).status_code == 200:
+        pass
+    data = {
+        "first_name": "Test",
+        "last_name": "User",
+        "animal_name": "Cancelled",
+        "qr_content": "1",
+    }
+    r = test_client.post(
+        "/upload", files={"file": open("tests/img/teddy.jpg", "rb")}, data=data
+    )
+    job_id = r.json()["job_id"]
+
+    async def batch() -> bytes:
+        response = await api.get_jobs(valid=True, max=1)
+        # cancelled while the batch is on its way
+        await api.job_queue.confirm_job(job_id, ConfirmJobEnum.cancel, 0, None)
+        return b"".join([bytes(part) async for part in response.body_iterator])
+
+    body = asyncio.run(batch())
+    boundary = body.split(b"\r\n", 1)[0][2:]
+    message = BytesParser().parsebytes(
+        b'Content-Type: multipart/mixed; boundary="' + boundary + b'"\r\n\r\n' + body
+    )
+    [part] = message.get_payload()
+    assert part["img_id"] == str(job_id)
+    Image.open(BytesIO(part.get_payload(decode=True)))
+
+
+def test_batch_size_limit(test_client: TestClient):
+    result = bytes(config.max_upload_mb * MB // 2 + MB)
+    # a batch may be larger than a single upload
+    r = test_client.post(
+        "/jobs",
+        data={"image_ids": [-1, -2]},
+        files=[("results", ("a.png", result, "image/png"))] * 2,
+    )
+    assert r.status_code == 200
+    assert [s["status"] for s in r.json()["results"]] == ["error", "error"]
+    r = test_client.post(
+        "/job",
+        data={"image_id": -1},
+        files={"result": ("a.png", result * 2, "image/png")},
+    )
+    assert r.status_code == 413
+
+
+def test_memory(test_client: TestClient):
+    r = test_client.get("/memory")
+    assert r.status_code == 200
+    assert {"budget", "resident", "spilled", "blobs", "refs"} <= r.json().keys()
+
+
+def test_qr_progress(test_client: TestClient, tmp_path, monkeypatch):
+    monkeypatch.setattr(api, "QR_PROGRESS_PATH", str(tmp_path / "qr_progress"))
+    r = test_client.get("/qr/progress")
+    assert r.status_code == 200
+    assert r.json() == {"progress": 0.0}
+    (tmp_path / "qr_progress").write_text("42.5")
+    assert test_client.get("/qr/progress").json() == {"progress": 42.5}
+
+
+def test_events_auth(test_client: TestClient):
+    assert test_client.get("/events", params={"token": "nope"}).status_code == 401
+    token = test_client.headers["Authorization"].removeprefix("Bearer ")
+
+    async def first_event(token: str | None) -> bytes:
+        body = (await api.get_events(token)).body_iterator
+        first = asyncio.ensure_future(anext(body))
+        await asyncio.sleep(0)
+        api.events.publish("job", {"id": 1})
+        api.events.publish("carousel", {"version": "abc"})
+        try:
+            return await first
+        finally:
+            await body.aclose()
+
+    assert b"event: job" in asyncio.run(first_event(token))
+    # without a token the job is left out
+    assert b"event: carousel" in asyncio.run(first_event(None))
+
+
+def test_image_caching(test_client: TestClient):
+    data = {
+        "first_name": "Test",
+        "last_name": "User",
+        "animal_name": "Teddy",
+        "qr_content": "1",
+    }
+    r = test_client.post(
+        "/upload", files={"file": open("tests/img/teddy.jpg", "rb")}, data=data
+    )
+    job_id = str(r.json()["job_id"])
+    url = test_client.get("/results").json()["originals"][job_id]
+    # the URL carries the version of the image, so it never changes its content
+    response = test_client.get(url)
+    assert response.status_code == 200
+    assert "immutable" in response.headers["cache-control"]
+    etag = response.headers["etag"]
+    response = test_client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    # without the version the browser has to ask every time
+    response = test_client.get(f"/results/{job_id}/original")
+    assert response.headers["cache-control"] == "no-cache"
+    assert response.headers["etag"] == etag
+
+    size = len(test_client.get(url).content)
+    response = test_client.head(url)
+    assert response.headers["content-length"] == str(size)
+    assert response.content == b""
+    response = test_client.get(url, headers={"Range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 0-9/{size}"
+    assert len(response.content) == 10
+
+
+def test_carousel(test_client: TestClient):
+    while test_client.get("/jobs", params={"max": 64}).status_code == 200:
+        pass
+    data = {
+        "first_name": "Test",
+        "last_name": "User",
+        "animal_name": "Teddy",
+        "qr_content": "1",
+    }
+    r = test_client.post(
+        "/upload", files={"file": open("tests/img/teddy.jpg", "rb")}, data=data
+    )
+    job_id = r.json()["job_id"]
+    while (response := test_client.get("/job")).status_code == 200:
+        r = test_client.post(
+            "/job",
+            data={"image_id": response.headers["img_id"]},
+            files={"result": ("result.png", response.content, "image/png")},
+        )
+        assert r.status_code == 200
+    r = test_client.get(
+        "/confirm", params={"image_id": job_id, "choice": 0, "confirm": "confirm"}
+    )
+    assert r.status_code == 200
+    # the bundle of the new item was built on confirmation
+    bundles = test_client.get("/memory").json()["bundles"]
+    assert bundles >= 1
+    url = test_client.get("/carousel").json()[0]
+    response = test_client.get(url)
+    assert response.status_code == 200
+    with zipfile.ZipFile(BytesIO(response.content)) as zip_file:
+        assert zip_file.namelist() == ["xray.png", "original.png"]
+    assert test_client.get(url).content == response.content
+    assert test_client.get("/memory").json()["bundles"] == bundles
+    response = test_client.get(url, headers={"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+
+
+def test_results_since(test_client: TestClient):
+    full = test_client.get("/results").json()
+    assert full["full"]
+    version = full["version"]
+    # nothing changed, nothing is listed
+    delta = test_client.get("/results", params={"since": version}).json()
+    assert not delta["full"]
+    assert delta["version"] == version
+    assert delta["metadata"] == delta["results"] == delta["originals"] == {}
+    assert delta["removed"] == []
+    data = {
+        "first_name": "Test",
+        "last_name": "User",
+        "animal_name": "Delta",
+        "qr_content": "1",
+    }
+    r = test_client.post(
+        "/upload", files={"file": open("tests/img/teddy.jpg", "rb")}, data=data
+    )
+    job_id = str(r.json()["job_id"])
+    delta = test_client.get("/results", params={"since": version}).json()
+    assert not delta["full"]
+    assert list(delta["metadata"]) == [job_id]
+    assert delta["metadata"][job_id]["animal_name"] == "Delta"
+    test_client.get(
+        "/confirm", params={"image_id": job_id, "choice": 0, "confirm": "cancel"}
+    )
+    delta = test_client.get("/results", params={"since": delta["version"]}).json()
+    assert delta["removed"] == [int(job_id)]
+    assert delta["metadata"] == {}
+
+
+def test_results_pages(test_client: TestClient):
+    job_ids = []
+    for name in ["Page 1", "Page 2", "Page 3"]:
+        data = {
+            "first_name": "Test",
+            "last_name": "User",
+            "animal_name": name,
+            "animal_type": "okapi",
+            "qr_content": "1",
+        }
+        r = test_client.post(
+            "/upload", files={"file": open("tests/img/teddy.jpg", "rb")}, data=data
+        )
+        job_ids.append(str(r.json()["job_id"]))
+    params = {"animal_type": "okapi", "complete": False, "limit": 2}
+    first = test_client.get("/results", params=params).json()
+    assert list(first["metadata"]) == job_ids[:2]
+    assert first["next"] is not None
+    second = test_client.get("/results", params=params | {"after": first["next"]})
+    assert list(second.json()["metadata"]) == job_ids[2:]
+    assert second.json()["next"] is None
+    # none of them waited a minute yet
+    r = test_client.get("/results", params={"animal_type": "okapi", "min_age": 60})
+    assert r.json()["metadata"] == {}
+    r = test_client.get("/results", params={"after": "nonsense"})
+    assert r.status_code == 400
+    for job_id in job_ids:
+        test_client.get(
+            "/confirm", params={"image_id": job_id, "choice": 0, "confirm": "cancel"}
+        )
+
+
+def test_carousel_history(test_client: TestClient, tmp_path, monkeypatch):
+    assert test_client.get("/carousel/history").status_code == 404
+    monkeypatch.setattr(api.job_queue, "archive", CarouselArchive(tmp_path))
+    assert test_client.get("/carousel/history").json() == {"total": 0, "items": []}
+    data = {
+        "first_name": "Test",
+        "last_name": "User",
+        "animal_name": "History",
+        "qr_content": "1",
+    }
+    r = test_client.post(
+        "/upload", files={"file": open("tests/img/teddy.jpg", "rb")}, data=data
+    )
+    job_id = r.json()["job_id"]
+    while (response := test_client.get("/job")).status_code == 200:
+        test_client.post(
+            "/job",
+            data={"image_id": response.headers["img_id"]},
+            files={"result": ("result.png", response.content, "image/png")},
+        )
+    test_client.get(
+        "/confirm", params={"image_id": job_id, "choice": 0, "confirm": "confirm"}
+    )
+    history = test_client.get("/carousel/history").json()
+    assert history["total"] == 1
+    [item] = history["items"]
+    response = test_client.get(item["url"])
+    assert response.status_code == 200
+    # the same item as the newest in the carousel
+    assert (
+        response.content
+        == test_client.get(test_client.get("/carousel").json()[0]).content
+    )
+    assert "immutable" in response.headers["cache-control"]
+    assert test_client.get("/carousel/history/1").status_code == 404
+
+
+def test_overlays(test_client: TestClient):
+    xray = BytesIO()
+    Image.new("RGB", (200, 200), (200, 200, 200)).save(xray, "PNG")
+    overlay = BytesIO()
+    Image.new("RGBA", (50, 50), (30, 30, 30, 255)).save(overlay, "PNG")
+    form = {"x": "20", "y": "30", "scale": "1.5", "noise": "0"}
+
+    r = test_client.post("/overlays", files={"overlay_file": overlay.getvalue()})
+    assert r.status_code == 200
+    overlay_id = r.json()["id"]
+    assert overlay_id in test_client.get("/overlays").json()["ids"]
+
+    uploaded = test_client.post(
+        "/apply_fracture",
+        data=form,
+        files={"image_file": xray.getvalue(), "overlay_file": overlay.getvalue()},
+    )
+    registered = test_client.post(
+        "/apply_fracture",
+        data=form | {"overlay_id": overlay_id},
+        files={"image_file": xray.getvalue()},
+    )
+    assert registered.status_code == 200
+    assert registered.content == uploaded.content
+
+    r = test_client.post(
+        "/apply_fracture",
+        data=form | {"overlay_id": "unknown"},
+        files={"image_file": xray.getvalue()},
+    )
+    assert r.status_code == 404
+    r = test_client.post(
+        "/apply_fracture", data=form, files={"image_file": xray.getvalue()}
+    )
+    assert r.status_code == 400
+
+    assert test_client.delete(f"/overlays/{overlay_id}").status_code == 204
+    assert test_client.delete(f"/overlays/{overlay_id}").status_code == 404
+
+
+def test_batch_fractures(test_client: TestClient):
+    while test_client.get("/jobs", params={"max": 64}).status_code == 200:
+        pass
+    data = {
+        "first_name": "Test",
+        "last_name": "User",
+        "animal_name": "Fracture",
+        "qr_content": "1",
+    }
+    r = test_client.post(
+        "/upload", files={"file": open("tests/img/teddy.jpg", "rb")}, data=data
+    )
+    job_id = r.json()["job_id"]
+    assert test_client.get("/job").headers["img_id"] == str(job_id)
+    xray = BytesIO()
+    Image.new("RGB", (200, 200), (200, 200, 200)).save(xray, "PNG")
+    test_client.post(
+        "/job", data={"image_id": job_id}, files={"result": xray.getvalue()}
+    )
+    overlay = BytesIO()
+    Image.new("RGBA", (40, 40), (30, 30, 30, 255)).save(overlay, "PNG")
+    overlay_id = test_client.post(
+        "/overlays", files={"overlay_file": overlay.getvalue()}
+    ).json()["id"]
+
+    operations = [
+        {"overlay_id": overlay_id, "x": 10, "y": 20, "scale": 1.0, "noise": 0},
+        {"overlay_id": "unknown", "x": 10, "y": 20},
+        {"overlay_file": 0, "x": 100, "y": 50, "scale": 0.5},
+        {"overlay_file": 1, "x": 100, "y": 50},
+        {"overlay_file": 0, "x": 190, "y": 190},
+    ]
+    r = test_client.post(
+        "/apply_fractures_queue",
+        data={"job_id": job_id, "choice": 0, "operations": json.dumps(operations)},
+        files=[("overlay_files", ("overlay.png", overlay.getvalue(), "image/png"))],
+    )
+    assert r.status_code == 200
+    statuses = [s["status"] for s in r.json()["results"]]
+    assert statuses == ["success", "error", "success", "error", "error"]
+
+    # painted as one by one, with a single encode
+    expected = cv2.imdecode(np.frombuffer(xray.getvalue(), np.uint8), cv2.IMREAD_COLOR)
+    stencil = cv2.imdecode(
+        np.frombuffer(overlay.getvalue(), np.uint8), cv2.IMREAD_UNCHANGED
+    )
+    expected = apply_fracture(expected, stencil, 10, 20, 1.0, 0)
+    expected = apply_fracture(expected, stencil, 100, 50, 0.5, 0)
+    result = api.job_queue.blobs.read(api.job_queue.get_pending(job_id)[1][0])
+    actual = cv2.imdecode(np.frombuffer(result, np.uint8), cv2.IMREAD_COLOR)
+    assert np.array_equal(actual, expected)
+
+    r = test_client.post(
+        "/apply_fractures_queue",
+        data={"job_id": job_id, "choice": 0, "operations": '[{"x": "left"}]'},
+    )
+    assert r.status_code == 400
+
+    # previews leave the result alone
+    r = test_client.post(
+        "/preview_fracture_queue",
+        data={"job_id": job_id, "choice": 0, "overlay_id": overlay_id}
+        | {"x": 150, "y": 150, "scale": 1.0, "noise": 0},
+    )
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "image/jpeg"
+    assert api.job_queue.blobs.read(api.job_queue.get_pending(job_id)[1][0]) == result
+
+    single = {"job_id": job_id, "choice": 0, "overlay_id": overlay_id} | {
+        "x": 150,
+        "y": 150,
+        "scale": 1.0,
+        "noise": 0,
+    }
+    r = test_client.post("/apply_fracture_queue", data=single)
+    assert r.status_code == 200
+    expected = apply_fracture(expected, stencil, 150, 150, 1.0, 0)
+    result = api.job_queue.blobs.read(api.job_queue.get_pending(job_id)[1][0])
+    actual = cv2.imdecode(np.frombuffer(result, np.uint8), cv2.IMREAD_COLOR)
+    assert np.array_equal(actual, expected)
+    # confirmed while the fracture was painted
+    with mock.patch.object(
+        api.job_queue, "replace_result", side_effect=ValueError("Invalid id")
+    ):
+        r = test_client.post("/apply_fracture_queue", data=single)
+    assert r.status_code == 404
+    test_client.get(
+        "/confirm", params={"image_id": job_id, "choice": 0, "confirm": "cancel"}
+    )
+
+
+def test_fracture_preview(test_client: TestClient):
+    xray = make_xray(1024, 2048)
+    form = {"x": "1200", "y": "400", "scale": "2.0", "noise": "0"}
+    r = test_client.post(
+        "/preview_fracture",
+        data=form,
+        files={
+            "image_file": cv2.imencode(".png", xray)[1].tobytes(),
+            "overlay_file": cv2.imencode(".png", make_overlay(128))[1].tobytes(),
+        },
+    )
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "image/jpeg"
+    preview = cv2.imdecode(np.frombuffer(r.content, np.uint8), cv2.IMREAD_COLOR)
+    assert preview.shape == (512, 1024, 3)
+    # painted on the copy at half the size, with the stencil at half the scale
+    base = PreviewCache(max_edge=1024).get("", cv2.imencode(".png", xray)[1]).pixels
+    expected = apply_fracture(base.copy(), make_overlay(128), 600, 200, 1.0, 0)
+    painted = (expected != base).any(axis=-1)
+    assert painted.any()
+    # closer to the fracture than to the unpainted copy, despite the JPEG
+    error = np.abs(preview[painted].astype(int) - expected[painted]).mean()
+    assert error < np.abs(preview[painted].astype(int) - base[painted]).mean() / 2
+    assert test_client.get("/memory").json()["previews"] >= 1
+
+
+def test_confirm_override(test_client: TestClient):
+    while test_client.get("/jobs", params={"max": 64}).status_code == 200:
+        pass
+    data = {
+        "first_name": "Test",
+        "last_name": "User",
+        "animal_name": "Override",
+        "qr_content": "1",
+    }
+    r = test_client.post(
+        "/upload", files={"file": open("tests/img/teddy.jpg", "rb")}, data=data
+    )
+    job_id = r.json()["job_id"]
+    while test_client.get("/job").status_code == 200:
+        xray = BytesIO()
+        Image.new("RGB", (20, 20), (200, 200, 200)).save(xray, "PNG")
+        test_client.post(
+            "/job", data={"image_id": job_id}, files={"result": xray.getvalue()}
+        )
+    result = api.job_queue.get_pending(job_id)[1][0]
+    override = BytesIO()
+    Image.new("RGB", (20, 20), (10, 10, 10)).save(override, "PNG")
+    with mock.patch.object(api.thumbnails, "invalidate") as invalidate:
+        r = test_client.request(
+            "GET",
+            "/confirm",
+            params={"image_id": job_id, "choice": 0, "confirm": "confirm"},
+            files={"image": override.getvalue()},
+        )
+    assert r.status_code == 200
+    # the thumbnails of the result the override replaced are dropped
+    invalidate.assert_called_once_with(result)
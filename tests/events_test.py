@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+from anyio import to_thread
+
+from backend.routes.events import EventBus
+
+
+@pytest.mark.anyio
+class TestEventBus:
+    async def test_publish(self):
+        bus = EventBus()
+        with bus.subscribe() as first, bus.subscribe() as second:
+            event = bus.publish("job", {"id": 1})
+            assert await first.get() is event
+            assert await second.get() is event
+            assert event.encode() == (
+                f'id: {event.id}\nevent: job\ndata: {{"id":1}}\n\n'.encode()
+            )
+            waiting = asyncio.create_task(first.get())
+            await to_thread.run_sync(bus.publish_from_thread, "qr", {"progress": 50})
+            assert (await waiting).data == {"progress": 50}
+        assert bus._subscribers == set()
+
+    async def test_resume(self):
+        bus = EventBus(history=3)
+        events = [bus.publish("result", {"id": i}) for i in range(4)]
+        # the client missed the last two events, which are still kept
+        with bus.subscribe(events[1].id) as subscription:
+            assert await subscription.get() is events[2]
+            assert await subscription.get() is events[3]
+        with bus.subscribe(events[3].id) as subscription:
+            assert not subscription._events
+        # the first event is gone, as are the events of a previous run
+        for last_id in [events[0].id - 1, events[3].id + 100]:
+            with bus.subscribe(last_id) as subscription:
+                reset = await subscription.get()
+                assert reset.type == "reset"
+                assert reset.id == events[3].id
+
+    async def test_slow_client(self):
+        bus = EventBus(buffer=2)
+        with bus.subscribe() as subscription:
+            for i in range(3):
+                bus.publish("result", {"id": i})
+            # the backlog was dropped, the client fetches everything again
+            assert (await subscription.get()).type == "reset"
+            last = bus.publish("result", {"id": 3})
+            assert await subscription.get() is last
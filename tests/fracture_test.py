@@ -0,0 +1,82 @@
+import cv2
+import numpy as np
+import pytest
+
+from backend.routes.fracture_tool4 import (
+    apply_fracture,
+    apply_gradient_to_mask,
+    sample_color_gradient,
+)
+from benchmarks.fracture_bench import (
+    apply_gradient_to_mask_float64,
+    sample_color_gradient_loop,
+)
+
+# overlay size and position of the fractures in the golden image
+PLACEMENTS = [(96, 40, 30), (64, 300, 200), (128, 200, 120), (32, 470, 340), (48, 0, 0)]
+
+
+def make_xray(h: int = 384, w: int = 512) -> np.ndarray:
+    yy, xx = np.mgrid[0:h, 0:w]
+    bones = ((xx // 24 + yy // 32) % 3 == 0) * 140
+    shade = (xx * 3 + yy * 5) % 90
+    gray = (40 + bones + shade).astype(np.uint8)
+    return np.stack([gray, gray + 4, gray + 8], axis=-1).astype(np.uint8)
+
+
+def make_overlay(size: int) -> np.ndarray:
+    yy, xx = np.mgrid[0:size, 0:size]
+    alpha = (np.abs(xx - yy - (xx // 7) % 3) < max(size // 8, 1)) * 255
+    rgb = np.full((size, size, 3), 30)
+    return np.dstack([rgb, alpha]).astype(np.uint8)
+
+
+def test_golden_image():
+    # rendered before the color search was vectorized, without noise
+    img = make_xray()
+    for size, x, y in PLACEMENTS:
+        img = apply_fracture(img, make_overlay(size), x, y, 1.0, 0)
+    golden = cv2.imread("tests/img/fracture_golden.png", cv2.IMREAD_COLOR)
+    assert np.array_equal(img, golden)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_matches_pixel_loop(seed):
+    rng = np.random.default_rng(seed)
+    # mostly bright, so the searches walk many rings, and some gray images
+    img = np.where(
+        rng.random((160, 200, 3)) < 0.01, 30, rng.integers(110, 255, (160, 200, 3))
+    ).astype(np.uint8)
+    if seed % 2:
+        img = img[:, :, 0].copy()
+    for _ in range(25):
+        size = int(rng.integers(1, 120))
+        mask = (rng.random((size, int(rng.integers(1, 120)))) < 0.5) * 255
+        x, y = (int(v) for v in rng.integers(-50, 250, 2))
+        expected = sample_color_gradient_loop(img, mask, x, y)
+        actual = sample_color_gradient(img, mask, x, y)
+        for a, b in zip(expected, actual):
+            assert np.array_equal(a, b)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_matches_float64_blend(seed):
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 256, (150, 170, 3), dtype=np.uint8)
+    size = int(rng.integers(20, 200))
+    overlay = rng.integers(0, 256, (size, size, 4), dtype=np.uint8)
+    x, y = (int(v) for v in rng.integers(-100, 170, 2))
+    colors = rng.uniform(0, 255, (2, 3)).astype(np.float32)
+    args = x, y, overlay, rng.normal(size=2), *colors, 0
+    expected = apply_gradient_to_mask_float64(img.copy(), *args)
+    actual = apply_gradient_to_mask(img.copy(), *args)
+    # the fixed point blend rounds down exactly, the float64 one is sometimes one
+    # below where the exact result is an integer
+    assert np.abs(actual.astype(int) - expected).max() <= 1
+    assert np.count_nonzero(actual != expected) < 0.01 * actual.size
+
+    # opaque or transparent overlays blend exactly either way
+    overlay[..., 3] = (overlay[..., 3] > 127) * 255
+    expected = apply_gradient_to_mask_float64(img.copy(), *args)
+    actual = apply_gradient_to_mask(img.copy(), *args)
+    assert np.array_equal(actual, expected)
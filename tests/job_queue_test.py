@@ -1,24 +1,38 @@
+import asyncio
+import io
 from unittest import mock
 
 import pytest
-from anyio import SpooledTemporaryFile
 from PIL import Image
 from PIL.Image import Transpose
 
-from backend.routes.jobqueue import ConfirmJobEnum, Job, JobQueue, Result
+from backend.routes.carousel import CarouselArchive
+from backend.routes.jobqueue import (
+    ConfirmJobEnum,
+    Job,
+    JobDeque,
+    JobQueue,
+    PendingFilter,
+    Result,
+)
+from backend.routes.journal import Journal
+from backend.routes.uploads import UploadPipeline
 from tests.conftest import MockStorage
+from tests.uploads_test import FlakyStorage
 
 
-async def flip(f: SpooledTemporaryFile) -> list[SpooledTemporaryFile[bytes]]:
-    await f.seek(0)
-    f1 = SpooledTemporaryFile()
-    f2 = SpooledTemporaryFile()
-    f3 = SpooledTemporaryFile()
-    img = Image.open(f.wrapped)
-    img.transpose(Transpose.FLIP_TOP_BOTTOM).save(f1.wrapped, "png")
-    img.transpose(Transpose.FLIP_LEFT_RIGHT).save(f2.wrapped, "png")
-    img.transpose(Transpose.ROTATE_90).save(f3.wrapped, "png")
-    return [f1, f2, f3]
+def flip(data: bytes) -> list[bytes]:
+    img = Image.open(io.BytesIO(data))
+    results = []
+    for transpose in [
+        Transpose.FLIP_TOP_BOTTOM,
+        Transpose.FLIP_LEFT_RIGHT,
+        Transpose.ROTATE_90,
+    ]:
+        f = io.BytesIO()
+        img.transpose(transpose).save(f, "png")
+        results.append(f.getvalue())
+    return results
 
 
 @pytest.mark.anyio
@@ -27,17 +41,14 @@ class TestJobQueue:
         job_queue = JobQueue(
             results_per_image=3, carrousel_size=3, storage=mock_storage
         )
-        sf1 = SpooledTemporaryFile()
-        sf2 = SpooledTemporaryFile()
-        sf3 = SpooledTemporaryFile()
         f1 = open("tests/img/eichhornchen.jpeg", "rb")
         f2 = open("tests/img/teddy.jpg", "rb")
         f3 = open("tests/img/own.jpg", "rb")
-        await sf1.write(f1.read())
-        await sf2.write(f2.read())
-        await sf3.write(f3.read())
+        sf1 = await job_queue.blobs.put(f1.read())
+        sf2 = await job_queue.blobs.put(f2.read())
+        sf3 = await job_queue.blobs.put(f3.read())
         job = Job(
-            file=sf1,
+            blob=sf1,
             owner_ref=1,
             first_name="Test",
             last_name="User",
@@ -46,7 +57,7 @@ class TestJobQueue:
             broken_bone=False,
         )
         job2 = Job(
-            file=sf2,
+            blob=sf2,
             owner_ref=1,
             first_name="Test",
             last_name="User",
@@ -55,7 +66,7 @@ class TestJobQueue:
             broken_bone=False,
         )
         job3 = Job(
-            file=sf3,
+            blob=sf3,
             owner_ref=1,
             first_name="Test",
             last_name="User",
@@ -67,8 +78,7 @@ class TestJobQueue:
         job_queue.add_job(job2)
         job_queue.add_job(job3)
         assert len(job_queue.queue) == 3
-        assert len(job_queue.in_progress) == 0
-        assert len(job_queue.awaiting_approval) == 0
+        assert len(job_queue.awaiting_approval) == 3
         assert job_queue.get_job() == job
         assert job_queue.get_job() == job2
         assert job_queue.get_job() == job3
@@ -80,18 +90,15 @@ class TestJobQueue:
         )
         mock_storage.create_storage_for_user()
         mock_storage.create_storage_for_user()
-        sf1 = SpooledTemporaryFile()
-        sf2 = SpooledTemporaryFile()
-        sf3 = SpooledTemporaryFile()
         f1 = open("tests/img/eichhornchen.jpeg", "rb")
         f2 = open("tests/img/teddy.jpg", "rb")
         f3 = open("tests/img/own.jpg", "rb")
-        await sf1.write(f1.read())
-        await sf2.write(f2.read())
-        await sf3.write(f3.read())
+        sf1 = await job_queue.blobs.put(f1.read())
+        sf2 = await job_queue.blobs.put(f2.read())
+        sf3 = await job_queue.blobs.put(f3.read())
         job_queue.add_job(
             Job(
-                file=sf1,
+                blob=sf1,
                 owner_ref=1,
                 first_name="Test",
                 last_name="User",
@@ -102,7 +109,7 @@ class TestJobQueue:
         )
         job_queue.add_job(
             Job(
-                file=sf2,
+                blob=sf2,
                 owner_ref=1,
                 first_name="Test",
                 last_name="User",
@@ -113,7 +120,7 @@ class TestJobQueue:
         )
         job_queue.add_job(
             Job(
-                file=sf3,
+                blob=sf3,
                 owner_ref=1,
                 first_name="Test",
                 last_name="User",
@@ -125,18 +132,449 @@ class TestJobQueue:
         job = job_queue.get_job()
         assert job is not None
         assert len(job_queue.queue) == 2
-        assert len(job_queue.in_progress) == 1
-        mocked_result = await flip(job.file)
-        job_queue.submit_job(job.id, mocked_result[0])
-        job_queue.submit_job(job.id, mocked_result[1])
+        mocked_result = flip(job_queue.blobs.read(job.blob))
+        for result in mocked_result:
+            await job_queue.submit_job(job.id, result)
         assert len(job_queue.queue) == 2
-        assert len(job_queue.in_progress) == 1
-        assert len(job_queue.awaiting_approval) == 0
-        job_queue.submit_job(job.id, mocked_result[2])
-        assert len(job_queue.queue) == 2
-        assert len(job_queue.in_progress) == 0
-        assert len(job_queue.awaiting_approval) == 1
-        await job_queue.confirm_job(job.id, ConfirmJobEnum.confirm, 0)
-        assert len(job_queue.awaiting_approval) == 0
-        await mocked_result[0].seek(0)
-        assert mock_storage.storage[1]["xray"] == await mocked_result[0].read()
+        assert len(job_queue.awaiting_approval[job.id][1]) == 3
+        await job_queue.confirm_job(job.id, ConfirmJobEnum.confirm, 0, None)
+        assert job.id not in job_queue.awaiting_approval
+        assert job_queue.upload_status(job.id)["status"] == "queued"
+        await job_queue.uploads.join()
+        assert job_queue.upload_status(job.id)["status"] == "done"
+        assert mock_storage.storage[1]["xray"] == mocked_result[0]
+        xray, original = job_queue.get_carousel()[0]
+        assert job_queue.blobs.read(xray) == mocked_result[0]
+        assert original == job.blob
+        # the rejected results are dropped, the carousel keeps the other two
+        assert len(job_queue.blobs) == 4
+
+    async def test_results_per_image(self, mock_storage):
+        job_queue = JobQueue(
+            results_per_image=2, carrousel_size=3, storage=mock_storage
+        )
+        jobs = [
+            Job(
+                blob=await job_queue.blobs.put(b""),
+                owner_ref=1,
+                first_name="Test",
+                last_name="User",
+                animal_name=f"Teddy {i}",
+                number_of_results=2,
+            )
+            for i in range(2)
+        ]
+        for job in jobs:
+            job_queue.add_job(job)
+        # a job stays at the head until all of its results have been handed out
+        assert job_queue.get_job() is jobs[0]
+        assert job_queue.get_job() is jobs[0]
+        assert job_queue.get_job() is jobs[1]
+        assert len(job_queue.queue) == 1
+        # confirming removes the job from the queue even if it is still pending
+        await job_queue.confirm_job(jobs[1].id, ConfirmJobEnum.cancel, 0, None)
+        assert len(job_queue.queue) == 0
+        assert job_queue.get_job() is None
+        # retrying puts the job back with a fresh result count
+        await job_queue.confirm_job(jobs[0].id, ConfirmJobEnum.retry, 0, None)
+        assert jobs[0] in job_queue.queue
+        assert jobs[0].number_of_results == 2
+
+    async def test_wait_for_job(self, mock_storage):
+        job_queue = JobQueue(
+            results_per_image=1, carrousel_size=3, storage=mock_storage
+        )
+        assert await job_queue.wait_for_job(0.01) is None
+        first = asyncio.create_task(job_queue.wait_for_job(1))
+        second = asyncio.create_task(job_queue.wait_for_job(0.2))
+        await asyncio.sleep(0)
+        job = Job(
+            blob=await job_queue.blobs.put(b""),
+            owner_ref=1,
+            first_name="Test",
+            last_name="User",
+            animal_name="Teddy",
+        )
+        job_queue.add_job(job)
+        # only the worker that has been waiting longest gets the job
+        assert (await first).job is job
+        assert await second is None
+        assert len(job_queue.queue) == 0
+
+    async def test_lease_expiry(self, mock_storage):
+        job_queue = JobQueue(
+            results_per_image=2, carrousel_size=3, storage=mock_storage
+        )
+        job = Job(
+            blob=await job_queue.blobs.put(b""),
+            owner_ref=1,
+            first_name="Test",
+            last_name="User",
+            animal_name="Teddy",
+            number_of_results=2,
+        )
+        job_queue.add_job(job)
+        lost, delivered = job_queue.lease_jobs(2)
+        assert len(job_queue.queue) == 0
+        await job_queue.submit_job(job.id, b"result", delivered.token)
+        # the token of a resolved lease can't be used twice
+        with pytest.raises(ValueError):
+            await job_queue.submit_job(job.id, b"result", delivered.token)
+        assert job_queue.expire_leases(lost.deadline - 1) == 0
+        assert job_queue.expire_leases(lost.deadline) == 1
+        # the lost dispatch is back at the head of the queue
+        assert job_queue.queue.peek() is job
+        assert job.number_of_results == 1
+        with pytest.raises(ValueError):
+            await job_queue.submit_job(job.id, b"result", lost.token)
+        retry = job_queue.lease_job()
+        assert retry is not None and retry.job is job
+        await job_queue.confirm_job(job.id, ConfirmJobEnum.cancel, 0, None)
+        assert job_queue.leases == {}
+        assert job_queue.expire_leases(retry.deadline) == 0
+        assert len(job_queue.queue) == 0
+
+    async def test_archive(self, mock_storage: MockStorage):
+        mock_storage.create_storage_for_user()
+        job_queue = JobQueue(
+            results_per_image=1, carrousel_size=3, storage=mock_storage
+        )
+        job = Job(
+            blob=await job_queue.blobs.put(b"normalized"),
+            owner_ref=0,
+            first_name="Test",
+            last_name="User",
+            animal_name="Teddy",
+            archive=await job_queue.blobs.put(b"as taken"),
+        )
+        job_queue.add_job(job)
+        await job_queue.submit_job(job_queue.lease_job().job.id, b"xray")
+        await job_queue.confirm_job(job.id, ConfirmJobEnum.confirm, 0, None)
+        await job_queue.uploads.join()
+        # the storage gets the image as uploaded, the carousel the normalized one
+        assert mock_storage.storage[0] == {"normal": b"as taken", "xray": b"xray"}
+        assert job_queue.get_carousel()[0][1] == job.blob
+        assert len(job_queue.blobs) == 2
+
+    async def test_changes(self, mock_storage):
+        job_queue = JobQueue(
+            results_per_image=1, carrousel_size=3, storage=mock_storage
+        )
+        start, changed = job_queue.changes(0)
+        assert changed is None
+        assert job_queue.changes(start) == (start, [])
+        jobs = []
+        for name in ["a", "b", "c"]:
+            jobs.append(
+                Job(
+                    blob=await job_queue.blobs.put(name.encode()),
+                    owner_ref=1,
+                    first_name="Test",
+                    last_name="User",
+                    animal_name=name,
+                )
+            )
+            job_queue.add_job(jobs[-1])
+        version, changed = job_queue.changes(start)
+        assert changed == [job.id for job in jobs]
+        await job_queue.submit_job(jobs[0].id, b"result")
+        await job_queue.confirm_job(jobs[1].id, ConfirmJobEnum.cancel, 0, None)
+        # only the jobs changed since are listed, each once
+        assert job_queue.changes(version) == (version + 2, [jobs[0].id, jobs[1].id])
+        assert job_queue.changes(start)[1] == [jobs[2].id, jobs[0].id, jobs[1].id]
+        with mock.patch("backend.routes.jobqueue.CHANGE_LOG_SIZE", 2):
+            await job_queue.submit_job(jobs[2].id, b"result")
+        # the oldest change was forgotten, so the client has to reload everything
+        assert job_queue.changes(start)[1] is None
+        assert job_queue.changes(version + 2) == (version + 3, [jobs[2].id])
+
+    async def test_pending_page(self, mock_storage):
+        job_queue = JobQueue(
+            results_per_image=1, carrousel_size=3, storage=mock_storage
+        )
+        jobs = []
+        for i, animal_type in enumerate(["bear", "giraffe", "bear", "bear"]):
+            jobs.append(
+                Job(
+                    blob=await job_queue.blobs.put(b"%d" % i),
+                    owner_ref=1,
+                    first_name="Test",
+                    last_name="User",
+                    animal_name="Teddy",
+                    animal_type=animal_type,
+                    added=1000.0 + i,
+                )
+            )
+            job_queue.add_job(jobs[-1])
+        await job_queue.submit_job(jobs[2].id, b"result")
+
+        def ids(page):
+            return [job.id for job, _ in page]
+
+        page, cursor = job_queue.pending_page(PendingFilter(), None, 3)
+        assert ids(page) == [job.id for job in jobs[:3]]
+        assert cursor == (1002.0, jobs[2].id)
+        page, cursor = job_queue.pending_page(PendingFilter(), cursor, 3)
+        assert ids(page) == [jobs[3].id]
+        assert cursor is None
+        bears = PendingFilter(animal_type="bear")
+        assert ids(job_queue.pending_page(bears, None, 10)[0]) == [
+            jobs[0].id,
+            jobs[2].id,
+            jobs[3].id,
+        ]
+        page, _ = job_queue.pending_page(PendingFilter(complete=True), None, 10)
+        assert page == [(jobs[2], job_queue.awaiting_approval[jobs[2].id][1])]
+        incomplete_bears = PendingFilter(animal_type="bear", complete=False)
+        assert ids(job_queue.pending_page(incomplete_bears, None, 10)[0]) == [
+            jobs[0].id,
+            jobs[3].id,
+        ]
+        between = PendingFilter(added_after=1001.0, added_before=1002.0)
+        assert ids(job_queue.pending_page(between, None, 10)[0]) == [
+            jobs[1].id,
+            jobs[2].id,
+        ]
+        assert job_queue.pending_page(PendingFilter(animal_type="cat"), None, 10) == (
+            [],
+            None,
+        )
+        # a retried job is listed again at the end, without results
+        await job_queue.confirm_job(jobs[2].id, ConfirmJobEnum.retry, 0, None)
+        await job_queue.confirm_job(jobs[0].id, ConfirmJobEnum.cancel, 0, None)
+        assert ids(job_queue.pending_page(bears, None, 10)[0]) == [
+            jobs[3].id,
+            jobs[2].id,
+        ]
+        assert job_queue.pending_page(PendingFilter(complete=True), None, 10)[0] == []
+        assert "giraffe" in job_queue._by_type
+        await job_queue.confirm_job(jobs[1].id, ConfirmJobEnum.cancel, 0, None)
+        assert "giraffe" not in job_queue._by_type
+
+    async def test_carousel_archive(self, mock_storage, tmp_path):
+        def make_queue():
+            return JobQueue(
+                results_per_image=1,
+                carrousel_size=2,
+                storage=mock_storage,
+                archive=CarouselArchive(tmp_path),
+            )
+
+        job_queue = make_queue()
+        for i in range(3):
+            mock_storage.create_storage_for_user()
+            job = Job(
+                blob=await job_queue.blobs.put(b"original %d" % i),
+                owner_ref=i,
+                first_name="Test",
+                last_name="User",
+                animal_name="Teddy",
+            )
+            job_queue.add_job(job)
+            await job_queue.submit_job(job.id, b"xray %d" % i)
+            await job_queue.confirm_job(job.id, ConfirmJobEnum.confirm, 0, None)
+        await job_queue.uploads.join()
+        carousel = [
+            tuple(job_queue.blobs.read(blob) for blob in item)
+            for item in job_queue.get_carousel()
+        ]
+        assert carousel == [(b"xray 2", b"original 2"), (b"xray 1", b"original 1")]
+        assert job_queue.carousel_item(1) == job_queue.get_carousel()[1]
+        assert job_queue.carousel_item(2) is None
+        # the evicted item stays in the history
+        assert len(job_queue.archive) == 3
+        assert len(job_queue.blobs) == 4
+
+        restarted = make_queue()
+        await restarted.recover()
+        assert [
+            tuple(restarted.blobs.read(blob) for blob in item)
+            for item in restarted.get_carousel()
+        ] == carousel
+
+    @pytest.mark.parametrize("compact_every", [1000, 2])
+    async def test_journal_recovery(self, mock_storage, tmp_path, compact_every):
+        mock_storage.create_storage_for_user()
+        mock_storage.create_storage_for_user()
+        job_queue = JobQueue(
+            results_per_image=2,
+            carrousel_size=3,
+            storage=mock_storage,
+            journal=Journal(tmp_path, compact_every),
+        )
+        await job_queue.recover()
+        jobs = []
+        for name in ["eichhornchen.jpeg", "teddy.jpg", "own.jpg"]:
+            jobs.append(
+                Job(
+                    blob=await job_queue.blobs.put(
+                        open(f"tests/img/{name}", "rb").read()
+                    ),
+                    owner_ref=1,
+                    first_name="Test",
+                    last_name="User",
+                    animal_name=name,
+                    number_of_results=2,
+                    archive=(
+                        await job_queue.blobs.put(b"teddy as taken")
+                        if name == "teddy.jpg"
+                        else None
+                    ),
+                )
+            )
+            job_queue.add_job(jobs[-1])
+        for lease in job_queue.lease_jobs(4):
+            await job_queue.submit_job(lease.job.id, b"xray %d" % lease.job.id)
+        await job_queue.replace_result(jobs[0].id, 1, b"fractured")
+        await job_queue.confirm_job(jobs[0].id, ConfirmJobEnum.confirm, 1, None)
+        # one dispatch of the last job is lost in the restart
+        assert job_queue.lease_job().job is jobs[2]
+        job_queue.journal.close()
+
+        recovered = JobQueue(
+            results_per_image=2,
+            carrousel_size=3,
+            storage=mock_storage,
+            journal=Journal(tmp_path, compact_every),
+        )
+        await recovered.recover()
+        assert list(recovered.awaiting_approval) == [jobs[1].id, jobs[2].id]
+        job, results = recovered.awaiting_approval[jobs[1].id]
+        assert job.animal_name == "teddy.jpg"
+        assert [recovered.blobs.read(r) for r in results] == [b"xray %d" % job.id] * 2
+        assert (
+            recovered.blobs.read(job.blob) == open("tests/img/teddy.jpg", "rb").read()
+        )
+        assert recovered.blobs.read(job.archive) == b"teddy as taken"
+        assert [j.id for j in recovered.queue] == [jobs[2].id]
+        assert recovered.queue.peek().number_of_results == 2
+        xray, original = recovered.get_carousel()[0]
+        assert recovered.blobs.read(xray) == b"fractured"
+        assert Job.c_id > jobs[2].id
+        recovered.journal.close()
+
+    async def test_invalid_choice(self, mock_storage, tmp_path):
+        mock_storage.create_storage_for_user()
+        job_queue = JobQueue(
+            results_per_image=1,
+            carrousel_size=3,
+            storage=mock_storage,
+            journal=Journal(tmp_path),
+        )
+        await job_queue.recover()
+        job = Job(
+            blob=await job_queue.blobs.put(b"original"),
+            owner_ref=0,
+            first_name="Test",
+            last_name="User",
+            animal_name="Teddy",
+            number_of_results=1,
+        )
+        job_queue.add_job(job)
+        await job_queue.submit_job(job_queue.lease_job().job.id, b"xray")
+        with pytest.raises(ValueError):
+            await job_queue.confirm_job(job.id, ConfirmJobEnum.confirm, 1, None)
+        assert job.id in job_queue.awaiting_approval
+        # a record the state cannot take does not stop the journal
+        job_queue.journal.record({"op": "confirm", "id": job.id, "choice": 5})
+        await job_queue.confirm_job(job.id, ConfirmJobEnum.confirm, 0, None)
+        job_queue.journal.close()
+
+        recovered = JobQueue(
+            results_per_image=1,
+            carrousel_size=3,
+            storage=mock_storage,
+            journal=Journal(tmp_path),
+        )
+        await recovered.recover()
+        assert not recovered.awaiting_approval
+        xray, original = recovered.get_carousel()[0]
+        assert recovered.blobs.read(xray) == b"xray"
+        recovered.journal.close()
+
+    async def test_upload_recovery(self, mock_storage, tmp_path):
+        down = FlakyStorage(failures=100)
+
+        def make_queue(storage, **kwargs):
+            return JobQueue(
+                results_per_image=1,
+                carrousel_size=3,
+                storage=storage,
+                journal=Journal(tmp_path),
+                uploads=UploadPipeline(storage, **kwargs),
+            )
+
+        job_queue = make_queue(down, retries=100, backoff=60)
+        await job_queue.recover()
+        jobs = []
+        for name in ["stuck", "failed"]:
+            jobs.append(
+                Job(
+                    blob=await job_queue.blobs.put(name.encode()),
+                    owner_ref=0,
+                    first_name="Test",
+                    last_name="User",
+                    animal_name=name,
+                    number_of_results=1,
+                )
+            )
+            job_queue.add_job(jobs[-1])
+            await job_queue.submit_job(jobs[-1].id, b"xray " + name.encode())
+        await job_queue.confirm_job(jobs[0].id, ConfirmJobEnum.confirm, 0, None)
+        await asyncio.sleep(0.05)
+        assert job_queue.upload_status(jobs[0].id)["status"] == "retrying"
+        job_queue.uploads.retries = 0
+        await job_queue.confirm_job(jobs[1].id, ConfirmJobEnum.confirm, 0, None)
+        await asyncio.sleep(0.05)
+        assert job_queue.upload_status(jobs[1].id)["status"] == "failed"
+        # the process stops before the first upload got through
+        job_queue.journal.close()
+        await job_queue.uploads.aclose(timeout=0)
+
+        up = FlakyStorage(failures=0)
+        recovered = make_queue(up)
+        await recovered.recover()
+        await recovered.uploads.join()
+        assert recovered.upload_status(jobs[0].id)["status"] == "done"
+        assert up.storage[0] == {"normal": b"stuck", "xray": b"xray stuck"}
+        assert recovered.upload_status(jobs[1].id)["status"] == "failed"
+        assert recovered.retry_upload(jobs[1].id)
+        await recovered.uploads.join()
+        assert recovered.upload_status(jobs[1].id)["status"] == "done"
+        assert up.storage[0] == {"normal": b"failed", "xray": b"xray failed"}
+        recovered.journal.close()
+
+        # nothing is uploaded a second time
+        restarted = make_queue(up)
+        await restarted.recover()
+        assert restarted.upload_statuses() == []
+        restarted.journal.close()
+
+
+def test_job_deque():
+    queue = JobDeque()
+    jobs = [
+        Job(
+            blob="",
+            owner_ref=1,
+            first_name="Test",
+            last_name="User",
+            animal_name=f"Teddy {i}",
+        )
+        for i in range(4)
+    ]
+    for job in jobs[:3]:
+        queue.append(job)
+    queue.appendleft(jobs[3])
+    assert len(queue) == 4
+    assert list(queue) == [jobs[3], jobs[0], jobs[1], jobs[2]]
+    assert queue.discard(jobs[0].id) is jobs[0]
+    assert queue.discard(jobs[0].id) is None
+    assert jobs[0] not in queue
+    assert queue.peek() is jobs[3]
+    assert queue.popleft() is jobs[3]
+    assert queue.popleft() is jobs[1]
+    assert queue.popleft() is jobs[2]
+    assert queue.peek() is None
+    with pytest.raises(IndexError):
+        queue.popleft()
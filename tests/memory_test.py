@@ -0,0 +1,60 @@
+import pytest
+
+from backend.routes.memory import MemoryAccountant
+
+
+class Holder:
+    def __init__(self, memory: MemoryAccountant, size: int):
+        self.memory = memory
+        self.size = size
+        self.rolled = False
+        memory.resize(self, size)
+
+    async def rollover(self):
+        self.rolled = True
+        self.memory.resize_spilled(self, self.size)
+
+
+@pytest.mark.anyio
+class TestMemoryAccountant:
+    async def test_spill_least_recently_used(self):
+        memory = MemoryAccountant(budget=250, spill_threshold=200)
+        first, second = Holder(memory, 100), Holder(memory, 100)
+        # using the first holder makes the second one the least recently used
+        memory.touch(first)
+        third = Holder(memory, 100)
+        await memory.enforce()
+        assert memory.resident == 200
+        assert memory.spilled == 100
+        assert second.rolled
+        assert not first.rolled and not third.rolled
+
+    async def test_forget(self):
+        memory = MemoryAccountant()
+        resident, spilled = Holder(memory, 10), Holder(memory, 200)
+        await spilled.rollover()
+        assert memory.stats()["resident"] == 10
+        assert memory.stats()["spilled"] == 200
+        memory.forget(resident)
+        memory.forget(spilled)
+        assert memory.stats()["resident"] == 0
+        assert memory.stats()["spilled"] == 0
+
+    async def test_failed_rollover(self):
+        class Failing(Holder):
+            async def rollover(self):
+                raise OSError("No space left on device")
+
+        class Skipping(Holder):
+            async def rollover(self):
+                pass
+
+        for holder_type in [Failing, Skipping]:
+            memory = MemoryAccountant(budget=150)
+            holder, other = holder_type(memory, 100), Holder(memory, 100)
+            await memory.enforce()
+            # the bytes are still in memory and counted
+            assert memory.resident == 200
+            assert not other.rolled
+            memory.forget(holder)
+            assert memory.resident == 100
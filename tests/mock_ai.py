@@ -45,10 +45,9 @@ async def run():
     headers = {"Authorization": f"Bearer {token}"}
     while True:
         print("requesting job")
-        r = requests.get(f"{BACKEND_URL}/job", headers=headers)
+        r = requests.get(f"{BACKEND_URL}/job", params={"wait": 30}, headers=headers)
         if r.status_code == 204:
             print("no job available")
-            await sleep(5)
             continue
         if r.status_code == 401:
             print("unauthorized, retrying")
@@ -69,7 +68,7 @@ async def run():
             f"{BACKEND_URL}/job",
             headers=headers,
             files={"result": ("test_result.png", result, "image/png")},
-            data={"image_id": img_id},
+            data={"image_id": img_id, "lease_token": r.headers["lease_token"]},
         )
         await sleep(5)
 
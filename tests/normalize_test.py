@@ -0,0 +1,41 @@
+import io
+
+import pytest
+from PIL import ExifTags, Image
+
+from backend.routes.normalize import Normalizer, UnsupportedImage
+
+
+def encode(image: Image.Image, format: str, **kwargs) -> io.BytesIO:
+    out = io.BytesIO()
+    image.save(out, format, **kwargs)
+    out.seek(0)
+    return out
+
+
+@pytest.mark.anyio
+class TestNormalizer:
+    async def test_downscale_and_orientation(self):
+        exif = Image.Exif()
+        # rotated by 90 degrees, as a phone held upright stores it
+        exif[ExifTags.Base.Orientation] = 6
+        photo = encode(Image.new("RGB", (4000, 3000), "red"), "JPEG", exif=exif)
+        data = await Normalizer(max_edge=400).normalize(photo)
+        image = Image.open(io.BytesIO(data))
+        assert image.format == "JPEG"
+        assert image.size == (300, 400)
+        assert ExifTags.Base.Orientation not in image.getexif()
+
+    async def test_keep_small_images(self):
+        normalizer = Normalizer(max_edge=400, format="png")
+        assert (
+            await normalizer.normalize(encode(Image.new("RGB", (40, 30)), "PNG"))
+            is None
+        )
+        # converted even though it is small enough
+        data = await normalizer.normalize(encode(Image.new("RGBA", (40, 30)), "WEBP"))
+        assert Image.open(io.BytesIO(data)).format == "PNG"
+
+    async def test_unsupported(self):
+        with pytest.raises(UnsupportedImage):
+            await Normalizer().normalize(io.BytesIO(b"not an image"))
@@ -0,0 +1,58 @@
+import io
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from backend.routes.overlays import OverlayLibrary
+
+
+def png(width: int, height: int, mode: str = "RGBA") -> bytes:
+    out = io.BytesIO()
+    Image.new(mode, (width, height), "red").save(out, "PNG")
+    return out.getvalue()
+
+
+def test_register():
+    library = OverlayLibrary()
+    id = library.register(png(40, 20))
+    assert library.register(png(40, 20)) == id
+    assert id in library and len(library) == 1
+    with pytest.raises(ValueError):
+        library.register(b"not an image")
+    with pytest.raises(ValueError):
+        library.register(png(40, 20, "RGB"))
+    with pytest.raises(KeyError):
+        library.get("unknown", 1.0)
+
+
+def test_scaled_variants():
+    library = OverlayLibrary(scale_step=0.05)
+    id = library.register(png(40, 20))
+    # decoded on registration
+    assert library.get(id, 1.0).shape == (20, 40, 4)
+    half = library.get(id, 0.5)
+    assert half.shape == (10, 20, 4)
+    assert not half.flags.writeable
+    # within half a step of 0.5
+    assert library.get(id, 0.51) is half
+    assert library.stats()["overlay_hits"] == 2
+    assert library.stats()["overlay_misses"] == 1
+    expected = cv2.resize(library.get(id, 1.0), (0, 0), fx=0.5, fy=0.5)
+    assert np.array_equal(half, expected)
+
+
+def test_budget_and_remove():
+    library = OverlayLibrary()
+    id = library.register(png(100, 100))
+    library.budget = library.bytes + 50 * 50
+    library.get(id, 0.5)
+    # the unscaled overlay made room and is decoded again when needed
+    assert library.stats()["overlay_variants"] == 1
+    assert library.get(id, 1.0).shape == (100, 100, 4)
+    assert library.remove(id)
+    assert not library.remove(id)
+    assert library.bytes == 0
+    with pytest.raises(KeyError):
+        library.get(id, 0.5)
@@ -0,0 +1,50 @@
+import io
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from backend.routes.previews import PreviewCache
+
+
+def jpeg(width: int, height: int, orientation: int = 1) -> bytes:
+    out = io.BytesIO()
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    Image.new("RGB", (width, height), "gray").save(out, "JPEG", exif=exif)
+    return out.getvalue()
+
+
+def test_scaled_copy():
+    cache = PreviewCache(max_edge=400)
+    preview = cache.get("a", jpeg(2000, 1000))
+    assert preview.pixels.shape == (200, 400, 3)
+    assert (preview.fx, preview.fy) == (0.2, 0.2)
+    assert not preview.pixels.flags.writeable
+    assert cache.get("a", b"not decoded again") is preview
+    assert cache.stats()["preview_hits"] == 1
+    with pytest.raises(ValueError):
+        cache.get("b", b"not an image")
+
+
+def test_orientation():
+    # turned upright like cv2.imdecode does for the full resolution
+    data = jpeg(2000, 1000, orientation=6)
+    full = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    preview = PreviewCache(max_edge=400).get("a", data)
+    assert preview.pixels.shape == (400, 200, 3)
+    assert preview.fx * full.shape[1] == preview.pixels.shape[1]
+    assert preview.fy * full.shape[0] == preview.pixels.shape[0]
+
+
+def test_budget_and_encode():
+    cache = PreviewCache(max_edge=100, format="webp")
+    first = cache.get("a", jpeg(300, 300))
+    cache.budget = first.pixels.nbytes
+    cache.get("b", jpeg(300, 300))
+    assert cache.stats()["previews"] == 1
+    encoded = cache.encode(first.pixels)
+    assert Image.open(io.BytesIO(encoded)).format == "WEBP"
+    with pytest.raises(ValueError):
+        PreviewCache(format="png")
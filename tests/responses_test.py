@@ -0,0 +1,96 @@
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from backend.routes.responses import byte_range, content_response, file_response
+
+
+def test_byte_range():
+    assert byte_range("bytes=0-9", 100) == (0, 10)
+    assert byte_range("bytes=90-", 100) == (90, 100)
+    assert byte_range("bytes=-10", 100) == (90, 100)
+    assert byte_range("bytes=50-1000", 100) == (50, 100)
+    # several ranges and other units are ignored, the whole content is sent
+    assert byte_range("bytes=0-9,20-29", 100) is None
+    assert byte_range("items=0-9", 100) is None
+    assert byte_range("bytes=a-b", 100) is None
+    with pytest.raises(ValueError):
+        byte_range("bytes=100-", 100)
+    with pytest.raises(ValueError):
+        byte_range("bytes=-0", 100)
+
+
+@pytest.fixture
+def client(tmp_path) -> TestClient:
+    app = FastAPI()
+    (tmp_path / "ab").mkdir()
+    path = tmp_path / "ab" / "abc"
+    path.write_bytes(b"0123456789")
+    headers = {"ETag": '"abc"'}
+
+    @app.api_route("/memory", methods=["GET", "HEAD"])
+    def memory(request: Request):
+        return content_response(request, b"0123456789", "image/png", headers)
+
+    @app.api_route("/file", methods=["GET", "HEAD"])
+    def file(request: Request):
+        return file_response(request, path, "image/png", headers)
+
+    @app.api_route("/proxied", methods=["GET", "HEAD"])
+    def proxied(request: Request):
+        mapping = f"{tmp_path}=/_blobs/"
+        return file_response(request, path, "image/png", headers, accel_mapping=mapping)
+
+    @app.api_route("/elsewhere", methods=["GET", "HEAD"])
+    def elsewhere(request: Request):
+        mapping = "/elsewhere=/_blobs/"
+        return file_response(request, path, "image/png", headers, accel_mapping=mapping)
+
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("url", ["/memory", "/file"])
+def test_ranges(client: TestClient, url: str):
+    response = client.get(url)
+    assert response.content == b"0123456789"
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["etag"] == '"abc"'
+    response = client.get(url, headers={"Range": "bytes=2-4"})
+    assert response.status_code == 206
+    assert response.content == b"234"
+    assert response.headers["content-range"] == "bytes 2-4/10"
+    response = client.get(url, headers={"Range": "bytes=20-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */10"
+    # the range only applies to the version the client has
+    response = client.get(url, headers={"Range": "bytes=2-4", "If-Range": '"old"'})
+    assert response.status_code == 200
+    assert response.content == b"0123456789"
+    response = client.head(url)
+    assert response.status_code == 200
+    assert response.headers["content-length"] == "10"
+    assert response.content == b""
+
+
+def test_accel_redirect(client: TestClient, tmp_path):
+    mapping = {"X-Accel-Mapping": f"{tmp_path}=/_blobs/"}
+    response = client.get("/proxied", headers=mapping)
+    assert response.headers["x-accel-redirect"] == "/_blobs/ab/abc"
+    assert response.headers["etag"] == '"abc"'
+    assert response.content == b""
+    # without the mapping from the proxy the backend sends the file itself
+    response = client.get("/proxied")
+    assert "x-accel-redirect" not in response.headers
+    assert response.content == b"0123456789"
+    # a client cannot choose the mapping
+    response = client.get("/file", headers=mapping)
+    assert "x-accel-redirect" not in response.headers
+    response = client.get("/proxied", headers={"X-Accel-Mapping": "/=/_secret/"})
+    assert "x-accel-redirect" not in response.headers
+    assert response.content == b"0123456789"
+    # files outside of the mapped directory are sent by the backend
+    response = client.get(
+        "/elsewhere", headers={"X-Accel-Mapping": "/elsewhere=/_blobs/"}
+    )
+    assert "x-accel-redirect" not in response.headers
+    assert response.content == b"0123456789"
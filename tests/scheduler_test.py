@@ -0,0 +1,101 @@
+from unittest import mock
+
+import pytest
+
+from backend.routes.jobqueue import Job
+from backend.routes.scheduler import (
+    FairScheduler,
+    JobDeque,
+    PriorityScheduler,
+    create_scheduler,
+)
+
+
+def make_job(animal_type: str = "other", broken_bone: bool = False) -> Job:
+    return Job(
+        blob="",
+        owner_ref=1,
+        first_name="Test",
+        last_name="User",
+        animal_name="Teddy",
+        animal_type=animal_type,
+        broken_bone=broken_bone,
+    )
+
+
+def drain(scheduler) -> list[Job]:
+    jobs = []
+    while scheduler.peek() is not None:
+        jobs.append(scheduler.popleft())
+    return jobs
+
+
+@pytest.mark.parametrize("policy", ["fifo", "priority", "fair"])
+def test_common_behaviour(policy):
+    scheduler = create_scheduler(policy)
+    jobs = [make_job() for _ in range(4)]
+    for job in jobs[:3]:
+        scheduler.append(job)
+    scheduler.appendleft(jobs[3])
+    assert len(scheduler) == 4
+    assert jobs[3] in scheduler
+    assert scheduler.discard(jobs[1].id) is jobs[1]
+    assert scheduler.discard(jobs[1].id) is None
+    assert jobs[1] not in scheduler
+    # without any priorities every policy falls back to FIFO
+    assert drain(scheduler) == [jobs[3], jobs[0], jobs[2]]
+    with pytest.raises(IndexError):
+        scheduler.popleft()
+
+
+def test_priority_aging():
+    scheduler = create_scheduler("priority", broken_bone_boost=60)
+    with mock.patch("time.monotonic", return_value=1000.0):
+        old = make_job()
+        scheduler.append(old)
+    with mock.patch("time.monotonic", return_value=1030.0):
+        urgent = make_job(broken_bone=True)
+        scheduler.append(urgent)
+    with mock.patch("time.monotonic", return_value=1070.0):
+        late_urgent = make_job(broken_bone=True)
+        scheduler.append(late_urgent)
+    # the old job was waiting longer than the head start of the last one
+    assert drain(scheduler) == [urgent, old, late_urgent]
+
+
+def test_priority_retry():
+    scheduler = create_scheduler("priority", retry_boost=300)
+    first, retried = make_job(), make_job()
+    scheduler.append(first)
+    retried.retries = 1
+    scheduler.append(retried)
+    assert scheduler.peek() is retried
+
+
+def test_fair_weights():
+    scheduler = FairScheduler(lambda job: job.animal_type, {"bear": 2})
+    bears = [make_job("bear") for _ in range(6)]
+    others = [make_job("pikachu") for _ in range(3)]
+    for job in others + bears:
+        scheduler.append(job)
+    order = [job.animal_type for job in drain(scheduler)]
+    assert order[:6].count("bear") == 4
+    assert sorted(order) == ["bear"] * 6 + ["pikachu"] * 3
+
+
+def test_fair_idle_class_gets_no_credit():
+    scheduler = FairScheduler(lambda job: job.animal_type)
+    for _ in range(5):
+        scheduler.append(make_job("bear"))
+    for _ in range(4):
+        scheduler.popleft()
+    late = [make_job("pikachu") for _ in range(3)]
+    for job in late:
+        scheduler.append(job)
+    # the newcomer doesn't get four dispatches in a row to catch up
+    assert [j.animal_type for j in drain(scheduler)][:2] != ["pikachu"] * 2
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        create_scheduler("lottery")
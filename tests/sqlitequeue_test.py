@@ -0,0 +1,254 @@
+import asyncio
+import io
+import time
+from unittest import mock
+
+import pytest
+from fastapi import UploadFile
+
+from backend.routes.blobstore import BlobTooLarge, read_chunks
+from backend.routes.jobqueue import ConfirmJobEnum, Job, PendingFilter
+from backend.routes.scheduler import create_scheduler
+from backend.routes.sqlitequeue import SQLiteJobQueue
+from backend.routes.uploads import UploadPipeline
+from tests.conftest import MockStorage
+from tests.uploads_test import FlakyStorage
+
+
+def make_queue(tmp_path, storage, **kwargs) -> SQLiteJobQueue:
+    return SQLiteJobQueue(
+        tmp_path / "queue.sqlite3",
+        tmp_path / "blobs",
+        results_per_image=2,
+        carrousel_size=1,
+        storage=storage,
+        **kwargs,
+    )
+
+
+async def add(queue: SQLiteJobQueue, data: bytes, **kwargs) -> Job:
+    job = Job(
+        blob=await queue.blobs.put(data),
+        owner_ref=1,
+        first_name="Test",
+        last_name="User",
+        animal_name="Teddy",
+        number_of_results=2,
+        **kwargs,
+    )
+    queue.add_job(job)
+    return job
+
+
+@pytest.mark.anyio
+class TestSQLiteJobQueue:
+    async def test_shared_between_queues(self, tmp_path, mock_storage: MockStorage):
+        mock_storage.create_storage_for_user()
+        mock_storage.create_storage_for_user()
+        # two queues on the same database stand in for two worker processes
+        first = make_queue(tmp_path, mock_storage)
+        second = make_queue(tmp_path, mock_storage)
+        job = await add(first, b"teddy")
+        other = await add(second, b"teddy")
+        assert other.id == job.id + 1
+        assert second.blobs.stats() == {"blobs": 1, "bytes": 5, "refs": 2}
+        leases = second.lease_jobs(3)
+        assert [lease.job.id for lease in leases] == [job.id, job.id, other.id]
+        assert first.queued() == 1
+        for lease in leases[:2]:
+            await first.submit_job(job.id, b"xray %d" % lease.job.id, lease.token)
+        with pytest.raises(ValueError):
+            await first.submit_job(job.id, b"again", leases[0].token)
+        pending_job, results = second.get_pending(job.id)
+        assert pending_job.animal_name == "Teddy"
+        assert [second.blobs.read(r) for r in results] == [b"xray %d" % job.id] * 2
+        assert [j.id for j, _ in first.pending()] == [job.id, other.id]
+
+        await second.confirm_job(job.id, ConfirmJobEnum.confirm, 1, None)
+        assert first.get_pending(job.id) is None
+        await second.uploads.join()
+        # the state of the uploads is visible to the other processes
+        assert first.upload_status(job.id)["status"] == "done"
+        assert mock_storage.storage[1]["xray"] == b"xray %d" % job.id
+        [(xray, original)] = first.get_carousel()
+        assert first.blobs.read(xray) == b"xray %d" % job.id
+        assert original == job.blob
+        # the next confirmation pushes the first one out of the carousel
+        await first.confirm_job(other.id, ConfirmJobEnum.cancel, 0, None)
+        assert first.blobs.stats()["refs"] == 2
+        first.close()
+        second.close()
+
+    async def test_upload_takeover(self, tmp_path):
+        down, up = FlakyStorage(failures=100), FlakyStorage(failures=0)
+        down.create_storage_for_user()
+        up.create_storage_for_user()
+        crashed = make_queue(
+            tmp_path, down, uploads=UploadPipeline(down, retries=100, backoff=60)
+        )
+        carried_on = make_queue(tmp_path, up)
+        job = await add(crashed, b"teddy")
+        for lease in crashed.lease_jobs(2):
+            await crashed.submit_job(job.id, b"xray", lease.token)
+        await crashed.confirm_job(job.id, ConfirmJobEnum.confirm, 0, None)
+        await asyncio.sleep(0.05)
+        assert carried_on.upload_status(job.id)["status"] == "retrying"
+        # the uploads stay with the process as long as it renews them
+        assert crashed.claim_uploads() == 0
+        assert carried_on.claim_uploads() == 0
+        crashed.uploads.retries = 0
+        await crashed.uploads.aclose(timeout=0)
+        assert carried_on.claim_uploads(time.time() + 31) == 1
+        await carried_on.uploads.join()
+        assert carried_on.upload_status(job.id)["status"] == "done"
+        assert up.storage[1] == {"normal": b"teddy", "xray": b"xray"}
+        # only the carousel holds the images now
+        assert carried_on.blobs.stats()["refs"] == 2
+
+        failing = await add(carried_on, b"other")
+        for lease in carried_on.lease_jobs(2):
+            await carried_on.submit_job(failing.id, b"xray", lease.token)
+        await crashed.confirm_job(failing.id, ConfirmJobEnum.confirm, 0, None)
+        await crashed.uploads.join()
+        assert carried_on.upload_status(failing.id)["status"] == "failed"
+        assert carried_on.claim_uploads(time.time() + 31) == 0
+        # retried by another process than the one it failed in
+        assert carried_on.retry_upload(failing.id)
+        assert not crashed.retry_upload(failing.id)
+        await carried_on.uploads.join()
+        assert up.storage[1] == {"normal": b"other", "xray": b"xray"}
+        assert carried_on.blobs.stats()["refs"] == 2
+        crashed.close()
+        carried_on.close()
+
+    async def test_lease_expiry(self, tmp_path, mock_storage):
+        queue = make_queue(tmp_path, mock_storage)
+        job = await add(queue, b"teddy")
+        other = await add(queue, b"other")
+        lost = queue.lease_job()
+        # reaping without leases due only reads
+        statements = []
+        queue._db.set_trace_callback(statements.append)
+        assert queue.expire_leases(lost.deadline - 1) == 0
+        assert statements and "BEGIN IMMEDIATE" not in statements
+        queue._db.set_trace_callback(None)
+        assert queue.expire_leases(lost.deadline) == 1
+        # the lost dispatch is handed out before the jobs behind it
+        assert queue.lease_job().job.id == job.id
+        assert queue.lease_job().job.id == job.id
+        assert queue.lease_job().job.id == other.id
+        with pytest.raises(ValueError):
+            await queue.submit_job(job.id, b"result", lost.token)
+        queue.close()
+
+    async def test_wait_for_job(self, tmp_path, mock_storage):
+        queue = make_queue(tmp_path, mock_storage, poll_interval=0.01)
+        other_process = make_queue(tmp_path, mock_storage)
+        assert await queue.wait_for_job(0.02) is None
+        waiting = asyncio.create_task(queue.wait_for_job(1))
+        await asyncio.sleep(0.02)
+        job = await add(other_process, b"teddy")
+        assert (await waiting).job.id == job.id
+        assert queue.lease_job().job.id == job.id
+        # polling an empty queue only reads
+        statements = []
+        queue._db.set_trace_callback(statements.append)
+        assert await queue.wait_for_job(0.05) is None
+        assert statements and "BEGIN IMMEDIATE" not in statements
+        queue.close()
+        other_process.close()
+
+    async def test_fair_retry(self, tmp_path, mock_storage):
+        queue = make_queue(
+            tmp_path,
+            mock_storage,
+            scheduler=create_scheduler("fair", weights={"retry": 2}),
+        )
+        bears = [await add(queue, b"bear %d" % i, animal_type="bear") for i in range(3)]
+        retried = bears[0]
+        queue.lease_jobs(2)
+        await queue.confirm_job(retried.id, ConfirmJobEnum.retry, 0, None)
+        order = [lease.job.id for lease in queue.lease_jobs(6)]
+        # the retry class is new, so it starts at the pass of the last dispatch
+        assert order == [
+            retried.id,
+            retried.id,
+            bears[1].id,
+            bears[1].id,
+            bears[2].id,
+            bears[2].id,
+        ]
+        assert queue.get_pending(retried.id)[0].retries == 1
+        queue.close()
+
+    async def test_changes(self, tmp_path, mock_storage):
+        first = make_queue(tmp_path, mock_storage)
+        second = make_queue(tmp_path, mock_storage)
+        assert first.changes(-1) == (0, None)
+        a = await add(first, b"a")
+        b = await add(second, b"b")
+        version, changed = second.changes(0)
+        assert changed == [a.id, b.id]
+        await first.confirm_job(a.id, ConfirmJobEnum.cancel, 0, None)
+        # the change made by one process is seen by the other
+        assert second.changes(version) == (version + 1, [a.id])
+        with mock.patch("backend.routes.sqlitequeue.CHANGE_LOG_SIZE", 1):
+            await second.submit_job(b.id, b"result")
+        assert first.changes(0)[1] is None
+        assert first.changes(version + 1) == (version + 2, [b.id])
+        first.close()
+        second.close()
+
+    async def test_pending_page(self, tmp_path, mock_storage):
+        queue = make_queue(tmp_path, mock_storage)
+        a = await add(queue, b"a", animal_type="bear")
+        b = await add(queue, b"b", animal_type="giraffe")
+        c = await add(queue, b"c", animal_type="bear")
+        for result in [b"x", b"y"]:
+            await queue.submit_job(c.id, result)
+        page, cursor = queue.pending_page(PendingFilter(), None, 2)
+        assert [job.id for job, _ in page] == [a.id, b.id]
+        page, cursor = queue.pending_page(PendingFilter(), cursor, 2)
+        assert [(job.id, len(results)) for job, results in page] == [(c.id, 2)]
+        assert cursor is None
+        page, _ = queue.pending_page(PendingFilter(animal_type="bear"), None, 10)
+        assert [job.id for job, _ in page] == [a.id, c.id]
+        page, _ = queue.pending_page(PendingFilter(complete=False), None, 10)
+        assert [job.id for job, _ in page] == [a.id, b.id]
+        # the listing follows the retry, like the in-memory queue
+        await queue.confirm_job(c.id, ConfirmJobEnum.retry, 0, None)
+        assert queue.pending_page(PendingFilter(complete=True), None, 10) == ([], None)
+        retried = queue.get_pending(c.id)[0]
+        assert retried.added > b.added
+        page, _ = queue.pending_page(PendingFilter(added_after=retried.added), None, 10)
+        assert [job.id for job, _ in page] == [c.id]
+        # a queue expecting fewer results per image sees the jobs as complete
+        await queue.submit_job(c.id, b"z")
+        other = SQLiteJobQueue(
+            tmp_path / "queue.sqlite3",
+            tmp_path / "blobs",
+            results_per_image=1,
+            carrousel_size=1,
+            storage=mock_storage,
+        )
+        page, _ = other.pending_page(PendingFilter(complete=True), None, 10)
+        assert [job.id for job, _ in page] == [c.id]
+        queue.close()
+        other.close()
+
+    async def test_put_stream(self, tmp_path, mock_storage):
+        queue = make_queue(tmp_path, mock_storage)
+        id = await queue.blobs.put_stream(
+            read_chunks(UploadFile(io.BytesIO(b"teddy")), 2)
+        )
+        assert await queue.blobs.put(b"teddy") == id
+        assert queue.blobs.stats() == {"blobs": 1, "bytes": 5, "refs": 2}
+        with pytest.raises(BlobTooLarge):
+            await queue.blobs.put_stream(
+                read_chunks(UploadFile(io.BytesIO(b"x" * 100)), 8), limit=20
+            )
+        assert len(queue.blobs) == 1
+        assert list((tmp_path / "blobs").glob("*.tmp")) == []
+        # all blobs are files that can be sent as they are
+        assert queue.blobs.path(id).read_bytes() == b"teddy"
+        queue.close()
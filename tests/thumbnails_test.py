@@ -0,0 +1,68 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+
+from backend.routes.blobstore import BlobStore
+from backend.routes.thumbnails import ThumbnailCache
+
+
+def png(width: int, height: int, color: str = "red") -> bytes:
+    out = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(out, "PNG")
+    return out.getvalue()
+
+
+@pytest.mark.anyio
+class TestThumbnailCache:
+    async def test_render_once(self):
+        blobs = BlobStore()
+        id = await blobs.put(png(1000, 500))
+        cache = ThumbnailCache(sizes=(100, 400), format="png")
+        first, second = await asyncio.gather(
+            cache.get(blobs.open, id, 100), cache.get(blobs.open, id, 100)
+        )
+        assert first is second
+        assert Image.open(io.BytesIO(first)).size == (100, 50)
+        assert cache.stats()["thumbnail_misses"] == 1
+        assert cache.stats()["thumbnail_hits"] == 1
+        with pytest.raises(ValueError):
+            await cache.get(blobs.open, id, 200)
+
+    async def test_cancelled_render(self):
+        blobs = BlobStore()
+        id = await blobs.put(png(1000, 500))
+        cache = ThumbnailCache(sizes=(100,), format="png")
+        rendering = asyncio.create_task(cache.get(blobs.open, id, 100))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(cache.get(blobs.open, id, 100))
+        await asyncio.sleep(0)
+        rendering.cancel()
+        # the other request renders it instead of failing with the first one
+        assert Image.open(io.BytesIO(await waiting)).size == (100, 50)
+        with pytest.raises(asyncio.CancelledError):
+            await rendering
+        assert cache.stats()["thumbnail_misses"] == 2
+
+    async def test_budget_and_invalidate(self):
+        blobs = BlobStore()
+        ids = [await blobs.put(png(400, 400, color)) for color in ["red", "blue"]]
+        cache = ThumbnailCache(sizes=(400,), format="png")
+        size = len(await cache.get(blobs.open, ids[0], 400))
+        cache.budget = size * 3 // 2
+        await cache.get(blobs.open, ids[1], 400)
+        # the least recently used thumbnail made room for the new one
+        assert cache.stats()["thumbnails"] == 1
+        cache.invalidate(ids[1])
+        assert cache.stats()["thumbnail_bytes"] == 0
+
+    async def test_prefetch(self):
+        blobs = BlobStore()
+        id = await blobs.put(png(800, 800))
+        cache = ThumbnailCache(sizes=(100, 400))
+        cache.prefetch(blobs.open, id)
+        await asyncio.gather(*cache._prefetching)
+        assert cache.stats()["thumbnails"] == 2
+        await cache.get(blobs.open, id, 400)
+        assert cache.stats()["thumbnail_misses"] == 2
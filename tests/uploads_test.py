@@ -0,0 +1,96 @@
+import pytest
+
+from backend.routes.blobstore import BlobStore
+from backend.routes.uploads import Upload, UploadPipeline, UploadState, UploadStatus
+from tests.conftest import MockStorage
+
+
+class FlakyStorage(MockStorage):
+    def __init__(self, failures: int):
+        super().__init__()
+        self.failures = failures
+        self.create_storage_for_user()
+
+    def upload_file(self, user_ref, type, file_path, filename):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("Seafile is down")
+        super().upload_file(user_ref, type, file_path, filename)
+
+
+async def submit(pipeline: UploadPipeline, blobs: BlobStore):
+    original = await blobs.put(b"teddy")
+    xray = await blobs.put(b"xray")
+    state = pipeline.submit(
+        1,
+        0,
+        blobs,
+        [
+            Upload("normal", original, "1_original.png"),
+            Upload("xray", xray, "1_result.png"),
+        ],
+    )
+    # the queue lets go of the images, the pipeline keeps them until uploaded
+    blobs.release(original)
+    blobs.release(xray)
+    return state
+
+
+@pytest.mark.anyio
+class TestUploadPipeline:
+    async def test_retry(self):
+        storage = FlakyStorage(failures=2)
+        blobs = BlobStore()
+        changes = []
+        pipeline = UploadPipeline(
+            storage, backoff=0.01, on_change=lambda s: changes.append(s.status)
+        )
+        state = await submit(pipeline, blobs)
+        await pipeline.join()
+        assert state.status == UploadStatus.done
+        assert storage.storage[0] == {"normal": b"teddy", "xray": b"xray"}
+        assert changes.count(UploadStatus.retrying) == 2
+        assert state.as_dict()["uploaded"] == 2
+        assert len(blobs) == 0
+        await pipeline.aclose()
+
+    async def test_failed(self):
+        storage = FlakyStorage(failures=10)
+        blobs = BlobStore()
+        pipeline = UploadPipeline(storage, retries=2, backoff=0.01)
+        state = await submit(pipeline, blobs)
+        await pipeline.join()
+        assert pipeline.status(1) is state
+        assert state.status == UploadStatus.failed
+        assert state.attempts == 3
+        assert state.error == "ConnectionError: Seafile is down"
+        assert storage.storage[0] == {"normal": {}, "xray": {}}
+        # the files are kept until the upload is retried
+        assert len(blobs) == 2
+        assert pipeline.retry(2) is None
+        storage.failures = 0
+        assert pipeline.retry(1) is state
+        await pipeline.join()
+        assert state.status == UploadStatus.done
+        assert storage.storage[0] == {"normal": b"teddy", "xray": b"xray"}
+        assert len(blobs) == 0
+        assert pipeline.retry(1) is None
+        await pipeline.aclose()
+
+    async def test_resume(self):
+        storage = FlakyStorage(failures=0)
+        blobs = BlobStore()
+        pipeline = UploadPipeline(storage)
+        files = [
+            Upload("normal", await blobs.put(b"teddy"), "1_original.png"),
+            Upload("xray", await blobs.put(b"xray"), "1_result.png"),
+        ]
+        # the original was uploaded before a restart
+        state = UploadState(1, 0, files)
+        state.uploaded = 1
+        pipeline.resume(state, blobs)
+        await pipeline.join()
+        assert state.status == UploadStatus.done
+        assert storage.storage[0] == {"normal": {}, "xray": b"xray"}
+        assert len(blobs) == 0
+        await pipeline.aclose()